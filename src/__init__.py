@@ -7,3 +7,4 @@ from flask import Flask
 app = Flask(__name__, static_folder='../static', static_url_path='/')
 
 from . import routes
+from . import commands
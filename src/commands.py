@@ -0,0 +1,512 @@
+#
+# flask CLI commands for jobs over the whole datastore, e.g.
+#
+#   flask migrate-to-mongo --mongo-url mongodb://localhost:27017 --checkpoint migrate.json
+#   flask update-users --workers 16
+#   flask dump-users > users.txt
+#   flask compress-programs
+#   flask recount-stats
+#   flask reindex-search
+#   flask refresh-gallery
+#   flask mongo-indexes --explain
+#
+# They're built on the paging, worker pool and checkpoint helpers in jobs.py,
+# and (apart from the migration) run against whichever backend db_translate
+# picked, so they work on both NDB and Mongo.
+#
+
+from datetime import datetime
+import os
+
+import click
+from bson import ObjectId
+
+from . import app, jobs, mongo_models
+from .db_translate import db, NDB_DBGlue, screenshot_hash, ITER_BATCH_SIZE
+
+
+def job_options(checkpoint=None, workers=8, page_size=100, batch_size=50):
+    """
+    The options every job takes, with per job defaults.
+    """
+    options = [
+        click.option('--checkpoint', default=checkpoint, show_default=True,
+                     help='File to save progress in, so the job can be resumed.'),
+        click.option('--restart', is_flag=True, help='Ignore the checkpoint and start over.'),
+        click.option('--workers', default=workers, show_default=True, help='Worker threads.'),
+        click.option('--page-size', default=page_size, show_default=True, help='Entities read at a time.'),
+        click.option('--batch-size', default=batch_size, show_default=True, help='Entities written at a time.'),
+    ]
+
+    def decorator(command):
+        for option in reversed(options):
+            command = option(command)
+        return command
+    return decorator
+
+
+def run_job(name, glue, fetch_page, work, checkpoint=None, restart=False, workers=8, batch_size=None):
+    """
+    Page through fetch_page(cursor) and call work(items, progress) on the worker pool.
+    """
+    progress = jobs.Progress(name)
+    return jobs.run_pages(
+        fetch_page, lambda items: work(items, progress),
+        jobs.Checkpoint(checkpoint, restart), progress,
+        workers=workers, batch_size=batch_size, context=glue.stream_context)
+
+
+#
+# NDB -> Mongo migration
+#
+# Users are read from NDB a page at a time and each worker copies one user
+# with everything under it: the user, its folders, their programs and
+# screenshots. Documents are written with insert_many in batches. Since a page
+# that was cut short is run again on resume, a user is first cleared out of
+# Mongo, so copying the same user twice leaves a single copy.
+#
+
+def mongo_doc(model_obj, _id):
+    """
+    A bunnet model as a raw document for insert_many, with an _id chosen up front
+    so children can refer to it.
+    """
+    doc = mongo_models.to_document(model_obj)
+    doc["_id"] = _id
+    return doc
+
+
+def clear_mongo_user(username):
+    users = mongo_models.User.get_motor_collection()
+    folders = mongo_models.Folder.get_motor_collection()
+    existing = users.find_one({"key": username}, {"_id": 1})
+    if not existing:
+        return
+    folder_ids = [str(f["_id"]) for f in folders.find({"parentID": str(existing["_id"])}, {"_id": 1})]
+    mongo_models.Program.get_motor_collection().delete_many({"parentID": {"$in": folder_ids}})
+    mongo_models.Screenshot.get_motor_collection().delete_many({"parentID": {"$in": folder_ids}})
+    folders.delete_many({"parentID": str(existing["_id"])})
+    users.delete_one({"_id": existing["_id"]})
+
+
+class BatchWriter:
+    """
+    Collects documents per collection and writes them with insert_many batch_size at a time.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pending = {}
+
+    def add(self, model, doc):
+        docs = self.pending.setdefault(model, [])
+        docs.append(doc)
+        if len(docs) >= self.batch_size:
+            self.flush(model)
+
+    def flush(self, model=None):
+        for m in (model and [model] or list(self.pending)):
+            docs = self.pending.pop(m, [])
+            if docs:
+                m.get_motor_collection().insert_many(docs, ordered=False)
+
+
+def migrate_user(source, ndb_user, batch_size, progress):
+    """
+    Copy one user, their folders, programs and screenshots.
+    """
+    username = source.get_id(ndb_user)
+    clear_mongo_user(username)
+
+    secret = ndb_user.secret or ""
+    if isinstance(secret, bytes):
+        secret = secret.decode('utf-8')
+    email = ndb_user.email or (ndb_user.gaeUser and ndb_user.gaeUser.email().lower()) or ""
+
+    writer = BatchWriter(batch_size)
+    user_id = ObjectId()
+    writer.add(mongo_models.User, mongo_doc(mongo_models.User(
+        key=username, joinDate=ndb_user.joinDate or datetime.now(), email=email, secret=secret), user_id))
+
+    nfolders = nprograms = nscreenshots = 0
+    for ndb_folder in source.folders(username):
+        folder = source.get_id(ndb_folder)
+        folder_id = ObjectId()
+        writer.add(mongo_models.Folder, mongo_doc(mongo_models.Folder(
+            parentID=str(user_id), key=folder, isPublic=ndb_folder.isPublic is not False), folder_id))
+        nfolders += 1
+
+        # legacy inline screenshots come out of iter_programs as a screenshot, so they're moved over here
+        for name, data, shot in source.iter_programs(username, folder):
+            writer.add(mongo_models.Program, mongo_doc(mongo_models.Program(
+                parentID=str(folder_id), key=name,
+                description=data.get("description"), source=data.get("source"),
+                date_time=data.get("datetime") or datetime.now(),
+                screenshotHash=shot and screenshot_hash(shot[0]) or ""), ObjectId()))
+            nprograms += 1
+            if shot:
+                writer.add(mongo_models.Screenshot, mongo_doc(mongo_models.Screenshot(
+                    parentID=str(folder_id), key=name, image=shot[0], mimetype=shot[1]), ObjectId()))
+                nscreenshots += 1
+    writer.flush()
+
+    progress.add(users=1, folders=nfolders, programs=nprograms, screenshots=nscreenshots)
+
+
+@app.cli.command('migrate-to-mongo')
+@click.option('--mongo-url', default=lambda: os.environ.get('MONGO_URL'),
+              help='Where to copy to, defaults to $MONGO_URL.')
+@job_options(checkpoint='migrate-to-mongo.json', batch_size=500)
+def migrate_to_mongo(mongo_url, checkpoint, restart, workers, page_size, batch_size):
+    """
+    Copy every user, folder, program and screenshot from NDB to MongoDB.
+    Each worker copies one user at a time, --batch-size is documents per insert_many.
+    """
+    if not mongo_url:
+        raise click.UsageError("--mongo-url or MONGO_URL is needed")
+    mongo_models.init_client(mongo_url)
+
+    source = NDB_DBGlue()
+    run_job('migrate-to-mongo', source,
+            lambda cursor: source.users_page(page_size, cursor),
+            lambda ndb_user, progress: migrate_user(source, ndb_user, batch_size, progress),
+            checkpoint, restart, workers)
+
+
+#
+# Maintenance jobs, these used to be modDBFunctions run through "flask shell"
+#
+
+def fix_user_email(user_obj):
+    """
+    Users carried over from the python2 app may only have an email in gaeUser,
+    or one that isn't lowercase. Returns True if user_obj was changed.
+    """
+    gae_user = getattr(user_obj, 'gaeUser', None)  # only NDB users have one
+    if not gae_user:
+        return False
+    email = (user_obj.email or gae_user.email()).lower()
+    if email == user_obj.email:
+        return False
+    user_obj.email = email
+    return True
+
+
+def update_users(users, progress):
+    changed = [u for u in users if fix_user_email(u)]
+    if changed:
+        db.put_users(changed)
+    progress.add(users=len(users), modified=len(changed))
+
+
+def dump(entities, progress):
+    for entity in entities:
+        print(entity)
+    progress.add(entities=len(entities))
+
+
+@app.cli.command('update-users')
+@job_options(checkpoint='update-users.json')
+def update_users_command(checkpoint, restart, workers, page_size, batch_size):
+    """
+    Give every user a lowercase email, taken from gaeUser if need be.
+    Changed users are saved --batch-size at a time.
+    """
+    run_job('update-users', db, lambda cursor: db.users_page(page_size, cursor),
+            update_users, checkpoint, restart, workers, batch_size)
+
+
+@app.cli.command('dump-users')
+@job_options(workers=1, page_size=500)
+def dump_users_command(checkpoint, restart, workers, page_size, batch_size):
+    """
+    Print every user.
+    """
+    run_job('dump-users', db, lambda cursor: db.users_page(page_size, cursor),
+            dump, checkpoint, restart, workers, batch_size)
+
+
+@app.cli.command('dump-settings')
+@job_options(workers=1, page_size=500)
+def dump_settings_command(checkpoint, restart, workers, page_size, batch_size):
+    """
+    Print every Setting (NDB only).
+    """
+    if not isinstance(db, NDB_DBGlue):
+        raise click.UsageError("Settings are only kept in NDB")
+    run_job('dump-settings', db, lambda cursor: db.settings_page(page_size, cursor),
+            dump, checkpoint, restart, workers, batch_size)
+
+
+def compress_user_programs(user_obj, progress):
+    """
+    Rewrite every program of a user in its current storage format: source
+    compressed, and legacy inline screenshots moved out to Screenshots.
+    """
+    username = db.get_id(user_obj)
+    nprograms = nscreenshots = 0
+    for folder_obj in db.folders(username):
+        folder = db.get_id(folder_obj)
+        cursor = None
+        while True:
+            page, cursor = db.programs_page(username, folder, ITER_BATCH_SIZE, cursor)
+            for program_obj in page:
+                if db.has_legacy_screenshot(program_obj):
+                    db.move_legacy_screenshot(program_obj)
+                    nscreenshots += 1
+            db.write_pending(page)
+            nprograms += len(page)
+            if not cursor:
+                break
+    progress.add(users=1, programs=nprograms, screenshots=nscreenshots)
+
+
+@app.cli.command('compress-programs')
+@job_options(checkpoint='compress-programs.json')
+def compress_programs_command(checkpoint, restart, workers, page_size, batch_size):
+    """
+    Store every program compressed. Programs are also compressed whenever
+    they're saved, this is for the ones nobody saves again.
+    """
+    run_job('compress-programs', db, lambda cursor: db.users_page(page_size, cursor),
+            compress_user_programs, checkpoint, restart, workers)
+
+
+@app.cli.command('recount-stats')
+def recount_stats_command():
+    """
+    Count users, folders and programs from scratch and reset the counters
+    /api/stats reads. The first read starts them off by itself, this is for
+    after anything that writes around DBGlue (like migrate-to-mongo).
+    """
+    with db.stream_context():
+        totals = db.recount()
+    click.echo(", ".join("%s=%d" % item for item in totals.items()))
+
+
+def reindex_user(user_obj, progress):
+    """
+    Index the programs of a user's public folders, and take the private ones out.
+    """
+    username = db.get_id(user_obj)
+    nfolders = nprograms = 0
+    for folder_obj in db.folders(username):
+        nprograms += db.reindex_folder(username, db.get_id(folder_obj), db.is_public(folder_obj))
+        nfolders += 1
+    progress.add(users=1, folders=nfolders, programs=nprograms)
+
+
+@app.cli.command('reindex-search')
+@job_options(checkpoint='reindex-search.json')
+def reindex_search_command(checkpoint, restart, workers, page_size, batch_size):
+    """
+    Build the /api/search index from scratch. Saves keep it up to date after
+    that, this is for programs saved before it existed, or written around DBGlue.
+    """
+    run_job('reindex-search', db, lambda cursor: db.users_page(page_size, cursor),
+            reindex_user, checkpoint, restart, workers)
+
+
+@app.cli.command('refresh-gallery')
+def refresh_gallery_command():
+    """
+    Recompute the gallery feeds, for running on a schedule (see gallery.py).
+    """
+    with db.stream_context():
+        feeds = db.refresh_feeds()
+    click.echo(", ".join("%s=%d" % (name, len(feed["programs"])) for name, feed in feeds.items()))
+
+
+#
+# Mongo indexes
+#
+# mongo_models.INDEXES are created at startup when they're missing, but that
+# can't build a unique index over duplicates, or change an index that
+# exists under the same name with other options. mongo-indexes checks them,
+# drops the redundant mongo_models.OBSOLETE_INDEXES, shows how much each index is used ($indexStats) and which index each kind
+# of query MONGO_DBGlue runs picks (explain), e.g.
+#
+#   flask mongo-indexes --explain
+#   flask mongo-indexes --repair
+#
+
+def index_problem(existing, index):
+    """
+    Why an index from INDEXES doesn't match the existing ones, or None.
+    """
+    spec = index.document
+    found = existing.get(spec["name"])
+    if not found:
+        return "missing"
+    if "weights" in spec:
+        # a text index's key is its _fts field, its fields are in weights
+        if found.get("weights") != spec["weights"]:
+            return "weights are %s" % (found.get("weights"),)
+    elif list(found["key"]) != list(spec["key"].items()):
+        return "keys are %s" % (found["key"],)
+    if bool(found.get("unique")) != bool(spec.get("unique")):
+        return "unique is %s" % bool(found.get("unique"))
+    return None
+
+
+def duplicate_groups(collection, fields, limit=10):
+    """
+    Up to limit groups of documents that a unique index on fields would reject.
+    """
+    return list(collection.aggregate([
+        {"$group": {"_id": {f: "$" + f for f in fields}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+        {"$limit": limit}], allowDiskUse=True))
+
+
+def sample_path():
+    """
+    Names and documents of some user, folder and program to fill queries in with.
+    """
+    program = mongo_models.Program.get_motor_collection().find_one({}) or {}
+    folder = mongo_models.Folder.get_motor_collection().find_one(
+        program and {"_id": ObjectId(program["parentID"])} or {}) or {}
+    user = mongo_models.User.get_motor_collection().find_one(
+        folder and {"_id": ObjectId(folder["parentID"])} or {}) or {}
+    return user, folder, program
+
+
+def glue_queries(user, folder, program):
+    """
+    (description, model, filter, sort) for every kind of find MONGO_DBGlue
+    runs, or (description, model, pipeline, None) for aggregations.
+    """
+    user_id, folder_id = str(user.get("_id")), str(folder.get("_id"))
+    name, folder_name, program_name = user.get("key", ""), folder.get("key", ""), program.get("key", "")
+    date_time = program.get("date_time", datetime.now())
+    return [
+        ("get_user", mongo_models.User, {"email": user.get("email", "")}, None),
+        ("get_user_byusername", mongo_models.User, {"key": name}, None),
+        ("users_page", mongo_models.User, {"_id": {"$gt": ObjectId()}}, [("_id", 1)]),
+        ("resolve_path", mongo_models.User, db.path_pipeline(name, folder_name, program_name), None),
+        ("folders", mongo_models.Folder, {"parentID": user_id}, None),
+        ("folders_page", mongo_models.Folder, {"parentID": user_id, "key": {"$gt": ""}}, [("key", 1)]),
+        ("programs, program_summaries", mongo_models.Program, {"parentID": folder_id}, None),
+        ("program (by name)", mongo_models.Program, {"parentID": folder_id, "key": program_name}, None),
+        ("programs_page, summaries_page by name", mongo_models.Program,
+         {"parentID": folder_id, "key": {"$gt": ""}}, [("key", 1)]),
+        ("summaries_page by datetime", mongo_models.Program,
+         {"parentID": folder_id, "$or": [{"date_time": {"$lt": date_time}},
+                                         {"date_time": date_time, "key": {"$gt": program_name}}]},
+         [("date_time", -1), ("key", 1)]),
+        ("load_screenshots", mongo_models.Screenshot, {"parentID": folder_id, "key": {"$in": [program_name]}}, None),
+        ("screenshot (by name)", mongo_models.Screenshot, {"parentID": folder_id, "key": program_name}, None),
+        ("program_versions", mongo_models.ProgramVersion,
+         {"parentID": folder_id, "key": program_name}, [("date_time", -1)]),
+        ("program_version", mongo_models.ProgramVersion, {"parentID": folder_id, "key": program_name, "slot": 0}, None),
+        ("stats", mongo_models.Counter, {"key": {"$in": ["users"]}}, None),
+        ("search", mongo_models.SearchDocument, {"$text": {"$search": '"%s"' % (program_name or "box")}}, None),
+        ("unindex_search_folder", mongo_models.SearchDocument, {"folder": "%s/%s" % (name, folder_name)}, None),
+        ("recent_programs", mongo_models.SearchDocument, {}, [("date_time", -1)]),
+        ("most_viewed", mongo_models.ProgramViews, {}, [("views", -1)]),
+        ("feed", mongo_models.Feed, {"key": "recent"}, None),
+    ]
+
+
+def plan_stages(plan):
+    """
+    The stages of a winning plan, outermost first, e.g. ["LIMIT", "FETCH", "IXSCAN parentID_key_unique"].
+    """
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage += " " + plan["indexName"]
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0] or plan.get("queryPlan")
+    return stages
+
+
+def explain_query(model, query, sort):
+    collection = model.get_motor_collection()
+    if sort is None and isinstance(query, list):
+        explained = collection.database.command(
+            "explain", {"aggregate": collection.name, "pipeline": query, "cursor": {}}, verbosity="queryPlanner")
+        # the first stage's plan, $lookup's don't show theirs here
+        planner = explained.get("queryPlanner") or explained["stages"][0]["$cursor"]["queryPlanner"]
+    else:
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        planner = cursor.explain()["queryPlanner"]
+    return plan_stages(planner["winningPlan"])
+
+
+@app.cli.command('mongo-indexes')
+@click.option('--repair', is_flag=True,
+              help='Create missing indexes, rebuild ones with other options and drop obsolete ones.')
+@click.option('--explain', is_flag=True, help="Show the plan of every kind of query the app runs.")
+def mongo_indexes_command(repair, explain):
+    """
+    Check the indexes in mongo_models.INDEXES, find the OBSOLETE_INDEXES that
+    are still there and report how much each index on the app's collections
+    is used. A unique index can't be built while
+    there are duplicates, those are listed and have to be cleaned up first.
+    """
+    if isinstance(db, NDB_DBGlue):
+        raise click.UsageError("Indexes are only checked on Mongo, set MONGO_URL")
+
+    ok = True
+    for model, indexes in mongo_models.INDEXES.items():
+        collection = model.get_motor_collection()
+        model_ok = True
+        for index in indexes:
+            spec = index.document
+            problem = index_problem(collection.index_information(), index)
+            click.echo("%s.%s: %s" % (collection.name, spec["name"], problem or "ok"))
+            if not problem:
+                continue
+            duplicates = spec.get("unique") and duplicate_groups(collection, list(spec["key"])) or []
+            for group in duplicates:
+                click.echo("    %d documents with %s" % (group["n"], group["_id"]))
+            # the old index is only dropped when the new one can be built
+            if repair and not duplicates:
+                if problem != "missing":
+                    collection.drop_index(spec["name"])
+                try:
+                    collection.create_indexes([index])
+                    click.echo("    rebuilt")
+                    continue
+                except Exception as e:
+                    click.echo("    can't build it: %s" % e)
+            ok = model_ok = False
+
+        # the indexes that replace an obsolete one have to be there before it's dropped
+        for name in mongo_models.OBSOLETE_INDEXES.get(model, []):
+            if name not in collection.index_information():
+                continue
+            click.echo("%s.%s: obsolete" % (collection.name, name))
+            if repair and model_ok:
+                collection.drop_index(name)
+                click.echo("    dropped")
+            else:
+                ok = False
+
+    click.echo("\nIndex usage since each index was loaded:")
+    for model in mongo_models.INDEXES:
+        collection = model.get_motor_collection()
+        try:
+            usage = list(collection.aggregate([{"$indexStats": {}}]))
+        except Exception as e:
+            click.echo("%s: $indexStats not available: %s" % (collection.name, e))
+            continue
+        for entry in sorted(usage, key=lambda u: u["name"]):
+            click.echo("%s.%s: %d ops" % (collection.name, entry["name"], entry["accesses"]["ops"]))
+
+    if explain:
+        click.echo("\nQuery plans:")
+        for description, model, query, sort in glue_queries(*sample_path()):
+            try:
+                stages = explain_query(model, query, sort)
+            except Exception as e:
+                stages = ["can't explain: %s" % e]
+            warning = any(s.startswith("COLLSCAN") for s in stages) and "  <-- collection scan" or ""
+            click.echo("%s: %s%s" % (description, " <- ".join(stages), warning))
+
+    if not ok:
+        raise SystemExit(1)
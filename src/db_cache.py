@@ -0,0 +1,322 @@
+#
+# Caching layers that sit in front of the DBGlue backends in db_translate.
+#
+
+import functools
+import os
+import pickle
+import threading
+
+import cachetools
+import flask
+
+#
+# Request scoped identity map.
+#
+# A single API call tends to look up the same user, folder or program several
+# times (parseUrlPath, authorize_user, the handler itself). The identity map
+# lives in flask.g so every lookup after the first one in a request is served
+# from memory, and it's dropped when the request is torn down.
+#
+# Entries are keyed by kind and names, e.g. ('program', user, folder, program).
+# Misses are remembered too (as None) so "does it exist?" checks are also free.
+#
+
+IDENTITY_MAP = 'db_identity_map'
+
+
+def identity_map():
+    """
+    Return the identity map for the current request, or None outside of a request
+    (e.g. flask shell or CLI commands, which would otherwise grow it forever).
+    """
+    if not flask.has_request_context():
+        return None
+    if IDENTITY_MAP not in flask.g:
+        setattr(flask.g, IDENTITY_MAP, {})
+    return flask.g.get(IDENTITY_MAP)
+
+
+def remember(entity, kind, *names):
+    imap = identity_map()
+    if imap is not None:
+        imap[(kind,) + names] = entity
+    return entity
+
+
+def forget(kind):
+    """
+    Drop every entry of a kind. Writes use this when they can't cheaply name
+    the exact entry that changed.
+    """
+    imap = identity_map()
+    if imap is not None:
+        for key in [k for k in imap if k[0] == kind]:
+            del imap[key]
+
+
+def clear_identity_map(exc=None):
+    """
+    teardown_request handler.
+    """
+    flask.g.pop(IDENTITY_MAP, None)
+
+
+def request_cached(kind):
+    """
+    Decorator for DBGlue lookups that take names and return a single entity (or None).
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *names):
+            imap = identity_map()
+            if imap is None:
+                return method(self, *names)
+            key = (kind,) + names
+            if key not in imap:
+                imap[key] = method(self, *names)
+            return imap[key]
+        return wrapper
+    return decorator
+
+
+PATH_KINDS = ('user', 'folder', 'program')
+
+
+def path_keys(user, folder=None, program=None):
+    names = [n for n in (user, folder, program) if n is not None]
+    return [(kind,) + tuple(names[:i+1]) for i, kind in enumerate(PATH_KINDS[:len(names)])]
+
+
+def remembered_path(user, folder=None, program=None):
+    """
+    The (user, folder, program) entities of a path if every one of them is in
+    the identity map, otherwise None.
+    """
+    imap = identity_map()
+    keys = path_keys(user, folder, program)
+    if imap is None or not all(key in imap for key in keys):
+        return None
+    found = [imap[key] for key in keys]
+    return tuple(found + [None]*(3 - len(found)))
+
+
+def remember_path(entities, user, folder=None, program=None):
+    imap = identity_map()
+    if imap is not None:
+        for key, entity in zip(path_keys(user, folder, program), entities):
+            imap[key] = entity
+    return entities
+
+
+def request_cached_path(method):
+    """
+    Decorator for DBGlue.resolve_path. The pieces of the path are stored under
+    the same keys as the single lookups, so a resolved path also answers later
+    get_user_byusername/folder/program calls and vice versa.
+    """
+    @functools.wraps(method)
+    def wrapper(self, user, folder=None, program=None):
+        if identity_map() is None:
+            return method(self, user, folder, program)
+
+        found = remembered_path(user, folder, program)
+        if found is None:
+            remember_path(method(self, user, folder, program), user, folder, program)
+            found = remembered_path(user, folder, program)
+        return found
+    return wrapper
+
+
+#
+# Process wide TTL caches.
+#
+# Users and folder listings are read on nearly every API call but change
+# rarely, so they're kept for a short while across requests. Each instance
+# only sees its own writes, hence the short TTL: other instances may serve
+# a stale folder list for up to CACHE_TTL seconds.
+#
+# Only hits are cached, never None. Remembering that a user doesn't exist
+# could let a stale miss on one instance create the same user twice.
+#
+
+CACHE_TTL = float(os.environ.get('DB_CACHE_TTL', 60))
+CACHE_SIZE = int(os.environ.get('DB_CACHE_SIZE', 4096))
+
+process_caches = {}
+
+
+class ProcessCache:
+    """
+    A bounded, thread safe TTL+LRU cache, used as a decorator on DBGlue methods.
+    Keys are the method's positional arguments (minus self).
+    """
+
+    def __init__(self, name, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.name = name
+        self.cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped on every invalidation, see __call__
+        process_caches[name] = self
+
+    def __call__(self, method):
+        @functools.wraps(method)
+        def wrapper(glue, *names):
+            with self.lock:
+                value = self.cache.get(names)
+                if value is not None:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+                generation = self.generation
+
+            value = method(glue, *names)
+
+            with self.lock:
+                # don't store a value that was read before a concurrent write invalidated it
+                if value is not None and generation == self.generation:
+                    self.cache[names] = value
+            return value
+        return wrapper
+
+    def invalidate(self, *names):
+        with self.lock:
+            self.generation += 1
+            self.cache.pop(names, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": self.cache.currsize, "maxsize": self.cache.maxsize,
+                    "ttl": self.cache.ttl}
+
+
+users_cache = ProcessCache('users')
+folders_cache = ProcessCache('folders')
+feeds_cache = ProcessCache('feeds', maxsize=16)  # gallery feeds, see gallery.py
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in process_caches.items()}
+
+
+#
+# Shared cache tier.
+#
+# Program reads are cached in a store that every instance can see, so a
+# popular public program is read from the datastore once rather than once per
+# instance. SHARED_CACHE_URL picks the backend:
+#
+#   redis://host:6379/0 (or rediss://)  a Redis server shared by all instances
+#   local                               an in-process cache, only safe with a single instance
+#   unset                               no shared caching
+#
+# The in-process cache can't see writes made on other instances, and a stale
+# program read followed by a save would clobber newer work, so it has to be
+# asked for explicitly.
+#
+
+SHARED_CACHE_URL = os.environ.get('SHARED_CACHE_URL')
+SHARED_CACHE_TTL = int(os.environ.get('SHARED_CACHE_TTL', 300))
+
+
+class NullCache:
+    """
+    No shared caching. Every get is a miss.
+    """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+
+class LocalCache:
+    """
+    In-process fallback for the shared tier.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=SHARED_CACHE_TTL):
+        self.cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.cache.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.cache[key] = value
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.cache.pop(key, None)
+
+
+class RedisCache:
+    """
+    Redis backed shared tier. Values are pickled.
+
+    The cache is an optimization, so if Redis is unreachable reads are treated
+    as misses and the error is logged rather than failing the request.
+    """
+
+    def __init__(self, url, ttl=SHARED_CACHE_TTL):
+        import redis
+        self.errors = redis.RedisError
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            value = self.client.get(key)
+        except self.errors as e:
+            print("shared cache get failed:", key, e)
+            return None
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        try:
+            self.client.set(key, pickle.dumps(value), ex=self.ttl)
+        except self.errors as e:
+            print("shared cache set failed:", key, e)
+
+    def delete(self, *keys):
+        try:
+            self.client.delete(*keys)
+        except self.errors as e:
+            print("shared cache delete failed:", keys, e)
+
+
+def make_shared_cache(url):
+    if not url:
+        return NullCache()
+    if url == 'local':
+        return LocalCache()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url)
+    raise ValueError("Unknown SHARED_CACHE_URL: " + url)
+
+
+def shared_key(kind, *names):
+    """
+    Names are URI-escaped, so they never contain a '/'.
+    """
+    return kind + ':' + '/'.join(names)
+
+
+shared_cache = make_shared_cache(SHARED_CACHE_URL)
@@ -1,10 +1,104 @@
 from . import mongo_models
 from . import ndb_models
+from . import db_cache
+from . import write_buffer
+from . import search_index
+from . import gallery
+from datetime import datetime
+import base64
+import contextlib
+import hashlib
+import json
 import os
 import abc
+import random
+import threading
+
+import pymongo
+from bson import ObjectId
 
 MONGO_URL = os.environ.get('MONGO_URL', None)
 
+# How many entities a lazy iterator reads from the datastore at a time
+ITER_BATCH_SIZE = 50
+
+# A program keeps up to VERSION_HISTORY earlier versions, at most one per
+# VERSION_INTERVAL seconds of saving, see DBGlue.version_to_keep
+VERSION_HISTORY = int(os.environ.get('PROGRAM_VERSIONS', 10))
+VERSION_INTERVAL = int(os.environ.get('PROGRAM_VERSION_INTERVAL', 600))
+
+# How many programs put_programs callers should hand over at a time. Each one
+# can be three NDB entities, and a single commit is limited to 500 entities/10MB.
+PUT_BATCH_SIZE = 25
+
+# What stats() counts. Each NDB counter is spread over COUNTER_SHARDS entities.
+COUNTERS = ("users", "folders", "programs")
+COUNTER_SHARDS = 20
+
+# The backend independent view of a program, see program_to_data/program_from_data
+PROGRAM_FIELDS = ("description", "source", "screenshot", "screenshotHash", "datetime", "nextVersionSlot")
+
+
+def decode_data_url(data_url):
+    """
+    Split a 'data:image/png;base64,...' URL (str or bytes), as sent by the IDE,
+    into (image bytes, mimetype). An empty URL means no screenshot.
+    """
+    if isinstance(data_url, bytes):
+        data_url = data_url.decode('utf-8')
+    if not data_url:
+        return b'', None
+    header, sep, payload = data_url.partition(',')
+    if not sep or not header.startswith('data:') or not header.endswith(';base64'):
+        raise ValueError("Not a base64 data URL")
+    return base64.b64decode(payload), header[len('data:'):-len(';base64')] or 'application/octet-stream'
+
+
+def screenshot_hash(image):
+    return hashlib.sha1(image).hexdigest()
+
+def encode_cursor(*values):
+    """
+    An opaque page cursor for a position given by values (strings or datetimes).
+    """
+    values = [isinstance(v, datetime) and v.isoformat() or v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, count):
+    """
+    The count values encode_cursor was given, as strings. Raises ValueError for a cursor it didn't make.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != count or not all(isinstance(v, str) for v in values):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+class CompletedFuture:
+    """
+    What the *_async methods of a backend without an async API return: the
+    call has already run, and like an ndb.Future its value is read with result().
+    """
+
+    def __init__(self, value=None):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class ProgramChanged(Exception):
+    """
+    A conditional save (upsert_program with expected) found the program
+    changed or gone since the caller read it. Nothing was written.
+    """
+    pass
+
+
 class DBGlue(abc.ABC):
     """     
     This class is used to translate the database calls from the
@@ -20,6 +114,13 @@ class DBGlue(abc.ABC):
     def get_id(self, obj):
         pass
 
+    @abc.abstractmethod
+    def path(self, obj):
+        """
+        The names leading to a user, folder or program, e.g. (user, folder, program).
+        """
+        pass
+
     @abc.abstractmethod
     def get_user(self, email):
         pass
@@ -33,15 +134,43 @@ class DBGlue(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def folders(self, user_id):
+    def users_page(self, limit, cursor=None):
+        """
+        One page of all users, for jobs that walk the whole datastore.
+        Returns (users, cursor) like programs_page.
+        """
         pass
 
+    @abc.abstractmethod
+    def put_users(self, user_objs):
+        """
+        Save changes to existing users with one batched write.
+        """
+        pass
+
+    @db_cache.folders_cache
+    def folders(self, user_id):
+        """
+        Every folder of a user, read a page at a time.
+        """
+        return list(self.iter_folders(user_id))
+
     @abc.abstractmethod
     def folder(self, user, folder):
         pass
 
+    @abc.abstractmethod
+    def folders_page(self, user, limit, cursor=None):
+        """
+        One page of a user's folders in name order, as (folders, cursor) like programs_page.
+        """
+        pass
+
     @abc.abstractmethod
     def new_folder(self, user_obj, folder_name, public):
+        """
+        Create a folder, or set whether an existing one is public.
+        """
         pass
 
     @abc.abstractmethod
@@ -49,7 +178,12 @@ class DBGlue(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def programs(self, user, folder):
+    def resolve_path(self, user, folder=None, program=None):
+        """
+        Look up a user/folder/program path in a single round trip.
+        Returns a (user, folder, program) tuple, with None for anything
+        that doesn't exist or wasn't asked for.
+        """
         pass
 
     @abc.abstractmethod
@@ -57,11 +191,124 @@ class DBGlue(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def new_program(self, folder_obj, program_name):
+    def program_summaries(self, user, folder):
+        """
+        What a folder listing needs: a list of {"name", "screenshotHash", "datetime"} dicts.
+        Program source is never read.
+        """
         pass
 
     @abc.abstractmethod
-    def put_program(self, program_obj):
+    def load_screenshots(self, user, folder, programs):
+        """
+        The stored Screenshots of some programs in a folder, read in one batch,
+        as {program: {"image", "mimetype", "hash", "datetime"}}. Programs without one are left out.
+        """
+        pass
+
+    @abc.abstractmethod
+    def put_screenshot(self, program_obj, image, mimetype):
+        """
+        Store (or with an empty image, remove) a program's screenshot and record
+        its hash on program_obj. The caller still needs to put_program.
+        """
+        pass
+
+    @abc.abstractmethod
+    def programs_page(self, user, folder, limit, cursor=None):
+        """
+        One page of a folder's programs. Returns (programs, cursor), where cursor is
+        an opaque string for the next page, or None after the last one.
+        """
+        pass
+
+    @abc.abstractmethod
+    def summaries_page(self, user, folder, limit, cursor=None, order="name"):
+        """
+        One page of a folder listing (see program_summaries) as (summaries, cursor),
+        sorted by name, or with order "datetime" newest first (and then by name).
+        A cursor that wasn't made here raises ValueError.
+        """
+        pass
+
+    @abc.abstractmethod
+    def put_programs(self, folder_obj, items):
+        """
+        Create or overwrite programs in a folder with batched writes. items are
+        (name, data, screenshot) with data as from program_to_data and
+        screenshot an (image, mimetype) tuple or None.
+        """
+        pass
+
+    @abc.abstractmethod
+    def stream_context(self):
+        """
+        A context manager to wrap datastore work done outside of a request.
+        """
+        pass
+
+    @abc.abstractmethod
+    def iter_program_sources(self, user, folder):
+        """
+        Lazily yield (name, source) for every program in a folder, reading from the
+        datastore in batches. The folder is looked up right away, but the iterator
+        may be consumed after the request has finished (e.g. by a streamed response).
+        """
+        pass
+
+    @abc.abstractmethod
+    def exists_programs(self, user, folder):
+        """
+        True if the folder holds any programs. Reads at most one key, never program bodies.
+        """
+        pass
+
+    @abc.abstractmethod
+    def upsert_program(self, folder_obj, program_name, source=None, screenshot=None, dt=None, program_obj=None,
+                       expected=None):
+        """
+        Create or update a program with its screenshot and kept version. The
+        search index and, for a new program, the programs counter are updated
+        after the save rather than as part of it. source None leaves the
+        source as it is, and screenshot is an (image, mimetype) tuple, with an
+        empty image to remove it.
+        program_obj is the program as the caller read it, None if there isn't one yet.
+        expected, if given, is the datetime the stored program must still have.
+        The check is part of the write, so of two saves of the same version
+        only one succeeds, the other raises ProgramChanged.
+        Returns the saved program.
+        """
+        pass
+
+    @abc.abstractmethod
+    def program_versions(self, user, folder, program):
+        """
+        The kept versions of a program as [{"id", "datetime"}], newest first.
+        """
+        pass
+
+    @abc.abstractmethod
+    def program_version(self, user, folder, program, version_id):
+        """
+        One kept version as {"id", "datetime", "source"}, or None.
+        """
+        pass
+
+    @abc.abstractmethod
+    def copy_program(self, program_obj, folder_obj, program_name, move=False):
+        """
+        Copy (or with move, rename) a program and its screenshot to program_name
+        in folder_obj, atomically and with a single write of the new program.
+        Returns the new program, or None if the original is gone or the new name
+        is taken by the time the copy runs.
+        """
+        pass
+
+    @abc.abstractmethod
+    def write_programs(self, program_objs):
+        """
+        Write programs, and whatever is kept alongside them (e.g. summaries), in one batch.
+        """
         pass
 
     @abc.abstractmethod
@@ -72,6 +319,464 @@ class DBGlue(abc.ABC):
     def set_datetime(self, obj, dt):
         pass
 
+    @abc.abstractmethod
+    def stats(self):
+        """
+        {"users", "folders", "programs"} totals, read from counters that are kept
+        up to date by the writes, so it costs the same however much there is.
+        Counters that don't exist yet are started off by recount() here.
+        """
+        pass
+
+    @abc.abstractmethod
+    def add_counts(self, **deltas):
+        """
+        Add deltas (e.g. programs=1) to the COUNTERS. Until recount() has
+        started a counter off there's nothing to add to, so it's left alone.
+        """
+        pass
+
+    @abc.abstractmethod
+    def recount(self):
+        """
+        Count everything from scratch and set the counters to that. Slow, for
+        "flask recount-stats" only. Returns the totals.
+        """
+        pass
+
+    @abc.abstractmethod
+    def index_search(self, entries):
+        """
+        Add programs to the search index, or update them. entries are
+        (path, source, datetime) with path (user, folder, program).
+        """
+        pass
+
+    @abc.abstractmethod
+    def unindex_search(self, paths):
+        """
+        Take programs out of the search index.
+        """
+        pass
+
+    @abc.abstractmethod
+    def unindex_search_folder(self, user, folder):
+        """
+        Take every program of a folder out of the search index.
+        """
+        pass
+
+    @abc.abstractmethod
+    def search(self, tokens, limit, cursor=None):
+        """
+        One page of the indexed programs that have every one of tokens (from
+        search_index.query_tokens), best matches first, as
+        ([{"user", "folder", "name", "datetime"}], cursor) like programs_page.
+        A cursor that wasn't made here raises ValueError.
+        """
+        pass
+
+    @abc.abstractmethod
+    def add_views(self, views):
+        """
+        Add {path: views} to the programs' view counts.
+        """
+        pass
+
+    @abc.abstractmethod
+    def most_viewed(self, limit):
+        """
+        [(path, views)] of the limit most viewed programs, most views first.
+        """
+        pass
+
+    @abc.abstractmethod
+    def delete_views(self, paths):
+        pass
+
+    @abc.abstractmethod
+    def recent_programs(self, limit):
+        """
+        [(path, datetime)] of the limit most recently saved programs in the search index, newest first.
+        """
+        pass
+
+    @abc.abstractmethod
+    def indexed_programs(self, paths):
+        """
+        {path: datetime} of the ones of paths that are in the search index.
+        """
+        pass
+
+    @abc.abstractmethod
+    def feed(self, name):
+        """
+        A stored gallery feed as {"programs", "datetime"}, or None.
+        """
+        pass
+
+    @abc.abstractmethod
+    def put_feeds(self, feeds):
+        """
+        Store {name: programs} gallery feeds.
+        """
+        pass
+
+    @abc.abstractmethod
+    def program_to_data(self, program_obj):
+        """
+        A plain dict with (at least) the PROGRAM_FIELDS of a program, suitable for pickling.
+        """
+        pass
+
+    @abc.abstractmethod
+    def program_from_data(self, path, data):
+        """
+        Rebuild a program entity at path (user, folder, program) from program_to_data output.
+        """
+        pass
+
+    #
+    # Screenshots live apart from programs. Programs saved before that still
+    # carry a data URL in program.screenshot, and are moved over when next saved.
+    #
+
+    def legacy_screenshot(self, program_obj):
+        try:
+            image, mimetype = decode_data_url(program_obj.screenshot)
+        except ValueError:
+            return None
+        return image and (image, mimetype) or None
+
+    def screenshot_hash(self, program_obj):
+        """
+        Version stamp of a program's (or program summary's) screenshot, "" if it has none.
+        """
+        if program_obj.screenshotHash is not None:
+            return program_obj.screenshotHash
+        legacy = self.legacy_screenshot(program_obj)
+        return legacy and screenshot_hash(legacy[0]) or ""
+
+    def load_screenshot(self, user, folder, program):
+        return self.load_screenshots(user, folder, [program]).get(program)
+
+    def screenshot(self, user, folder, program, program_obj=None):
+        """
+        A program's screenshot like load_screenshot, falling back to a legacy inline
+        one. Pass program_obj if it's at hand, it's only needed for the fallback.
+        """
+        shot = self.load_screenshot(user, folder, program)
+        if shot:
+            return shot
+        return self.legacy_screenshot_info(program_obj or self.program(user, folder, program))
+
+    def legacy_screenshot_info(self, program_obj):
+        """
+        A legacy inline screenshot in the form load_screenshot returns, or None.
+        """
+        legacy = program_obj and self.legacy_screenshot(program_obj)
+        if not legacy:
+            return None
+        image, mimetype = legacy
+        return {"image": image, "mimetype": mimetype, "hash": screenshot_hash(image),
+                "datetime": program_obj.datetime}
+
+    def move_legacy_screenshot(self, program_obj):
+        """
+        Called by put_program, so a legacy inline screenshot costs one extra write, once.
+        """
+        if self.has_legacy_screenshot(program_obj):
+            self.put_screenshot(program_obj, *(self.legacy_screenshot(program_obj) or (b'', None)))
+
+    def screenshot_unchanged(self, program_obj, screenshot):
+        """
+        Whether saving screenshot, an (image, mimetype) tuple, would store what program_obj already has.
+        """
+        image = screenshot[0]
+        return program_obj is not None and (image and screenshot_hash(image) or "") == program_obj.screenshotHash
+
+    def has_legacy_screenshot(self, program_obj):
+        return program_obj is not None and program_obj.screenshotHash is None and program_obj.screenshot is not None
+
+    #
+    # Saving programs. With a write-behind buffer (see write_buffer.py)
+    # put_program only records the program, and reads check the buffer first.
+    # Anything that reads programs of a folder straight from the datastore
+    # flushes that folder's pending saves before it does.
+    #
+
+    write_buffer = None
+
+    def put_program(self, program_obj):
+        self.move_legacy_screenshot(program_obj)
+        if self.write_buffer:
+            self.write_buffer.put(self.path(program_obj), program_obj)
+        else:
+            self.write_programs([program_obj])
+            self.index_programs([program_obj])
+        self.uncache_program(program_obj)
+
+    def write_pending(self, program_objs):
+        """
+        Flush callback of the write buffer. The shared cache is dropped again
+        once the write is done, another instance may have cached the old program meanwhile.
+        """
+        self.write_programs(program_objs)
+        self.index_programs(program_objs)
+        for program_obj in program_objs:
+            self.uncache_program(program_obj)
+
+    def count(self, **deltas):
+        """
+        add_counts, called after a write. A counter that can't be updated isn't
+        worth failing the write for, "flask recount-stats" puts it right.
+        """
+        try:
+            self.add_counts(**deltas)
+        except Exception as e:
+            print("counter update failed:", deltas, e)
+
+    def pending_program(self, user, folder, program):
+        return self.write_buffer and self.write_buffer.get((user, folder, program))
+
+    def flush_folder(self, user, folder):
+        if self.write_buffer:
+            self.write_buffer.flush_folder(user, folder)
+
+    def flush_program(self, program_obj):
+        if self.write_buffer:
+            self.write_buffer.flush_path(self.path(program_obj))
+
+    # held by conditional saves while they check and buffer a program
+    buffer_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def buffered_check(self, program_obj, expected):
+        """
+        Around a conditional save that goes to the write buffer. The check is
+        against this process's latest save of the program, pending or stored,
+        and the lock is held until the save is buffered, so the next
+        conditional save sees it. Like reads, it can't see other instances'
+        pending saves. Does nothing unless the save is conditional and buffered.
+        """
+        if expected is None or not self.write_buffer:
+            yield
+            return
+        with self.buffer_lock:
+            pending = program_obj and self.pending_program(*self.path(program_obj))
+            latest = pending and pending.datetime or (program_obj and self.stored_datetime(program_obj))
+            if latest != expected:
+                raise ProgramChanged()
+            yield
+
+    @abc.abstractmethod
+    def stored_datetime(self, program_obj):
+        """
+        The datetime of the program as stored right now, None if it's gone.
+        """
+        pass
+
+    #
+    # Search index upkeep (see search_index.py), called after the writes.
+    # Like count(), a failed update is logged rather than failing the write,
+    # and "flask reindex-search" puts it right.
+    #
+
+    def is_public(self, folder_obj):
+        # before March 2015, isPublic wasn't set
+        return folder_obj is not None and folder_obj.isPublic is not False
+
+    def index_programs(self, program_objs):
+        folders = {}
+        for program_obj in program_objs:
+            path = self.path(program_obj)
+            folders.setdefault(path[:2], []).append((path[2], program_obj.source, program_obj.datetime))
+        self.index_sources(folders)
+
+    def index_sources(self, folders):
+        """
+        Index programs given as {(user, folder): [(name, source, datetime)]},
+        the ones in public folders that is.
+        """
+        try:
+            entries = []
+            for (user, folder), programs in folders.items():
+                if self.is_public(self.folder(user, folder)):
+                    entries += [((user, folder, name), source, dt) for name, source, dt in programs]
+            if entries:
+                self.index_search(entries)
+        except Exception as e:
+            print("search index update failed:", e)
+
+    def unindex_programs(self, paths):
+        try:
+            self.unindex_search(paths)
+        except Exception as e:
+            print("search index update failed:", e)
+
+    def reindex_folder(self, user, folder, public=True):
+        """
+        Index every program of a folder that's public, or take them out of the
+        index if it isn't. Returns how many programs were indexed.
+        """
+        indexed = 0
+        try:
+            if not public:
+                self.unindex_search_folder(user, folder)
+                return 0
+            cursor = None
+            while True:
+                page, cursor = self.programs_page(user, folder, ITER_BATCH_SIZE, cursor)
+                self.index_search([((user, folder, self.get_id(p)), p.source, p.datetime) for p in page])
+                indexed += len(page)
+                if not cursor:
+                    break
+        except Exception as e:
+            print("search index update failed:", e)
+        return indexed
+
+    #
+    # Gallery feeds, see gallery.py
+    #
+
+    view_counter = None
+    feed_refresher = None
+
+    def count_view(self, user, folder, program):
+        if self.view_counter:
+            self.view_counter.view((user, folder, program))
+
+    def refresh_feeds(self, size=gallery.GALLERY_SIZE):
+        """
+        Recompute and store the gallery feeds, returns them like feed() does.
+        Only programs in the search index (i.e. in a public folder) make the
+        popular feed, the views of the rest are dropped.
+        """
+        recent = self.recent_programs(size)
+        candidates = self.most_viewed(2*size)
+        indexed = self.indexed_programs([path for path, _ in candidates])
+        gone = [path for path, _ in candidates if path not in indexed]
+        if gone:
+            self.delete_views(gone)
+        popular = [(path, indexed[path], views) for path, views in candidates if path in indexed][:size]
+
+        feeds = {"recent": [self.feed_item(path, dt) for path, dt in recent],
+                 "popular": [dict(self.feed_item(path, dt), views=views) for path, dt, views in popular]}
+        self.put_feeds(feeds)
+        now = datetime.now()
+        return {name: {"programs": programs, "datetime": now} for name, programs in feeds.items()}
+
+    def feed_item(self, path, dt):
+        user, folder, program = path
+        return {"user": user, "folder": folder, "name": program, "datetime": str(dt)}
+
+    def gallery_feed(self, name):
+        """
+        A feed as it was last stored, computed now if it never was.
+        """
+        if self.feed_refresher:
+            self.feed_refresher.start()
+        return self.feed(name) or self.refresh_feeds()[name]
+
+    #
+    # Version history. Versions are kept in a ring of VERSION_HISTORY slots
+    # per program, and the program's nextVersionSlot says which one is the
+    # oldest. The first save in a new VERSION_INTERVAL keeps the program as
+    # it was at its last save there, so a burst of autosaves costs nothing
+    # extra and the ring holds the last VERSION_HISTORY kept versions.
+    #
+
+    def version_to_keep(self, program_obj, source, dt):
+        """
+        (slot, source, datetime) of the version that saving source at dt replaces,
+        if it should be kept, otherwise None. A kept version moves program_obj's
+        nextVersionSlot on, so the caller has to save program_obj as well.
+        """
+        if program_obj is None or source is None or not program_obj.source or not program_obj.datetime:
+            return None
+        if source == program_obj.source:
+            return None
+        interval = int(program_obj.datetime.timestamp() // VERSION_INTERVAL)
+        if interval == int(dt.timestamp() // VERSION_INTERVAL):
+            return None
+        slot = (program_obj.nextVersionSlot or 0) % VERSION_HISTORY
+        program_obj.nextVersionSlot = (slot + 1) % VERSION_HISTORY
+        return slot, program_obj.source, program_obj.datetime
+
+    #
+    # Async variants. A handler starts independent lookups together and then
+    # waits for each with result(), so they overlap where the backend can do
+    # that. By default they simply run synchronously.
+    #
+
+    def resolve_path_async(self, user, folder=None, program=None):
+        return CompletedFuture(self.resolve_path(user, folder, program))
+
+    def iter_pages(self, fetch_page, page_size=ITER_BATCH_SIZE):
+        """
+        Every item of the pages fetch_page(limit, cursor) returns, read a page at a time.
+        """
+        cursor = None
+        while True:
+            page, cursor = fetch_page(page_size, cursor)
+            yield from page
+            if not cursor:
+                break
+
+    def iter_folders(self, user):
+        return self.iter_pages(lambda limit, cursor: self.folders_page(user, limit, cursor))
+
+    def iter_programs(self, user, folder):
+        """
+        Lazily yield (name, data, screenshot) for every program in a folder, as
+        put_programs takes them, reading a page of programs and their
+        screenshots at a time. Safe to consume outside of a request.
+        """
+        cursor = None
+        while True:
+            with self.stream_context():
+                page, cursor = self.programs_page(user, folder, ITER_BATCH_SIZE, cursor)
+                shots = self.load_screenshots(user, folder, [self.get_id(p) for p in page])
+            for p in page:
+                name = self.get_id(p)
+                data = self.program_to_data(p)
+                shot = shots.get(name)
+                yield name, data, shot and (shot["image"], shot["mimetype"]) or self.legacy_screenshot(p)
+            if not cursor:
+                break
+
+    #
+    # Read-through/invalidate helpers for the shared cache tier (db_cache.shared_cache).
+    # Only hits are cached, a missing program is always looked up again.
+    #
+
+    def cached_program(self, path):
+        data = db_cache.shared_cache.get(db_cache.shared_key('program', *path))
+        if data is None:
+            return None
+        return self.program_from_data(path, data)
+
+    def cache_program(self, program_obj):
+        if program_obj:
+            key = db_cache.shared_key('program', *self.path(program_obj))
+            db_cache.shared_cache.set(key, self.program_to_data(program_obj))
+        return program_obj
+
+    def cached_summaries(self, user, folder, load):
+        key = db_cache.shared_key('summaries', user, folder)
+        summaries = db_cache.shared_cache.get(key)
+        if summaries is None:
+            summaries = load()
+            db_cache.shared_cache.set(key, summaries)
+        return summaries
+
+    def uncache_program(self, program_obj):
+        self.uncache_path(*self.path(program_obj))
+
+    def uncache_path(self, user, folder, name):
+        db_cache.shared_cache.delete(db_cache.shared_key('program', user, folder, name),
+                                     db_cache.shared_key('summaries', user, folder))
+
 
 class NDB_DBGlue(DBGlue):
 
@@ -83,64 +788,607 @@ class NDB_DBGlue(DBGlue):
     def get_id(self, obj):
         return obj.key.id()
 
+    def path(self, obj):
+        return tuple(obj.key.flat()[1::2])
+
     def get_user(self, email):
         return ndb_models.User.query(ndb_models.User.email == email).get()
 
+    @db_cache.request_cached('user')
+    @db_cache.users_cache
     def get_user_byusername(self, username):
         return ndb_models.ndb.Key("User", username).get()
 
     def new_user(self, user_id, email, secret):
         """
-        Create a new user, and two default folders.
+        Create a new user, and two default folders. The keys are all known up
+        front, so the three puts are sent together.
         """
         db_user = ndb_models.User(id=user_id, email=email, secret=secret)
-        db_user.put()
         db_my_programs = ndb_models.Folder(
             parent=db_user.key, id="MyPrograms", isPublic=True)
-        db_my_programs.put()
-
-        db_my_programs = ndb_models.Folder(
+        db_private = ndb_models.Folder(
             parent=db_user.key, id="Private", isPublic=False)
-        db_my_programs.put()
+        for future in ndb_models.ndb.put_multi_async([db_user, db_my_programs, db_private]):
+            future.result()
+        self.count(users=1, folders=2)
+
+        db_cache.users_cache.invalidate(user_id)
+        db_cache.folders_cache.invalidate(user_id)
+        db_cache.remember(db_user, 'user', user_id)
+        db_cache.forget('folder')
         return db_user
 
-    def folders(self, user_id):
-        return ndb_models.Folder.query(ancestor=ndb_models.ndb.Key("User", user_id))
+    def users_page(self, limit, cursor=None):
+        start = self.page_cursor(cursor)
+        page, next_cursor, more = ndb_models.User.query().fetch_page(limit, start_cursor=start)
+        return page, more and next_cursor and next_cursor.urlsafe().decode() or None
+
+    def put_users(self, user_objs):
+        ndb_models.ndb.put_multi(user_objs)
+        for user_obj in user_objs:
+            db_cache.users_cache.invalidate(self.get_id(user_obj))
+        db_cache.forget('user')
+
+    def settings_page(self, limit, cursor=None):
+        """
+        Settings only exist in NDB.
+        """
+        start = self.page_cursor(cursor)
+        page, next_cursor, more = ndb_models.Setting.query().fetch_page(limit, start_cursor=start)
+        return page, more and next_cursor and next_cursor.urlsafe().decode() or None
 
+    @db_cache.request_cached('folder')
     def folder(self, user, folder):
         return ndb_models.Folder.query(ancestor=ndb_models.ndb.Key("User", user, "Folder", folder)).get()
 
+    def folders_page(self, user, limit, cursor=None):
+        query = ndb_models.Folder.query(ancestor=ndb_models.ndb.Key("User", user)).order(ndb_models.Folder.key)
+        page, next_cursor, more = query.fetch_page(limit, start_cursor=self.page_cursor(cursor))
+        return page, more and next_cursor and next_cursor.urlsafe().decode() or None
+
+    def page_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            return ndb_models.ndb.Cursor(urlsafe=cursor)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
     def new_folder(self, user_obj, folder_name, public):
         new_fold=ndb_models.Folder(parent=user_obj.key, id=folder_name, isPublic=public)
+        old = new_fold.key.get()
         new_fold.put()
+        if not old:
+            self.count(folders=1)
+        db_cache.folders_cache.invalidate(self.get_id(user_obj))
+        db_cache.remember(new_fold, 'folder', self.get_id(user_obj), folder_name)
+        if old and self.is_public(old) != self.is_public(new_fold):
+            self.reindex_folder(self.get_id(user_obj), folder_name, self.is_public(new_fold))
         return new_fold
 
     def delete_folder(self, folder_obj):
         folder_obj.key.delete()
+        self.count(folders=-1)
+        self.reindex_folder(*self.path(folder_obj), public=False)
+        db_cache.folders_cache.invalidate(folder_obj.key.parent().id())
+        db_cache.forget('folder')
+
+    @db_cache.request_cached_path
+    def resolve_path(self, user, folder=None, program=None):
+        return self.fetch_path_async(user, folder, program).result()
 
-    def programs(self, user, folder):
-        return ndb_models.Program.query(ancestor=ndb_models.ndb.Key("User", user, "Folder", folder))
+    @ndb_models.ndb.tasklet
+    def resolve_path_async(self, user, folder=None, program=None):
+        found = db_cache.remembered_path(user, folder, program)
+        if found is None:
+            found = yield self.fetch_path_async(user, folder, program)
+            db_cache.remember_path(found, user, folder, program)
+        return found
 
+    @ndb_models.ndb.tasklet
+    def fetch_path_async(self, user, folder=None, program=None):
+        """
+        Keys are built from names, so the whole path is fetched in one batch.
+        The program itself may come from the shared cache.
+        """
+        db_program = None
+        if program is not None:
+            db_program = self.pending_program(user, folder, program) or self.cached_program((user, folder, program))
+
+        names = [user] + [n for n in (folder, not db_program and program or None) if n is not None]
+        kinds = ["User", "Folder", "Program"][:len(names)]
+        pairs = []
+        keys = []
+        for kind, name in zip(kinds, names):
+            pairs += [kind, name]
+            keys.append(ndb_models.ndb.Key(*pairs))
+        entities = list((yield ndb_models.ndb.get_multi_async(keys)))
+
+        if db_program:
+            entities.append(entities[-1] and db_program or None)
+        elif len(entities) == 3:
+            self.cache_program(entities[2])
+        return tuple(entities + [None]*(3 - len(entities)))
+
+
+    @db_cache.request_cached('program')
     def program(self, user, folder, program):
-        return ndb_models.ndb.Key("User", user, "Folder", folder, "Program", program).get()
+        path = (user, folder, program)
+        return self.pending_program(*path) or self.cached_program(path) or \
+            self.cache_program(ndb_models.ndb.Key("User", user, "Folder", folder, "Program", program).get())
 
-    def new_program(self, folder_obj, program_name):
-        new_prog=ndb_models.Program(parent=folder_obj.key, id=program_name)
-        new_prog.put()
-        return new_prog
+    def program_summaries(self, user, folder):
+        self.flush_folder(user, folder)
+        return self.cached_summaries(user, folder, lambda: self.load_summaries(user, folder))
 
-    def put_program(self, program_obj):
-        program_obj.put()
+    def load_summaries(self, user, folder):
+        """
+        Names come from a keys-only query, the rest from ProgramSummary entities.
+        Programs saved before (current) summaries existed get theirs written here, once.
+        """
+        folder_key = ndb_models.ndb.Key("User", user, "Folder", folder)
+        names = [k.id() for k in ndb_models.Program.query(ancestor=folder_key).iter(keys_only=True)]
+        summaries = {s.key.id(): s for s in ndb_models.ProgramSummary.query(ancestor=folder_key)}
+        return self.summaries_of(folder_key, names, summaries)
+
+    def summaries_of(self, folder_key, names, summaries):
+        """
+        Listing entries for names, given the ProgramSummary entities found for them (by name).
+        Programs saved before (current) summaries existed get theirs written here, once.
+        """
+        summaries = {name: s for name, s in summaries.items() if s.screenshotHash is not None}
+        missing = [name for name in names if name not in summaries]
+        if missing:
+            programs = ndb_models.ndb.get_multi([ndb_models.ndb.Key("Program", name, parent=folder_key)
+                                                 for name in missing])
+            backfill = [self.summary_of(p) for p in programs if p]
+            ndb_models.ndb.put_multi(backfill)
+            summaries.update((s.key.id(), s) for s in backfill)
+
+        return [{"name": name, "screenshotHash": summaries[name].screenshotHash, "datetime": summaries[name].datetime}
+                for name in names if name in summaries]
+
+    def summaries_page(self, user, folder, limit, cursor=None, order="name"):
+        """
+        Pages are Program keys, or for datetime order a projection on datetime
+        (see index.yaml), so source is never read. The rest comes from the
+        ProgramSummary entities of the page.
+        """
+        self.flush_folder(user, folder)
+        folder_key = ndb_models.ndb.Key("User", user, "Folder", folder)
+        query = ndb_models.Program.query(ancestor=folder_key)
+        start = self.page_cursor(cursor)
+        if order == "datetime":
+            query = query.order(-ndb_models.Program.datetime, ndb_models.Program.key)
+            page, next_cursor, more = query.fetch_page(limit, start_cursor=start,
+                                                       projection=[ndb_models.Program.datetime])
+            keys = [p.key for p in page]
+        else:
+            query = query.order(ndb_models.Program.key)
+            keys, next_cursor, more = query.fetch_page(limit, start_cursor=start, keys_only=True)
+
+        names = [k.id() for k in keys]
+        found = ndb_models.ndb.get_multi([ndb_models.ndb.Key("ProgramSummary", name, parent=folder_key)
+                                          for name in names])
+        summaries = self.summaries_of(folder_key, names, {s.key.id(): s for s in found if s})
+        return summaries, more and next_cursor and next_cursor.urlsafe().decode() or None
+
+    def summary_of(self, program_obj):
+        return ndb_models.ProgramSummary(parent=program_obj.key.parent(), id=program_obj.key.id(),
+                                         screenshotHash=self.screenshot_hash(program_obj),
+                                         datetime=program_obj.datetime)
+
+    def load_screenshots(self, user, folder, programs):
+        keys = [ndb_models.ndb.Key("User", user, "Folder", folder, "Screenshot", name) for name in programs]
+        return {shot.key.id(): self.screenshot_info(shot) for shot in ndb_models.ndb.get_multi(keys) if shot}
+
+    def screenshot_info(self, shot):
+        return {"image": shot.image, "mimetype": shot.mimetype, "hash": screenshot_hash(shot.image),
+                "datetime": shot.datetime}
+
+    def put_screenshot(self, program_obj, image, mimetype):
+        key = ndb_models.ndb.Key("Screenshot", program_obj.key.id(), parent=program_obj.key.parent())
+        if image:
+            self.screenshot_entity(key, image, mimetype).put()
+        else:
+            key.delete()
+        program_obj.screenshot = None
+        program_obj.screenshotHash = image and screenshot_hash(image) or ""
+
+    def screenshot_entity(self, key, image, mimetype):
+        return ndb_models.Screenshot(key=key, image=image, mimetype=mimetype, datetime=datetime.utcnow())
+
+    def programs_page(self, user, folder, limit, cursor=None):
+        self.flush_folder(user, folder)
+        query = ndb_models.Program.query(ancestor=ndb_models.ndb.Key("User", user, "Folder", folder))
+        start = self.page_cursor(cursor)
+        page, next_cursor, more = query.fetch_page(limit, start_cursor=start)
+        return page, more and next_cursor and next_cursor.urlsafe().decode() or None
+
+    def put_programs(self, folder_obj, items):
+        self.flush_folder(*self.path(folder_obj))
+        existing = ndb_models.ndb.get_multi([ndb_models.ndb.Key("Program", name, parent=folder_obj.key)
+                                             for name, _, _ in items])
+        puts = []
+        deletes = []
+        for name, data, shot in items:
+            new_prog = ndb_models.Program(parent=folder_obj.key, id=name,
+                                          description=data.get("description"), source=data.get("source"),
+                                          datetime=data.get("datetime"),
+                                          screenshotHash=shot and screenshot_hash(shot[0]) or "")
+            puts += [new_prog, self.summary_of(new_prog)]
+            shot_key = ndb_models.ndb.Key("Screenshot", name, parent=folder_obj.key)
+            if shot:
+                puts.append(ndb_models.Screenshot(key=shot_key, image=shot[0], mimetype=shot[1],
+                                                  datetime=datetime.utcnow()))
+            else:
+                deletes.append(shot_key)
+        ndb_models.ndb.put_multi(puts)
+        ndb_models.ndb.delete_multi(deletes)
+        self.count(programs=existing.count(None))
+        self.index_sources({self.path(folder_obj): [(name, data.get("source"), data.get("datetime"))
+                                                    for name, data, _ in items]})
+        for name, _, _ in items:
+            self.uncache_path(*self.path(folder_obj), name)
+        db_cache.forget('program')
+
+    def stream_context(self):
+        return ndb_models.ensure_context()
+
+    def iter_program_sources(self, user, folder):
+        self.flush_folder(user, folder)
+        query = ndb_models.Program.query(ancestor=ndb_models.ndb.Key("User", user, "Folder", folder))
+
+        def generate():
+            with self.stream_context():
+                for p in query.iter(batch_size=ITER_BATCH_SIZE):
+                    yield p.key.id(), p.source
+
+        return generate()
+
+    def exists_programs(self, user, folder):
+        self.flush_folder(user, folder)
+        query = ndb_models.Program.query(ancestor=ndb_models.ndb.Key("User", user, "Folder", folder))
+        return query.get(keys_only=True) is not None
+
+    def write_programs(self, program_objs):
+        ndb_models.ndb.put_multi([e for p in program_objs for e in (p, self.summary_of(p))])
+
+    def stored_datetime(self, program_obj):
+        current = program_obj.key.get(use_cache=False, use_global_cache=False)
+        return current and current.datetime
+
+    def upsert_program(self, folder_obj, program_name, source=None, screenshot=None, dt=None, program_obj=None,
+                       expected=None):
+        """
+        The Program, its ProgramSummary, Screenshot and kept ProgramVersion
+        are one put_multi, or for a conditional save one transaction that
+        reads the program back first. A removed screenshot adds a delete. With
+        a write buffer the program waits in the buffer and the rest is put at once.
+
+        The search index and, for a new program, the counter are updated
+        after that and aren't part of the save: they're other entities, and
+        a failure there is logged rather than failing the save.
+        """
+        with self.buffered_check(program_obj, expected):
+            dt = dt or datetime.now()
+            kept = self.version_to_keep(program_obj, source, dt)
+            if screenshot is not None and self.screenshot_unchanged(program_obj, screenshot):
+                screenshot = None
+            created = program_obj is None
+            if created:
+                program_obj = ndb_models.Program(parent=folder_obj.key, id=program_name, screenshotHash="")
+
+            if source is not None:
+                program_obj.source = source
+            program_obj.description = ""  # description currently not used
+            if source is not None or created:
+                # a new screenshot alone isn't a new version of the program
+                program_obj.datetime = dt
+
+            if screenshot is None and self.has_legacy_screenshot(program_obj):
+                screenshot = self.legacy_screenshot(program_obj) or (b'', None)
+
+            puts = []
+            shot_key = ndb_models.ndb.Key("Screenshot", program_name, parent=folder_obj.key)
+            if screenshot is not None:
+                image, mimetype = screenshot
+                program_obj.screenshot = None
+                program_obj.screenshotHash = image and screenshot_hash(image) or ""
+                if image:
+                    puts.append(self.screenshot_entity(shot_key, image, mimetype))
+            if kept:
+                slot, old_source, old_dt = kept
+                puts.append(ndb_models.ProgramVersion(parent=program_obj.key, id=str(slot),
+                                                      source=old_source, datetime=old_dt))
+            remove_shot = screenshot is not None and not screenshot[0]
+
+            if self.write_buffer:
+                removed = remove_shot and shot_key.delete_async()
+                ndb_models.ndb.put_multi(puts)
+                self.put_program(program_obj)
+                if removed:
+                    removed.result()
+            else:
+                entities = puts + [program_obj, self.summary_of(program_obj)]
+                if expected is None:
+                    removed = remove_shot and shot_key.delete_async()
+                    ndb_models.ndb.put_multi(entities)
+                    if removed:
+                        removed.result()
+                else:
+                    def save():
+                        current = program_obj.key.get()
+                        if not current or current.datetime != expected:
+                            raise ProgramChanged()
+                        ndb_models.ndb.put_multi(entities)
+                        if remove_shot:
+                            shot_key.delete()
+
+                    try:
+                        ndb_models.ndb.transaction(save)
+                    except ProgramChanged:
+                        self.uncache_program(program_obj)
+                        raise
+                self.index_programs([program_obj])
+                self.uncache_program(program_obj)
+        if created:
+            self.count(programs=1)
+        return db_cache.remember(program_obj, 'program', *self.path(program_obj))
+
+    def copy_program(self, program_obj, folder_obj, program_name, move=False):
+        """
+        One transaction (across the two folders' entity groups) whose commit
+        writes the copy, its summary and screenshot, and for a move deletes the
+        original. A move takes the kept versions along, they're children of
+        the program's key so they're copied over to the new one.
+        """
+        ndb = ndb_models.ndb
+        self.flush_program(program_obj)
+        old_key = program_obj.key
+        new_key = ndb.Key("Program", program_name, parent=folder_obj.key)
+
+        def copy():
+            old_prog, old_shot, existing, *old_versions = ndb.get_multi(
+                [old_key, ndb.Key("Screenshot", old_key.id(), parent=old_key.parent()), new_key] +
+                (move and self.version_keys(old_key) or []))
+            if not old_prog or existing:
+                return None
+
+            shot = old_shot and (old_shot.image, old_shot.mimetype) or self.legacy_screenshot(old_prog)
+            new_prog = ndb_models.Program(key=new_key, description="", source=old_prog.source,
+                                          datetime=old_prog.datetime,
+                                          nextVersionSlot=move and old_prog.nextVersionSlot or None,
+                                          screenshotHash=shot and screenshot_hash(shot[0]) or "")
+            puts = [new_prog, self.summary_of(new_prog)]
+            versions = [ndb_models.ProgramVersion(parent=new_key, id=v.key.id(), source=v.source,
+                                                  datetime=v.datetime) for v in old_versions if v]
+            puts += versions
+            written = set(v.key for v in versions)
+            # a deleted program of the same name may have left versions behind
+            deletes = [key for key in self.version_keys(new_key) if key not in written]
+            if move:
+                deletes += self.program_keys(old_key)
+            new_shot_key = ndb.Key("Screenshot", program_name, parent=folder_obj.key)
+            if shot:
+                puts.append(self.screenshot_entity(new_shot_key, *shot))
+            else:
+                deletes.append(new_shot_key)  # in case one was left behind
+            ndb.put_multi(puts)
+            ndb.delete_multi(deletes)
+            return new_prog
+
+        new_prog = ndb.transaction(copy)
+        if new_prog:
+            self.uncache_program(new_prog)
+            self.index_programs([new_prog])
+            if move:
+                self.uncache_program(program_obj)
+                self.unindex_programs([self.path(program_obj)])
+            else:
+                self.count(programs=1)
+        db_cache.forget('program')
+        return new_prog
 
     def delete_program(self, program_obj):
-        program_obj.key.delete()
+        self.flush_program(program_obj)
+        ndb_models.ndb.delete_multi(self.program_keys(program_obj.key))
+        self.count(programs=-1)
+        self.unindex_programs([self.path(program_obj)])
+        self.uncache_program(program_obj)
+        db_cache.forget('program')
+
+    def program_keys(self, program_key):
+        """
+        The keys of a program and the entities kept alongside it.
+        """
+        name, folder_key = program_key.id(), program_key.parent()
+        return [program_key,
+                ndb_models.ndb.Key("ProgramSummary", name, parent=folder_key),
+                ndb_models.ndb.Key("Screenshot", name, parent=folder_key)] + self.version_keys(program_key)
+
+    def version_keys(self, program_key):
+        return [ndb_models.ndb.Key("ProgramVersion", str(slot), parent=program_key) for slot in range(VERSION_HISTORY)]
+
+    def program_versions(self, user, folder, program):
+        program_key = ndb_models.ndb.Key("User", user, "Folder", folder, "Program", program)
+        versions = [v for v in ndb_models.ndb.get_multi(self.version_keys(program_key)) if v]
+        return [{"id": v.key.id(), "datetime": v.datetime}
+                for v in sorted(versions, key=lambda v: v.datetime, reverse=True)]
+
+    def program_version(self, user, folder, program, version_id):
+        v = ndb_models.ndb.Key("User", user, "Folder", folder, "Program", program, "ProgramVersion", version_id).get()
+        return v and {"id": v.key.id(), "datetime": v.datetime, "source": v.source}
 
     def set_datetime(self, obj, dt):
         obj.datetime = dt
 
+    def counter_keys(self, name):
+        return [ndb_models.ndb.Key("CounterShard", "%s-%d" % (name, shard)) for shard in range(COUNTER_SHARDS)]
+
+    def stats(self):
+        """
+        A get_multi of every shard of every counter.
+        """
+        keys = [key for name in COUNTERS for key in self.counter_keys(name)]
+        shards = ndb_models.ndb.get_multi(keys)
+        counters = [shards[i*COUNTER_SHARDS:(i+1)*COUNTER_SHARDS] for i in range(len(COUNTERS))]
+        if not all(any(counter) for counter in counters):
+            return self.recount()
+        return {name: sum(s.count for s in counter if s) for name, counter in zip(COUNTERS, counters)}
+
+    def add_counts(self, **deltas):
+        """
+        One transaction on a random shard of each counter. recount() creates
+        every shard, so a missing one means the counter hasn't been started.
+        """
+        shard = random.randrange(COUNTER_SHARDS)
+        keys = [self.counter_keys(name)[shard] for name in deltas]
+
+        def add():
+            shards = ndb_models.ndb.get_multi(keys)
+            shards = [(s, delta) for s, delta in zip(shards, deltas.values()) if s]
+            for s, delta in shards:
+                s.count += delta
+            if shards:
+                ndb_models.ndb.put_multi([s for s, _ in shards])
+
+        ndb_models.ndb.transaction(add)
+
+    def recount(self):
+        totals = {"users": ndb_models.User.query().count(),
+                  "folders": ndb_models.Folder.query().count(),
+                  "programs": ndb_models.Program.query().count()}
+        shards = []
+        for name in COUNTERS:
+            for shard, key in enumerate(self.counter_keys(name)):
+                shards.append(ndb_models.CounterShard(key=key, count=shard == 0 and totals[name] or 0))
+        ndb_models.ndb.put_multi(shards)
+        return totals
+
+    def search_token_key(self, token, entry_id):
+        return ndb_models.ndb.Key("SearchToken", "%s %s" % (token, entry_id))
+
+    def index_search(self, entries):
+        """
+        A program's SearchEntry says what it was indexed under before, so only
+        the SearchTokens whose score changed are written.
+        """
+        ndb = ndb_models.ndb
+        keys = [ndb.Key("SearchEntry", search_index.path_id(path)) for path, _, _ in entries]
+        puts = []
+        deletes = []
+        for key, old, (path, source, dt) in zip(keys, ndb.get_multi(keys), entries):
+            tokens = search_index.program_tokens(path[2], source)
+            old_tokens = old and old.tokens or {}
+            puts += [ndb_models.SearchToken(key=self.search_token_key(token, key.id()), token=token, score=score)
+                     for token, score in tokens.items() if old_tokens.get(token) != score]
+            deletes += [self.search_token_key(token, key.id()) for token in old_tokens if token not in tokens]
+            puts.append(ndb_models.SearchEntry(key=key, tokens=tokens, folder=search_index.path_id(path[:2]),
+                                               datetime=dt))
+        ndb.put_multi(puts)
+        ndb.delete_multi(deletes)
+
+    def delete_search_entries(self, entries):
+        ndb_models.ndb.delete_multi([self.search_token_key(token, e.key.id()) for e in entries for token in e.tokens or {}] +
+                                    [e.key for e in entries])
+
+    def unindex_search(self, paths):
+        keys = [ndb_models.ndb.Key("SearchEntry", search_index.path_id(path)) for path in paths]
+        self.delete_search_entries([e for e in ndb_models.ndb.get_multi(keys) if e])
+
+    def unindex_search_folder(self, user, folder):
+        query = ndb_models.SearchEntry.query(ndb_models.SearchEntry.folder == search_index.path_id((user, folder)))
+        cursor = None
+        more = True
+        while more:
+            page, cursor, more = query.fetch_page(ITER_BATCH_SIZE, start_cursor=cursor)
+            self.delete_search_entries(page)
+
+    def search(self, tokens, limit, cursor=None):
+        """
+        Candidates are read from the SearchTokens of the first (longest) token
+        in score order, and their SearchEntries say whether they have the other
+        tokens. A page is ranked by the total score of all of the tokens, but
+        the pages follow the first token's score.
+        """
+        ndb = ndb_models.ndb
+        query = ndb_models.SearchToken.query(ndb_models.SearchToken.token == tokens[0]).order(
+            -ndb_models.SearchToken.score, ndb_models.SearchToken.key)
+        start = self.page_cursor(cursor)
+        found = []
+        more = True
+        for _ in range(search_index.MAX_SEARCH_READS):
+            page, start, more = query.fetch_page(limit - len(found), start_cursor=start, keys_only=True)
+            entries = ndb.get_multi([ndb.Key("SearchEntry", key.id().split(" ", 1)[1]) for key in page])
+            found += [e for e in entries if e and all(token in e.tokens for token in tokens)]
+            if len(found) >= limit or not more:
+                break
+        found.sort(key=lambda e: -sum(e.tokens[token] for token in tokens))
+        results = [dict(zip(("user", "folder", "name"), search_index.path_of(e.key.id())), datetime=e.datetime) for e in found]
+        return results, more and start and start.urlsafe().decode() or None
+
+    def view_keys(self, paths):
+        return [ndb_models.ndb.Key("ProgramViews", search_index.path_id(path)) for path in paths]
+
+    def add_views(self, views):
+        """
+        A transaction per 25 programs, the most entity groups one can span.
+        """
+        ndb = ndb_models.ndb
+        items = list(views.items())
+        for start in range(0, len(items), 25):
+            batch = items[start:start + 25]
+            keys = self.view_keys([path for path, _ in batch])
+
+            def add():
+                counters = [c or ndb_models.ProgramViews(key=key) for c, key in zip(ndb.get_multi(keys), keys)]
+                for counter, (_, n) in zip(counters, batch):
+                    counter.views += n
+                ndb.put_multi(counters)
+
+            ndb.transaction(add)
+
+    def most_viewed(self, limit):
+        counters = ndb_models.ProgramViews.query().order(-ndb_models.ProgramViews.views).fetch(limit)
+        return [(search_index.path_of(c.key.id()), c.views) for c in counters]
+
+    def delete_views(self, paths):
+        ndb_models.ndb.delete_multi(self.view_keys(paths))
+
+    def recent_programs(self, limit):
+        entries = ndb_models.SearchEntry.query().order(-ndb_models.SearchEntry.datetime).fetch(limit)
+        return [(search_index.path_of(e.key.id()), e.datetime) for e in entries]
+
+    def indexed_programs(self, paths):
+        keys = [ndb_models.ndb.Key("SearchEntry", search_index.path_id(path)) for path in paths]
+        return {path: e.datetime for path, e in zip(paths, ndb_models.ndb.get_multi(keys)) if e}
+
+    @db_cache.feeds_cache
+    def feed(self, name):
+        feed_obj = ndb_models.ndb.Key("Feed", name).get()
+        return feed_obj and {"programs": feed_obj.programs, "datetime": feed_obj.datetime}
+
+    def put_feeds(self, feeds):
+        ndb_models.ndb.put_multi([ndb_models.Feed(id=name, programs=programs, datetime=datetime.now())
+                                  for name, programs in feeds.items()])
+        for name in feeds:
+            db_cache.feeds_cache.invalidate(name)
+
+    def program_to_data(self, program_obj):
+        return {field: getattr(program_obj, field) for field in PROGRAM_FIELDS}
+
+    def program_from_data(self, path, data):
+        user, folder, program = path
+        key = ndb_models.ndb.Key("User", user, "Folder", folder, "Program", program)
+        return ndb_models.Program(key=key, **{field: data.get(field) for field in PROGRAM_FIELDS})
+
 
 class MONGO_DBGlue(DBGlue):
 
+    supports_transactions = None  # found out on first use, see transaction()
+
     def wrap_app(self, app):
         # init the Mongo client
         self.client =  mongo_models.init_client(MONGO_URL)
@@ -149,9 +1397,25 @@ class MONGO_DBGlue(DBGlue):
     def get_id(self, obj):
         return obj.key
 
+    def path(self, obj):
+        """
+        Documents only store their parent's id, so the glue records the path
+        of every folder and program it hands out (see mongo_models._path).
+        """
+        if isinstance(obj, mongo_models.User):
+            return (obj.key,)
+        return obj._path
+
+    def with_path(self, obj, *names):
+        if obj:
+            obj._path = names
+        return obj
+
     def get_user(self, email):
         return mongo_models.User.find({"email":email}).first_or_none()
 
+    @db_cache.request_cached('user')
+    @db_cache.users_cache
     def get_user_byusername(self, username):
         return mongo_models.User.find({"key":username}).first_or_none()
 
@@ -167,61 +1431,569 @@ class MONGO_DBGlue(DBGlue):
 
         db_my_programs = mongo_models.Folder(parentID=str(db_user.id), key="Private", isPublic=False)
         db_my_programs.insert()
+        self.count(users=1, folders=2)
 
+        db_cache.users_cache.invalidate(user_id)
+        db_cache.folders_cache.invalidate(user_id)
+        db_cache.remember(db_user, 'user', user_id)
+        db_cache.forget('folder')
         return db_user
 
-    def folders(self, user_id):
-        db_user = self.get_user_byusername(user_id)
+    def users_page(self, limit, cursor=None):
+        where = cursor and {"_id": {"$gt": ObjectId(cursor)}} or {}
+        page = mongo_models.User.find(where).sort("+_id").limit(limit).to_list()
+        return page, len(page) == limit and str(page[-1].id) or None
+
+    def put_users(self, user_objs):
+        writes = [pymongo.ReplaceOne({"_id": u.id}, mongo_models.to_document(u)) for u in user_objs]
+        if writes:
+            mongo_models.User.get_motor_collection().bulk_write(writes, ordered=False)
+        for user_obj in user_objs:
+            db_cache.users_cache.invalidate(self.get_id(user_obj))
+        db_cache.forget('user')
+
+    @db_cache.request_cached('folder')
+    def folder(self, user_id, folder):
+        db_user, db_folder, _ = self.resolve_path(user_id, folder)
         if not db_user:
             raise Exception("User not found")
-        return mongo_models.Folder.find({"parentID":str(db_user.id)}).to_list()
+        return db_folder
 
-    def folder(self, user_id, folder):
+    def folders_page(self, user_id, limit, cursor=None):
         db_user = self.get_user_byusername(user_id)
         if not db_user:
             raise Exception("User not found")
-        return mongo_models.Folder.find({"parentID":str(db_user.id), "key":folder}).first_or_none()
+        where = {"parentID":str(db_user.id)}
+        if cursor:
+            where["key"] = {"$gt": decode_cursor(cursor, 1)[0]}
+        page = mongo_models.Folder.find(where).sort("+key").limit(limit).to_list()
+        page = [self.with_path(f, user_id, f.key) for f in page]
+        return page, len(page) == limit and encode_cursor(page[-1].key) or None
 
     def new_folder(self, user_obj, folder_name, public):
-        new_fold=mongo_models.Folder(parentID=str(user_obj.id), key=folder_name, isPublic=public)
-        new_fold.insert()
+        # an existing folder keeps its _id, which its programs refer to
+        where = {"parentID":str(user_obj.id), "key":folder_name}
+        new_id = ObjectId()
+        old = mongo_models.Folder.get_motor_collection().find_one_and_update(
+            where, {"$set": {"isPublic": public}, "$setOnInsert": {"_id": new_id}},
+            projection={"_id": 1, "isPublic": 1}, upsert=True)
+        new_fold=mongo_models.Folder(id=old and old["_id"] or new_id, isPublic=public, **where)
+        if not old:
+            self.count(folders=1)
+        self.with_path(new_fold, self.get_id(user_obj), folder_name)
+        db_cache.folders_cache.invalidate(self.get_id(user_obj))
+        db_cache.remember(new_fold, 'folder', self.get_id(user_obj), folder_name)
+        if old and (old.get("isPublic") is not False) != self.is_public(new_fold):
+            self.reindex_folder(self.get_id(user_obj), folder_name, self.is_public(new_fold))
         return new_fold
 
     def delete_folder(self, folder_obj):
         folder_obj.delete()
+        self.count(folders=-1)
+        self.reindex_folder(*self.path(folder_obj), public=False)
+        db_cache.folders_cache.invalidate(self.path(folder_obj)[0])
+        db_cache.forget('folder')
+
+    def path_pipeline(self, user_id, folder=None, program=None):
+        """
+        The aggregation resolve_path runs on User. program is left out when it's None.
+        """
+        def child_lookup(model, let_name, key, nested=None):
+            pipeline = [
+                {"$match": {"$expr": {"$eq": ["$parentID", "$$" + let_name]}, "key": key}},
+                {"$limit": 1}]
+            if nested:
+                pipeline.append(nested)
+            return {"$lookup": {
+                "from": model.get_collection_name(),
+                "let": {let_name: {"$toString": "$_id"}},
+                "pipeline": pipeline,
+                "as": "children"}}
+
+        pipeline = [{"$match": {"key": user_id}}, {"$limit": 1}]
+        if folder is not None:
+            nested = None
+            if program is not None:
+                nested = child_lookup(mongo_models.Program, "folderID", program)
+            pipeline.append(child_lookup(mongo_models.Folder, "userID", folder, nested))
+        return pipeline
+
+    @db_cache.request_cached_path
+    def resolve_path(self, user_id, folder=None, program=None):
+        """
+        Children point at their parent by the parent's id, so walking the path
+        with find() costs one round trip per level. Instead run one aggregation
+        on User that $lookup's the folder, and inside it the program.
+        The program itself may come from the shared cache.
+        """
+        db_program = None
+        if program is not None:
+            db_program = self.pending_program(user_id, folder, program) or self.cached_program((user_id, folder, program))
+
+        pipeline = self.path_pipeline(user_id, folder, not db_program and program or None)
+        docs = list(mongo_models.User.get_motor_collection().aggregate(pipeline))
+
+        names = (user_id, folder, program)
+        result = []
+        models = [mongo_models.User, mongo_models.Folder, mongo_models.Program]
+        while docs and len(result) < 3:
+            doc = docs[0]
+            docs = doc.pop("children", [])
+            entity = models[len(result)].parse_obj(doc)
+            if result:
+                self.with_path(entity, *names[:len(result)+1])
+            result.append(entity)
+
+        if db_program:
+            if len(result) == 2:
+                result.append(db_program)
+        elif len(result) == 3:
+            self.cache_program(result[2])
+        return tuple(result + [None]*(3 - len(result)))
+
+    @db_cache.request_cached('program')
+    def program(self, user_id, folder, program):
+        db_user, db_folder, db_program = self.resolve_path(user_id, folder, program)
+        if not db_user:
+            raise Exception("User not found")
+        if not db_folder:
+            raise Exception("Folder not found")
+        return db_program
 
-    def programs(self, user_id, folder):
+    def program_summaries(self, user_id, folder):
         db_folder = self.folder(user_id, folder)
         if not db_folder:
             raise Exception("Folder not found")
-        return mongo_models.Program.find({"parentID":str(db_folder.id)}).to_list()
+        self.flush_folder(user_id, folder)
 
-    def program(self, user_id, folder, program):
+        def load():
+            query = mongo_models.Program.find({"parentID":str(db_folder.id)}).project(mongo_models.ProgramSummary)
+            return [{"name": s.key, "screenshotHash": self.screenshot_hash(s), "datetime": s.date_time}
+                    for s in query.to_list()]
+
+        return self.cached_summaries(user_id, folder, load)
+
+    def load_screenshots(self, user_id, folder, programs):
+        _, db_folder, _ = self.resolve_path(user_id, folder)
+        if not db_folder:
+            return {}  # like NDB, an unknown user or folder has no screenshots
+        shots = mongo_models.Screenshot.find({"parentID":str(db_folder.id), "key":{"$in":list(programs)}})
+        return {shot.key: {"image": shot.image, "mimetype": shot.mimetype,
+                           "hash": screenshot_hash(shot.image), "datetime": shot.date_time}
+                for shot in shots.to_list()}
+
+    def put_screenshot(self, program_obj, image, mimetype):
+        self.write_screenshot({"parentID":program_obj.parentID, "key":program_obj.key}, image, mimetype)
+        program_obj.screenshot = None
+        program_obj.screenshotHash = image and screenshot_hash(image) or ""
+
+    def write_screenshot(self, where, image, mimetype, session=None):
+        collection = mongo_models.Screenshot.get_motor_collection()
+        if image:
+            collection.replace_one(where, dict(where, image=image, mimetype=mimetype, date_time=datetime.utcnow()),
+                                   upsert=True, session=session)
+        else:
+            collection.delete_one(where, session=session)
+
+    def programs_page(self, user_id, folder, limit, cursor=None):
+        """
+        Pages are ranges of name, so each page is a scan of the (parentID, key)
+        index from where the last one stopped.
+        """
         db_folder = self.folder(user_id, folder)
         if not db_folder:
             raise Exception("Folder not found")
-        return mongo_models.Program.find({"parentID":str(db_folder.id), "key":program}).first_or_none()
+        self.flush_folder(user_id, folder)
+        where = {"parentID":str(db_folder.id)}
+        if cursor:
+            where["key"] = {"$gt": decode_cursor(cursor, 1)[0]}
+        page = mongo_models.Program.find(where).sort("+key").limit(limit).to_list()
+        page = [self.with_path(p, user_id, folder, p.key) for p in page]
+        return page, len(page) == limit and encode_cursor(page[-1].key) or None
 
-    def new_program(self, folder_obj, program_name):
-        new_prog=mongo_models.Program(parentID=str(folder_obj.id), key=program_name)
-        new_prog.insert()
+    def summaries_page(self, user_id, folder, limit, cursor=None, order="name"):
+        """
+        Pages are ranges of name, or of (datetime, name), starting after the
+        last entry of the previous page.
+        """
+        db_folder = self.folder(user_id, folder)
+        if not db_folder:
+            raise Exception("Folder not found")
+        self.flush_folder(user_id, folder)
+        where = {"parentID":str(db_folder.id)}
+        if order == "datetime":
+            sort = ["-date_time", "+key"]
+            if cursor:
+                dt, key = decode_cursor(cursor, 2)
+                dt = datetime.fromisoformat(dt)
+                where["$or"] = [{"date_time": {"$lt": dt}}, {"date_time": dt, "key": {"$gt": key}}]
+        else:
+            sort = ["+key"]
+            if cursor:
+                where["key"] = {"$gt": decode_cursor(cursor, 1)[0]}
+        page = mongo_models.Program.find(where).sort(*sort).limit(limit).project(mongo_models.ProgramSummary).to_list()
+
+        next_cursor = None
+        if len(page) == limit:
+            last = page[-1]
+            next_cursor = order == "datetime" and encode_cursor(last.date_time, last.key) or encode_cursor(last.key)
+        return [{"name": s.key, "screenshotHash": self.screenshot_hash(s), "datetime": s.date_time}
+                for s in page], next_cursor
+
+    def put_programs(self, folder_obj, items):
+        self.flush_folder(*self.path(folder_obj))
+        program_writes = []
+        screenshot_writes = []
+        for name, data, shot in items:
+            where = {"parentID":str(folder_obj.id), "key":name}
+            new_prog = mongo_models.Program(parentID=str(folder_obj.id), key=name,
+                                            description=data.get("description"), source=data.get("source"),
+                                            date_time=data.get("datetime") or datetime.now(),
+                                            screenshotHash=shot and screenshot_hash(shot[0]) or "")
+            program_writes.append(pymongo.ReplaceOne(where, mongo_models.to_document(new_prog), upsert=True))
+            if shot:
+                screenshot_writes.append(pymongo.ReplaceOne(
+                    where, dict(where, image=shot[0], mimetype=shot[1], date_time=datetime.utcnow()), upsert=True))
+            else:
+                screenshot_writes.append(pymongo.DeleteOne(where))
+        if program_writes:
+            result = mongo_models.Program.get_motor_collection().bulk_write(program_writes, ordered=False)
+            self.count(programs=result.upserted_count)
+            mongo_models.Screenshot.get_motor_collection().bulk_write(screenshot_writes, ordered=False)
+            self.index_sources({self.path(folder_obj): [(name, data.get("source"), data.get("datetime"))
+                                                        for name, data, _ in items]})
+        for name, _, _ in items:
+            self.uncache_path(*self.path(folder_obj), name)
+        db_cache.forget('program')
+
+    def stream_context(self):
+        return contextlib.nullcontext()
+
+    def iter_program_sources(self, user_id, folder):
+        db_folder = self.folder(user_id, folder)
+        if not db_folder:
+            raise Exception("Folder not found")
+        self.flush_folder(user_id, folder)
+        collection = mongo_models.Program.get_motor_collection()
+        cursor = collection.find({"parentID":str(db_folder.id)}, {"key": 1, "source": 1},
+                                 batch_size=ITER_BATCH_SIZE)
+        return ((p["key"], mongo_models.decompress_text(p.get("source"))) for p in cursor)
+
+    def exists_programs(self, user_id, folder):
+        db_folder = self.folder(user_id, folder)
+        if not db_folder:
+            raise Exception("Folder not found")
+        self.flush_folder(user_id, folder)
+        collection = mongo_models.Program.get_motor_collection()
+        return collection.find_one({"parentID":str(db_folder.id)}, {"_id": 1}) is not None
+
+    def program_versions(self, user_id, folder, program):
+        db_folder = self.folder(user_id, folder)
+        if not db_folder:
+            raise Exception("Folder not found")
+        versions = mongo_models.ProgramVersion.get_motor_collection().find(
+            {"parentID":str(db_folder.id), "key":program}, {"slot": 1, "date_time": 1}).sort("date_time", -1)
+        return [{"id": str(v["slot"]), "datetime": v["date_time"]} for v in versions]
+
+    def program_version(self, user_id, folder, program, version_id):
+        db_folder = self.folder(user_id, folder)
+        if not db_folder or not version_id.isdigit():
+            return None
+        v = mongo_models.ProgramVersion.get_motor_collection().find_one(
+            {"parentID":str(db_folder.id), "key":program, "slot":int(version_id)})
+        return v and {"id": version_id, "datetime": v["date_time"], "source": mongo_models.decompress_text(v.get("source"))}
+
+    def transaction(self, callback):
+        """
+        Run callback(session) in a session transaction. Transactions need a
+        replica set or mongos; against a standalone server (as in development)
+        callback is run with no session instead.
+        """
+        if self.supports_transactions is None:
+            try:
+                hello = self.client.admin.command('hello')
+                MONGO_DBGlue.supports_transactions = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+            except pymongo.errors.PyMongoError:
+                MONGO_DBGlue.supports_transactions = False
+            if not self.supports_transactions:
+                print("MongoDB server doesn't support transactions, running without them")
+
+        if not self.supports_transactions:
+            return callback(None)
+        with self.client.start_session() as session:
+            return session.with_transaction(callback)
+
+    def upsert_program(self, folder_obj, program_name, source=None, screenshot=None, dt=None, program_obj=None,
+                       expected=None):
+        """
+        The program is written by put_program as an upsert on its name, so a
+        program that's created concurrently elsewhere isn't inserted twice.
+        A conditional save is instead an update whose filter has the expected
+        date_time, written first, and nothing else is written if it matches
+        nothing. It's one transaction with the version and screenshot writes
+        where the server supports them.
+        """
+        with self.buffered_check(program_obj, expected):
+            where = {"parentID":str(folder_obj.id), "key":program_name}
+            dt = dt or datetime.now()
+
+            kept = self.version_to_keep(program_obj, source, dt)
+            if screenshot is not None and self.screenshot_unchanged(program_obj, screenshot):
+                screenshot = None
+            if screenshot is None and self.has_legacy_screenshot(program_obj):
+                screenshot = self.legacy_screenshot(program_obj) or (b'', None)
+            created = program_obj is None
+            if created:
+                program_obj = self.with_path(mongo_models.Program(screenshotHash="", **where),
+                                             *self.path(folder_obj), program_name)
+            if source is not None:
+                program_obj.source = source
+            program_obj.description = ""
+            if source is not None or created:
+                # a new screenshot alone isn't a new version of the program
+                program_obj.date_time = dt
+            if screenshot is not None:
+                program_obj.screenshot = None
+                program_obj.screenshotHash = screenshot[0] and screenshot_hash(screenshot[0]) or ""
+
+            def save(session):
+                if expected is not None and not self.write_buffer:
+                    result = mongo_models.Program.get_motor_collection().update_one(
+                        dict(where, date_time=expected),
+                        {"$set": mongo_models.to_document(program_obj, exclude={"parentID", "key"})}, session=session)
+                    if not result.matched_count:
+                        raise ProgramChanged()
+                if kept:
+                    slot, old_source, old_dt = kept
+                    version = mongo_models.ProgramVersion(slot=slot, source=old_source, date_time=old_dt, **where)
+                    mongo_models.ProgramVersion.get_motor_collection().replace_one(
+                        dict(where, slot=slot), mongo_models.to_document(version), upsert=True, session=session)
+                if screenshot is not None:
+                    self.write_screenshot(where, *screenshot, session=session)
+
+            if expected is None or self.write_buffer:
+                save(None)
+                self.put_program(program_obj)
+            else:
+                try:
+                    self.transaction(save)
+                except ProgramChanged:
+                    self.uncache_program(program_obj)
+                    raise
+                self.index_programs([program_obj])
+                self.uncache_program(program_obj)
+        if created:
+            self.count(programs=1)
+        return db_cache.remember(program_obj, 'program', *self.path(program_obj))
+
+    def copy_program(self, program_obj, folder_obj, program_name, move=False):
+        """
+        A move is a single update that re-parents the document (and its
+        screenshot and kept versions) in place, a copy a single insert.
+        """
+        self.flush_program(program_obj)
+        programs = mongo_models.Program.get_motor_collection()
+        screenshots = mongo_models.Screenshot.get_motor_collection()
+        versions = mongo_models.ProgramVersion.get_motor_collection()
+        where_old = {"parentID": program_obj.parentID, "key": program_obj.key}
+        where_new = {"parentID": str(folder_obj.id), "key": program_name}
+
+        def copy(session):
+            old = programs.find_one(where_old, session=session)
+            if not old or programs.find_one(where_new, {"_id": 1}, session=session):
+                return None
+            old_shot = screenshots.find_one(where_old, session=session)
+            shot = old_shot and (old_shot["image"], old_shot["mimetype"]) or \
+                self.legacy_screenshot(mongo_models.Program.parse_obj(old))
+
+            new_prog = mongo_models.Program(id=old["_id"], description="", source=old.get("source"),
+                                            date_time=old["date_time"], screenshot=None,
+                                            screenshotHash=shot and screenshot_hash(shot[0]) or "",
+                                            **where_new)
+            if move:
+                new_prog.nextVersionSlot = old.get("nextVersionSlot") or 0
+            fields = mongo_models.to_document(new_prog)
+            # in case a deleted program of the same name left these behind
+            screenshots.delete_one(where_new, session=session)
+            versions.delete_many(where_new, session=session)
+            if move:
+                programs.update_one({"_id": old["_id"]}, {"$set": fields}, session=session)
+                versions.update_many(where_old, {"$set": where_new}, session=session)
+            else:
+                new_prog.id = programs.insert_one(fields, session=session).inserted_id
+            if shot and move and old_shot:
+                screenshots.update_one({"_id": old_shot["_id"]}, {"$set": where_new}, session=session)
+            elif shot:
+                screenshots.insert_one(dict(where_new, image=shot[0], mimetype=shot[1],
+                                            date_time=datetime.utcnow()), session=session)
+            return new_prog
+
+        new_prog = self.transaction(copy)
+        if new_prog:
+            self.with_path(new_prog, *self.path(folder_obj), program_name)
+            self.uncache_program(new_prog)
+            self.index_programs([new_prog])
+            if move:
+                self.uncache_program(program_obj)
+                self.unindex_programs([self.path(program_obj)])
+            else:
+                self.count(programs=1)
+        db_cache.forget('program')
         return new_prog
 
-    def put_program(self, program_obj):
-        program_obj.save()
+    def write_programs(self, program_objs):
+        """
+        Upserts on (parentID, key), new programs get the _id they were inserted with.
+        """
+        writes = [pymongo.UpdateOne({"parentID": p.parentID, "key": p.key},
+                                    {"$set": mongo_models.to_document(p, exclude={"parentID", "key"})}, upsert=True)
+                  for p in program_objs]
+        if not writes:
+            return
+        result = mongo_models.Program.get_motor_collection().bulk_write(writes, ordered=False)
+        for i, _id in result.upserted_ids.items():
+            program_objs[i].id = _id
+
+    def stored_datetime(self, program_obj):
+        current = mongo_models.Program.get_motor_collection().find_one(
+            {"parentID": program_obj.parentID, "key": program_obj.key}, {"date_time": 1})
+        return current and current["date_time"]
 
     def delete_program(self, program_obj):
+        self.flush_program(program_obj)
         program_obj.delete()
+        where = {"parentID":program_obj.parentID, "key":program_obj.key}
+        mongo_models.Screenshot.get_motor_collection().delete_one(where)
+        mongo_models.ProgramVersion.get_motor_collection().delete_many(where)
+        self.count(programs=-1)
+        self.unindex_programs([self.path(program_obj)])
+        self.uncache_program(program_obj)
+        db_cache.forget('program')
 
     def set_datetime(self, obj, dt):
         obj.date_time = dt
 
+    def stats(self):
+        counters = mongo_models.Counter.get_motor_collection().find({"key": {"$in": list(COUNTERS)}})
+        totals = {c["key"]: c["value"] for c in counters}
+        if len(totals) < len(COUNTERS):
+            return self.recount()
+        return totals
+
+    def add_counts(self, **deltas):
+        writes = [pymongo.UpdateOne({"key": name}, {"$inc": {"value": delta}})
+                  for name, delta in deltas.items() if delta]
+        if writes:
+            mongo_models.Counter.get_motor_collection().bulk_write(writes, ordered=False)
+
+    def recount(self):
+        totals = {"users": mongo_models.User.get_motor_collection().count_documents({}),
+                  "folders": mongo_models.Folder.get_motor_collection().count_documents({}),
+                  "programs": mongo_models.Program.get_motor_collection().count_documents({})}
+        mongo_models.Counter.get_motor_collection().bulk_write(
+            [pymongo.UpdateOne({"key": name}, {"$set": {"value": n}}, upsert=True) for name, n in totals.items()])
+        return totals
+
+    def index_search(self, entries):
+        """
+        One SearchDocument per program, replaced whole.
+        """
+        writes = []
+        for path, source, dt in entries:
+            uses = search_index.source_uses(source)
+            doc = mongo_models.SearchDocument(key=search_index.path_id(path), folder=search_index.path_id(path[:2]),
+                                              name=" ".join(search_index.name_words(path[2])),
+                                              text=" ".join(" ".join([w]*n) for w, n in uses.items()),
+                                              date_time=dt)
+            writes.append(pymongo.ReplaceOne({"key": doc.key}, mongo_models.to_document(doc), upsert=True))
+        if writes:
+            mongo_models.SearchDocument.get_motor_collection().bulk_write(writes, ordered=False)
+
+    def unindex_search(self, paths):
+        mongo_models.SearchDocument.get_motor_collection().delete_many(
+            {"key": {"$in": [search_index.path_id(path) for path in paths]}})
+
+    def unindex_search_folder(self, user, folder):
+        mongo_models.SearchDocument.get_motor_collection().delete_many({"folder": search_index.path_id((user, folder))})
+
+    def search(self, tokens, limit, cursor=None):
+        """
+        A $text search with every token quoted, so they're all required, ranked
+        by textScore. Pages are offsets into the ranking, up to search_index.MAX_RESULTS.
+        """
+        offset = cursor and int(decode_cursor(cursor, 1)[0]) or 0
+        if not 0 <= offset < search_index.MAX_RESULTS:
+            raise ValueError("Invalid cursor")
+        score = {"$meta": "textScore"}
+        docs = mongo_models.SearchDocument.get_motor_collection().find(
+            {"$text": {"$search": " ".join('"%s"' % token for token in tokens)}},
+            {"key": 1, "date_time": 1, "score": score}).sort([("score", score)]).skip(offset).limit(limit)
+        results = [dict(zip(("user", "folder", "name"), search_index.path_of(d["key"])), datetime=d.get("date_time")) for d in docs]
+        offset += len(results)
+        more = len(results) == limit and offset < search_index.MAX_RESULTS
+        return results, more and encode_cursor(str(offset)) or None
+
+    def add_views(self, views):
+        writes = [pymongo.UpdateOne({"key": search_index.path_id(path)}, {"$inc": {"views": n}}, upsert=True)
+                  for path, n in views.items()]
+        if writes:
+            mongo_models.ProgramViews.get_motor_collection().bulk_write(writes, ordered=False)
+
+    def most_viewed(self, limit):
+        counters = mongo_models.ProgramViews.get_motor_collection().find().sort("views", -1).limit(limit)
+        return [(search_index.path_of(c["key"]), c["views"]) for c in counters]
+
+    def delete_views(self, paths):
+        mongo_models.ProgramViews.get_motor_collection().delete_many(
+            {"key": {"$in": [search_index.path_id(path) for path in paths]}})
+
+    def recent_programs(self, limit):
+        docs = mongo_models.SearchDocument.get_motor_collection().find(
+            {}, {"key": 1, "date_time": 1}).sort("date_time", -1).limit(limit)
+        return [(search_index.path_of(d["key"]), d.get("date_time")) for d in docs]
+
+    def indexed_programs(self, paths):
+        docs = mongo_models.SearchDocument.get_motor_collection().find(
+            {"key": {"$in": [search_index.path_id(path) for path in paths]}}, {"key": 1, "date_time": 1})
+        return {search_index.path_of(d["key"]): d.get("date_time") for d in docs}
+
+    @db_cache.feeds_cache
+    def feed(self, name):
+        doc = mongo_models.Feed.get_motor_collection().find_one({"key": name})
+        return doc and {"programs": doc["programs"], "datetime": doc.get("date_time")}
+
+    def put_feeds(self, feeds):
+        writes = [pymongo.ReplaceOne({"key": name}, mongo_models.to_document(
+                      mongo_models.Feed(key=name, programs=programs, date_time=datetime.now())), upsert=True)
+                  for name, programs in feeds.items()]
+        mongo_models.Feed.get_motor_collection().bulk_write(writes, ordered=False)
+        for name in feeds:
+            db_cache.feeds_cache.invalidate(name)
+
+    def program_to_data(self, program_obj):
+        data = {field: getattr(program_obj, field) for field in PROGRAM_FIELDS}
+        # needed to rebuild a document that can be saved or deleted again
+        data.update(id=program_obj.id, parentID=program_obj.parentID)
+        return data
+
+    def program_from_data(self, path, data):
+        program_obj = mongo_models.Program(
+            id=data.get("id"), parentID=data.get("parentID"), key=path[2],
+            description=data.get("description"), source=data.get("source"),
+            screenshot=data.get("screenshot"), screenshotHash=data.get("screenshotHash"),
+            date_time=data.get("datetime"), nextVersionSlot=data.get("nextVersionSlot") or 0)
+        return self.with_path(program_obj, *path)
+
 def setupDB():
     """ If MONGO_URL is set, use MongoDB, otherwise use NDB """
-    if MONGO_URL:
-        return MONGO_DBGlue()
-    else:
-        return NDB_DBGlue()
+    glue = MONGO_URL and MONGO_DBGlue() or NDB_DBGlue()
+    if write_buffer.WRITE_BEHIND_DELAY > 0:
+        glue.write_buffer = write_buffer.WriteBuffer(glue.write_pending, glue.stream_context)
+    if gallery.VIEW_FLUSH_INTERVAL > 0:
+        glue.view_counter = gallery.ViewCounter(glue.add_views, glue.stream_context)
+    if gallery.GALLERY_REFRESH > 0:
+        glue.feed_refresher = gallery.FeedRefresher(glue.refresh_feeds, glue.stream_context)
+    return glue
 
 
 db = setupDB()
@@ -0,0 +1,147 @@
+#
+# Public program gallery: the "recent" and "popular" feeds.
+#
+# Neither can be read cheaply from Program, whose public flag is on the
+# parent Folder, so both are precomputed:
+#
+#   recent   the most recently saved programs in the search index, which
+#            already holds exactly the programs in public folders
+#   popular  the programs with the most views, as counted below
+#
+# DBGlue.refresh_feeds stores each feed as a single document (a Feed), which
+# /api/gallery/<feed> reads through a process cache. They're meant to be
+# recomputed in one place, by "flask refresh-gallery" run on a schedule
+# (cron). A feed that was never stored is computed by the first request
+# for it. Setting GALLERY_REFRESH instead has every server process recompute
+# them that often in a FeedRefresher thread, which suits a single instance.
+#
+# With VIEW_FLUSH_INTERVAL set, views of public programs by anyone but their
+# owner are counted in memory by ViewCounter and added to the datastore every
+# VIEW_FLUSH_INTERVAL seconds, one batch for all the programs viewed
+# meanwhile. Views counted since the last flush are lost if the process
+# crashes, which a popularity ranking can afford. Without it no views are
+# counted and the popular feed stays empty.
+#
+# Both are off by default, and neither thread starts until a request needs
+# it, so flask commands never run them.
+#
+
+import atexit
+import os
+import random
+import threading
+import time
+
+GALLERY_SIZE = int(os.environ.get('GALLERY_SIZE', 50))
+GALLERY_REFRESH = float(os.environ.get('GALLERY_REFRESH', 0))
+VIEW_FLUSH_INTERVAL = float(os.environ.get('VIEW_FLUSH_INTERVAL', 0))
+
+FEEDS = ("recent", "popular")
+
+# views per add() call
+VIEW_BATCH_SIZE = 100
+
+
+class ViewCounter:
+    """
+    Views by path (user, folder, program), added to the datastore by
+    add({path: views}) every interval seconds. add runs inside context().
+    The thread starts with the first view.
+    """
+
+    def __init__(self, add, context, interval=VIEW_FLUSH_INTERVAL):
+        self.add = add
+        self.context = context
+        self.interval = interval
+        self.pending = {}  # path -> views not yet added
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.views = 0
+        self.writes = 0
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name='view-counter', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def view(self, path):
+        self.start()
+        with self.lock:
+            self.pending[path] = self.pending.get(path, 0) + 1
+            self.views += 1
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        items = list(pending.items())
+        for start in range(0, len(items), VIEW_BATCH_SIZE):
+            batch = dict(items[start:start + VIEW_BATCH_SIZE])
+            try:
+                with self.context():
+                    self.add(batch)
+            except Exception as e:
+                print("view count flush failed, will retry:", e)
+                self.requeue(items[start:])
+                return
+            with self.lock:
+                self.writes += len(batch)
+
+    def requeue(self, items):
+        with self.lock:
+            for path, views in items:
+                self.pending[path] = self.pending.get(path, 0) + views
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.flush()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {"pending": len(self.pending), "views": self.views, "writes": self.writes,
+                    "interval": self.interval}
+
+
+class FeedRefresher:
+    """
+    Calls refresh() inside context() every interval seconds once start()ed.
+    The first call is a random part of the interval in, so instances started
+    together don't all refresh at once.
+    """
+
+    def __init__(self, refresh, context, interval=GALLERY_REFRESH):
+        self.refresh = refresh
+        self.context = context
+        self.interval = interval
+        self.refreshes = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name='feed-refresher', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        delay = random.uniform(0, self.interval)
+        while True:
+            time.sleep(delay)
+            delay = self.interval
+            try:
+                with self.context():
+                    self.refresh()
+                self.refreshes += 1
+            except Exception as e:
+                print("gallery refresh failed:", e)
@@ -195,7 +195,8 @@ $(function () {
             }
         })
     }
-    function apiPut(route, data, callback) {
+    function apiPut(route, data, callback, onRejected) {
+        // onRejected, if given, handles a save the server turned down (a stale or invalid patch)
         var url = apiURL(route)
         $.ajax({
             type: 'PUT',
@@ -205,7 +206,10 @@ $(function () {
             dataType: 'text',  // actually nothing?
             success: callback,
             error: function (xhr, message, exc) {
-                apiError("API " + message + " saving " + url + ": " + exc)
+                if (onRejected && (xhr.status == 409 || xhr.status == 400))
+                    onRejected()
+                else
+                    apiError("API " + message + " saving " + url + ": " + exc)
             }
         })
     }
@@ -269,7 +273,21 @@ $(function () {
         if (folderList) callback(folderList)
         apiGet({user:username, folder:LIST}, function (nfl) { folderList = nfl; callback(nfl); })
     }
-    function saver(uri, getProgramSource, setStatus) {
+    function sourcePatch(before, after) {
+        // The edit that turns before into after, as the [[offset, length, text]] patch the server takes
+        var start = 0
+        while (start < before.length && start < after.length && before[start] === after[start]) start++
+        var end = 0
+        while (end < before.length - start && end < after.length - start &&
+               before[before.length - 1 - end] === after[after.length - 1 - end]) end++
+        // don't split a surrogate pair (e.g. an emoji) between kept and replaced text
+        if (start > 0 && /[\ud800-\udbff]/.test(before[start - 1])) start--
+        if (end > 0 && /[\udc00-\udfff]/.test(before[before.length - end])) end--
+        return [[start, before.length - start - end, after.substring(start, after.length - end)]]
+    }
+    function saver(uri, getProgramSource, setStatus, version) {
+        // version is the server's version (ETag) of the program as loaded. While it's
+        // known, saves only send the edit since the last save rather than the whole source.
         var saveTimeout = null
         var saving = false
         var savingSource = getProgramSource()
@@ -280,21 +298,29 @@ $(function () {
             if (saveTimeout) { clearTimeout(saveTimeout); saveTimeout = null; }
             if (saving) return
             saving = true
+            var savedSource = savingSource
             savingSource = getProgramSource()
             var save = { 
                 source: savingSource
                 //description: ""  // not currently used
             }
+            if (version) save = { base: version, patch: sourcePatch(savedSource, savingSource) }
 
             // description is not currently used
             //var descriptionCommentMatch = savingSource.match(/^(?:GlowScript.*\r?\n|#.*\r?\n|\r?\n)*\/\*([^\x00]*?)\*\//)
             //if (descriptionCommentMatch) save.description = descriptionCommentMatch[1]
 
             setStatus("Saving...")
-            apiPut(uri, save, saved)
+            apiPut(uri, save, saved, function () {
+                // the program was changed elsewhere (or the patch was bad), so send all of it
+                version = null
+                apiPut(uri, { source: savingSource }, saved)
+            })
         }
 
-        function saved() {
+        function saved(data, status, xhr) {
+            var etag = xhr && xhr.getResponseHeader('ETag')
+            version = etag ? etag.replace(/^W\/|"/g, '') : null
             saving = false
             // If there's been another change, do another delayed save
             if (getProgramSource() !== savingSource)
@@ -1631,7 +1657,8 @@ $(function () {
 	            if (isWritable) {
 	                var save = saver( {user:username, folder:folder, program:program},
 	                    function () { return editor.getValue() },
-	                    function (status) { page.find(".program-status").text(" ("+status+")") }
+	                    function (status) { page.find(".program-status").text(" ("+status+")") },
+	                    progData.version
 	                )
 	                // Save immediately when navigating away from this page
 	                onNavigate.on(function (cb) { save(0, cb) })
@@ -1664,7 +1691,8 @@ $(function () {
                         },
                         function (status) { 
                             page.find(".program-status").text(" ("+status+")") 
-                        }
+                        },
+                        progData.version
                     )
                     // Save immediately when navigating away from this page
                     onNavigate.on(function (cb) { save(0, cb) })
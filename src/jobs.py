@@ -0,0 +1,133 @@
+#
+# Building blocks for long running jobs over a whole datastore (migrations,
+# maintenance), which are run as flask CLI commands, see commands.py.
+#
+# A job walks a query a page at a time with a datastore cursor and hands the
+# items of each page to a pool of worker threads. The next page is read while
+# the workers are busy with the current one. Once every item of a page is
+# done, the cursor after it is saved to a checkpoint file, so an interrupted
+# job picks up where it stopped instead of starting over. Work on an item must
+# therefore be safe to repeat: a page that was cut short is run again.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Checkpoint:
+    """
+    The cursor of the next page to run and the counts so far, kept in a small JSON file.
+    With no path nothing is saved and every run starts from the beginning.
+    """
+
+    def __init__(self, path=None, restart=False):
+        self.path = path
+        if path and restart and os.path.exists(path):
+            os.remove(path)
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                return json.load(f)
+        return {"cursor": None, "counts": {}, "finished": False}
+
+    def save(self, cursor, counts, finished=False):
+        if not self.path:
+            return
+        # write and rename, so a job killed mid-write leaves the previous checkpoint intact
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({"cursor": cursor, "counts": counts, "finished": finished}, f)
+        os.replace(tmp, self.path)
+
+
+class Progress:
+    """
+    Thread safe counters with a periodic throughput report, on stderr so it
+    doesn't mix with what a job prints.
+    """
+
+    def __init__(self, name, counts=None, every=10.0):
+        self.name = name
+        self.counts = dict(counts or {})
+        self.start_counts = dict(self.counts)
+        self.every = every
+        self.lock = threading.Lock()
+        self.started = self.reported = time.monotonic()
+
+    def resume(self, counts):
+        """
+        Carry on from the counts of an earlier run, only this run counts towards the rates.
+        """
+        with self.lock:
+            self.counts = dict(counts)
+            self.start_counts = dict(counts)
+
+    def add(self, **counts):
+        with self.lock:
+            for name, n in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.reported < self.every:
+            return
+        self.reported = now
+        elapsed = max(now - self.started, 1e-6)
+        with self.lock:
+            rates = ["%s=%d (%.1f/s)" % (name, n, (n - self.start_counts.get(name, 0))/elapsed)
+                     for name, n in sorted(self.counts.items())]
+        print("%s: %s, %.0fs" % (self.name, ", ".join(rates) or "nothing yet", elapsed), file=sys.stderr)
+
+
+def run_pages(fetch_page, work, checkpoint, progress, workers=8, batch_size=None,
+              context=contextlib.nullcontext):
+    """
+    Run work(item) on a pool of threads for every item of every page. With a
+    batch_size, work is given lists of up to batch_size items instead, so it
+    can write them back with a single batched call.
+
+    fetch_page(cursor) returns (items, next_cursor), with next_cursor None after
+    the last page. Both are called inside context() (e.g. DBGlue.stream_context),
+    on the calling thread and on every worker respectively.
+
+    An exception from work stops the job without saving the checkpoint past
+    the page it happened in.
+    """
+    state = checkpoint.load()
+    if state.get("finished"):
+        print("%s: already finished, nothing to do" % progress.name, file=sys.stderr)
+        return progress
+    progress.resume(state.get("counts") or {})
+
+    def run(item):
+        with context():
+            work(item)
+
+    with ThreadPoolExecutor(workers) as pool:
+        with context():
+            items, next_cursor = fetch_page(state.get("cursor"))
+        while True:
+            if batch_size:
+                items = [items[i:i+batch_size] for i in range(0, len(items), batch_size)]
+            futures = [pool.submit(run, item) for item in items]
+            upcoming = None
+            if next_cursor:
+                with context():
+                    upcoming = fetch_page(next_cursor)
+            for future in futures:
+                future.result()
+
+            checkpoint.save(next_cursor, progress.counts, finished=not next_cursor)
+            progress.report()
+            if not next_cursor:
+                break
+            items, next_cursor = upcoming
+
+    progress.report(force=True)
+    return progress
@@ -13,38 +13,29 @@ def NewUser(**kwargs):
 def UpdateUsers(**kwargs):
     """
     Find users like the one created in "NewUser" and add an email at the User level.
-    """
 
-    count = 0
-    modCount = 0
-    for c in kwargs['User'].query():
-        count += 1
-        if (count % 100) == 0:
-            print("Checking user: ", c.key.id(), " count = ", count)
-            
-        if not c.email:
-            if c.gaeUser:
-                modCount += 1
-                c.email = c.gaeUser.email().lower()
-                c.put()
-                if (modCount % 100) == 0:
-                    print("Modified 100 more users: ", c.key.id(), " modCount = ", modCount, "email=", c.email)
-        elif c.gaeUser:
-            if c.email != c.email.lower():
-                modCount += 1
-                c.email = c.email.lower()
-                c.put()
-                if (modCount % 100) == 0:
-                    print("Modified 100 more users: ", c.key.id(), " modCount = ", modCount, "email=", c.email)
+    This is now the "flask update-users" job, which is much faster on a big datastore.
+    """
+    from .commands import run_job, update_users
+    from .db_translate import db
+    run_job('update-users', db, lambda cursor: db.users_page(100, cursor), update_users, batch_size=50)
 
 
 def DumpSettings(**kwargs):
-    for s in kwargs['Setting'].query():
-        print (s)
+    """
+    Now "flask dump-settings".
+    """
+    from .commands import run_job, dump
+    from .db_translate import db
+    run_job('dump-settings', db, lambda cursor: db.settings_page(500, cursor), dump, workers=1, batch_size=50)
 
 def DumpUsers(**kwargs):
-    for s in kwargs['User'].query():
-        print (s)
+    """
+    Now "flask dump-users".
+    """
+    from .commands import run_job, dump
+    from .db_translate import db
+    run_job('dump-users', db, lambda cursor: db.users_page(500, cursor), dump, workers=1, batch_size=50)
 
 
 def SetSetting(name, value, **kwargs):
@@ -1,23 +1,66 @@
 
 from datetime import datetime
+import zlib
 from bunnet import Document, Indexed, init_bunnet, TimeSeriesConfig
 
-from pydantic import Field
+from bson import Binary
+from pydantic import BaseModel, Field, PrivateAttr, validator
 from typing import Optional
 
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+from . import search_index
 
 def init_client(MONGO_URL):
     # Wrap the app in middleware.
     client =  MongoClient(MONGO_URL)
-    init_bunnet(database=client.gldb, document_models=[User, Folder, Program])
+    init_bunnet(database=client.gldb, document_models=[User, Folder, Program, Screenshot, ProgramVersion, Counter, SearchDocument,
+                                                          ProgramViews, Feed])
+    for model, name, error in ensure_indexes():
+        print("Can't create index %s on %s, see flask mongo-indexes: %s" % (name, model.__name__, error))
     return client
 
+#
+# Program source is stored zlib compressed, as binary. The models hold it as
+# plain text: documents are decompressed as they're parsed, and written with
+# to_document. Documents saved before are plain strings, which read as they are.
+#
+
+COMPRESSED_FIELDS = ("source",)
+
+
+def compress_text(text):
+    if text is None:
+        return None
+    return Binary(zlib.compress(text.encode('utf-8')))
+
+
+def decompress_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    try:
+        return zlib.decompress(value).decode('utf-8')
+    except zlib.error:
+        return bytes(value).decode('utf-8')
+
+
+def to_document(model_obj, exclude=()):
+    """
+    A model as the raw document that's stored, for writes that bypass bunnet.
+    """
+    doc = model_obj.dict(exclude={"id", "revision_id", *exclude})
+    for field in COMPRESSED_FIELDS:
+        if field in doc and isinstance(model_obj, (Program, ProgramVersion)):
+            doc[field] = compress_text(doc[field])
+    return doc
+
+
 class User(Document):
     """A single user of the IDE"""
     # No parent
-    # key is the user's unique name
-    key: Indexed(str)
+    # key is the user's unique name, with a unique index (see INDEXES)
+    key: str
     joinDate: datetime = Field(default_factory=datetime.now)
     email: Indexed(str)
     secret: str
@@ -31,21 +74,31 @@ class Folder (Document):
     """A collection of programs created by a user"""
     # Parent is a User
     # key is the folder's name (unique for a user)
-    parentID: Indexed(str)
-    key: Indexed(str)
+    parentID: str
+    key: str
     isPublic: bool
 
+    # (user, folder) names, filled in by MONGO_DBGlue since only parentID is stored
+    _path: Optional[tuple] = PrivateAttr(default=None)
+
 
 class Program (Document):
     """A single program"""
     # Parent is a Folder
     # key is the program's name (unique for a folder)
-    parentID: Indexed(str)
-    key: Indexed(str)
+    parentID: str
+    key: str
     description: Optional[str] = None
     source: Optional[str] = None
-    screenshot: Optional[bytes] = None
+    screenshot: Optional[bytes] = None  # legacy inline data URL, new screenshots are in Screenshot
+    screenshotHash: Optional[str] = None  # "" if there's no Screenshot, None for legacy programs
     date_time: datetime = Field(default_factory=datetime.now)
+    nextVersionSlot: int = 0  # the ProgramVersion slot to overwrite next
+
+    # (user, folder, program) names, filled in by MONGO_DBGlue since only parentID is stored
+    _path: Optional[tuple] = PrivateAttr(default=None)
+
+    _decompress_source = validator("source", pre=True, allow_reuse=True)(decompress_text)
 
     @property
     def datetime(self):
@@ -55,3 +108,136 @@ class Program (Document):
     def datetime(self, value):
         self.date_time = value
 
+
+
+class ProgramSummary (BaseModel):
+    """What a folder listing shows about a program, used as a projection so source is never read"""
+    key: str
+    screenshot: Optional[bytes] = None  # only set for legacy programs
+    screenshotHash: Optional[str] = None
+    date_time: Optional[datetime] = None
+
+
+class Screenshot (Document):
+    """A program's screenshot as a decoded image, served by its own endpoint"""
+    # Parent is a Folder
+    # key is the program's name, the same as the Program it belongs to
+    parentID: str
+    key: str
+    image: bytes
+    mimetype: str
+    date_time: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ProgramVersion (Document):
+    """An earlier version of a program, see DBGlue.version_to_keep"""
+    # Parent is a Folder
+    # key is the program's name, slot the version's place in the program's ring of VERSION_HISTORY versions
+    parentID: str
+    key: str
+    slot: int
+    source: Optional[str] = None
+    date_time: datetime
+
+    _decompress_source = validator("source", pre=True, allow_reuse=True)(decompress_text)
+
+
+class Counter (Document):
+    """A running total, see MONGO_DBGlue.stats"""
+    # No parent
+    # key is the counter's name
+    key: str
+    value: int = 0
+
+
+class SearchDocument (Document):
+    """A public program as the search text index sees it, see search_index.py"""
+    # No parent
+    # key is "<user>/<folder>/<program>"
+    key: str
+    folder: str  # "<user>/<folder>", to drop a folder from the index
+    name: str  # words of the program's name
+    text: str  # the most used identifiers of its source, each repeated up to search_index.MAX_USES times
+    date_time: Optional[datetime] = None  # the program's, for the gallery's recent feed
+
+
+class ProgramViews (Document):
+    """How often a public program has been viewed, see gallery.py"""
+    # No parent
+    # key is "<user>/<folder>/<program>"
+    key: str
+    views: int = 0
+
+
+class Feed (Document):
+    """A precomputed gallery feed, see gallery.py"""
+    # No parent
+    # key is the feed's name
+    key: str
+    programs: list = []  # [{"user", "folder", "name", "datetime", "views"}]
+    date_time: Optional[datetime] = None  # when it was computed
+
+
+#
+# Indexes other than bunnet's single field Indexed() ones. Every lookup by
+# name is on (parentID, key), and the unique indexes also stop two requests
+# racing to create the same user, folder or program. They start with
+# parentID, so they serve the lookups by parentID alone as well.
+#
+# They're created at startup when they're missing, but a unique index can't
+# be built while there are duplicates, and an existing index by the same name
+# with other options isn't replaced. "flask mongo-indexes" reports and repairs both.
+#
+
+def unique_name_index(*fields):
+    return IndexModel([(field, ASCENDING) for field in fields], name="_".join(fields) + "_unique", unique=True)
+
+
+INDEXES = {
+    User: [IndexModel([("key", ASCENDING)], name="key_1", unique=True)],  # replaces a plain Indexed(str) one
+    Folder: [unique_name_index("parentID", "key")],
+    Program: [unique_name_index("parentID", "key"),
+              IndexModel([("parentID", ASCENDING), ("date_time", DESCENDING), ("key", ASCENDING)],
+                         name="parentID_date_time_key")],  # listings by datetime, see MONGO_DBGlue.summaries_page
+    Screenshot: [unique_name_index("parentID", "key")],
+    ProgramVersion: [unique_name_index("parentID", "key", "slot")],
+    Counter: [IndexModel([("key", ASCENDING)], name="key_1", unique=True)],
+    SearchDocument: [IndexModel([("key", ASCENDING)], name="key_1", unique=True),
+                     IndexModel([("folder", ASCENDING)], name="folder_1"),
+                     IndexModel([("date_time", DESCENDING)], name="date_time_-1"),
+                     # code isn't English, so no stemming or stop words
+                     IndexModel([("name", TEXT), ("text", TEXT)], name="search_text", default_language="none",
+                                weights={"name": search_index.NAME_WEIGHT, "text": 1})],
+    ProgramViews: [IndexModel([("key", ASCENDING)], name="key_1", unique=True),
+                   IndexModel([("views", DESCENDING)], name="views_-1")],
+    Feed: [IndexModel([("key", ASCENDING)], name="key_1", unique=True)],
+}
+
+# Single field indexes that earlier Indexed() fields created, which the
+# INDEXES above make redundant. "flask mongo-indexes --repair" drops them.
+OBSOLETE_INDEXES = {
+    Folder: ["parentID_1", "key_1"],
+    Program: ["parentID_1", "key_1"],
+    Screenshot: ["parentID_1", "key_1"],
+    ProgramVersion: ["parentID_1", "key_1"],
+}
+
+
+def ensure_indexes():
+    """
+    Create the INDEXES that don't exist yet. Returns (model, index name, error)
+    for each one that couldn't be.
+    """
+    problems = []
+    for model, indexes in INDEXES.items():
+        collection = model.get_motor_collection()
+        existing = collection.index_information()
+        for index in indexes:
+            name = index.document["name"]
+            if name in existing:
+                continue
+            try:
+                collection.create_indexes([index])
+            except OperationFailure as e:
+                problems.append((model, name, str(e)))
+    return problems
@@ -1,9 +1,15 @@
 
 from google.cloud import ndb
+import contextlib
 import os
+import zlib
+
+from .db_cache import SHARED_CACHE_URL, SHARED_CACHE_TTL
 
 emulator = os.environ.get('DATASTORE_EMULATOR_HOST')
 
+client_state = {}  # the ndb.Client and its context options, set up by ndb_wsgi_middleware
+
 
 def ndb_wsgi_middleware(wsgi_app):
     """
@@ -20,6 +26,18 @@ def ndb_wsgi_middleware(wsgi_app):
     # for user data, folders, and programs
     client = ndb.Client(project=project)
 
+    # With a Redis shared cache configured, let NDB use it as its global cache too,
+    # so entity lookups by key are shared between instances. Like db_cache.RedisCache
+    # it mustn't fail writes when Redis is down: strict_write=False only logs a failed
+    # cache invalidation, and entities are cached for SHARED_CACHE_TTL so one that
+    # missed its invalidation is stale for that long at most.
+    global_cache = None
+    if SHARED_CACHE_URL and SHARED_CACHE_URL.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+        global_cache = ndb.RedisCache(redis.Redis.from_url(SHARED_CACHE_URL), strict_write=False)
+
+    client_state.update(client=client, global_cache=global_cache)
+
     def middleware(environ, start_response):
 
         if False and environ.get('REQUEST_METHOD') == 'PUT':
@@ -31,11 +49,30 @@ def ndb_wsgi_middleware(wsgi_app):
             import pdb
             pdb.set_trace()
 
-        with client.context():
+        with client.context(global_cache=global_cache, global_cache_timeout_policy=SHARED_CACHE_TTL):
             return wsgi_app(environ, start_response)
 
     return middleware
 
+
+@contextlib.contextmanager
+def ensure_context():
+    """
+    Run NDB calls outside of the middleware: a streamed response is iterated
+    after the request's context has closed, and CLI commands never had one.
+    An existing context is reused.
+    """
+    if ndb.get_context(False) is not None:
+        yield
+        return
+
+    if 'client' not in client_state:
+        ndb_wsgi_middleware(None)
+
+    with client_state['client'].context(global_cache=client_state['global_cache'],
+                                        global_cache_timeout_policy=SHARED_CACHE_TTL):
+        yield
+
 #
 # Now let's deal with the app
 #
@@ -47,6 +84,31 @@ def wrap_app(app):
     return app
 
 
+class CompressedTextProperty (ndb.BlobProperty):
+    """
+    Text stored zlib compressed. Values are only decompressed when the
+    property is first read, so loading an entity doesn't pay for it.
+
+    ndb.TextProperty(compressed=True) can't read the plain text values written
+    before, this can: they come back from Datastore as str and are used as is.
+    """
+
+    def _validate(self, value):
+        if not isinstance(value, str):
+            raise ndb.exceptions.BadValueError("Expected string, got %r" % (value,))
+
+    def _to_base_type(self, value):
+        return zlib.compress(value.encode('utf-8'))
+
+    def _from_base_type(self, value):
+        if isinstance(value, str):
+            return value
+        try:
+            return zlib.decompress(value).decode('utf-8')
+        except zlib.error:
+            return value.decode('utf-8')  # stored uncompressed as bytes
+
+
 class User (ndb.Model):
     """A single user of the IDE"""
     # No parent
@@ -69,9 +131,76 @@ class Program (ndb.Model):
     # Parent is a Folder
     # key is the program's name (unique for a folder)
     description = ndb.StringProperty()
-    source = ndb.TextProperty()
-    screenshot = ndb.BlobProperty()
+    source = CompressedTextProperty()
+    screenshot = ndb.BlobProperty()  # legacy inline data URL, new screenshots are Screenshot entities
+    screenshotHash = ndb.TextProperty()  # "" if there's no Screenshot, None for legacy programs
     datetime = ndb.DateTimeProperty()  # this is UTC date and time
+    nextVersionSlot = ndb.IntegerProperty(indexed=False)  # the ProgramVersion slot to overwrite next
+
+
+class ProgramSummary (ndb.Model):
+    """What a folder listing shows about a program, kept apart from its source"""
+    # Parent is a Folder
+    # key is the program's name, the same as the Program it summarizes
+    # TextProperty/BlobProperty can't be projected, so this is how a listing avoids loading source
+    screenshotHash = ndb.TextProperty()  # None means written before Screenshot existed
+    datetime = ndb.DateTimeProperty()
+
+
+class Screenshot (ndb.Model):
+    """A program's screenshot as a decoded image, served by its own endpoint"""
+    # Parent is a Folder
+    # key is the program's name, the same as the Program it belongs to
+    image = ndb.BlobProperty()
+    mimetype = ndb.StringProperty()
+    datetime = ndb.DateTimeProperty()  # UTC
+
+
+class ProgramVersion (ndb.Model):
+    """An earlier version of a program, see DBGlue.version_to_keep"""
+    # Parent is the Program
+    # key is the version's slot in the program's ring of VERSION_HISTORY versions
+    source = CompressedTextProperty()
+    datetime = ndb.DateTimeProperty()
+
+
+class CounterShard (ndb.Model):
+    """One shard of a running total, see NDB_DBGlue.stats"""
+    # No parent
+    # key is "<counter>-<shard number>", increments go to a random shard so they rarely contend
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class SearchToken (ndb.Model):
+    """A public program indexed under one token, see search_index.py"""
+    # No parent
+    # key is "<token> <user>/<folder>/<program>"
+    token = ndb.StringProperty()
+    score = ndb.IntegerProperty()
+
+
+class SearchEntry (ndb.Model):
+    """The tokens a public program is indexed under, so a save only writes the ones that changed"""
+    # No parent
+    # key is "<user>/<folder>/<program>"
+    tokens = ndb.JsonProperty()  # {token: score}
+    folder = ndb.StringProperty()  # "<user>/<folder>", to drop a folder from the index
+    datetime = ndb.DateTimeProperty()  # the program's, for the gallery's recent feed
+
+
+class ProgramViews (ndb.Model):
+    """How often a public program has been viewed, see gallery.py"""
+    # No parent
+    # key is "<user>/<folder>/<program>"
+    views = ndb.IntegerProperty(default=0)
+
+
+class Feed (ndb.Model):
+    """A precomputed gallery feed, see gallery.py"""
+    # No parent
+    # key is the feed's name
+    programs = ndb.JsonProperty()  # [{"user", "folder", "name", "datetime", "views"}]
+    datetime = ndb.DateTimeProperty(indexed=False)  # when it was computed
 
 
 class Setting(ndb.Model):
@@ -28,26 +28,30 @@
 # python_version 2.7 works and can be deployed with Google App Engine Launcher 1.7.6
 
 import base64
+import hashlib
 import re
 from . import app, auth
 import os
 from datetime import datetime
 from google.auth.transport import requests
 import urllib.parse
-import functools
-import traceback
 import flask
 import uuid
 import cgi
 import zipfile
-from io import BytesIO
+import io
 import json
+import shutil
+import tempfile
 import requests
 
-from .ndb_models import Folder, User, Program
 from google.cloud import ndb
 
-from .db_translate import db
+from .db_translate import db, decode_data_url, PUT_BATCH_SIZE, ProgramChanged
+from . import db_cache
+from . import search_index
+from . import gallery
+from .static_assets import send_asset, MemoryAsset
 
 localport = '8080'     # normally 8080
 weblocs_safe = ["localhost:"+localport, "127.0.0.1:" +
@@ -68,19 +72,9 @@ unreserved = chrange('A', 'Z') | chrange(
 # Newer ndb:                       https://cloud.google.com/appengine/docs/standard/python/ndb/db_to_n
 
 app = db.wrap_app(app)
+app.teardown_request(db_cache.clear_identity_map)
 
-module_cache = {}  # cache some things, like ide.js, so we don't need to keep reloading them
-
-
-def load_idejs():
-    try:
-        ide_js = open('src/ide.js').read()
-        module_cache['ide.js'] = ide_js
-    except:
-        ide_js = 'Ack! Cannot load ide.js'
-        traceback.print_exc()
-
-    return ide_js
+ide_js = MemoryAsset(os.path.join(app.root_path, 'ide.js'), 'text/javascript')
 
 
 @app.route('/css/<path:filename>')
@@ -88,36 +82,13 @@ def css_static(filename):
     return flask.send_from_directory('../css', filename)
 
 
-def no_cache(view):
-    @functools.wraps(view)
-    def no_cache_impl(*args, **kwargs):
-        response = flask.make_response(view(*args, **kwargs))
-        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '-1'
-        return response
-
-    return functools.update_wrapper(no_cache_impl, view)
-
-
 @app.route('/ide.js')
-@no_cache
 def idejs_static():
     """
-    Load ide.js from the src directory, and cache it in module_cache.
+    ide.js, kept in memory. index.html asks for ide.js?v=<version>, which can be
+    cached for good. In debug mode edits to the file are picked up on the next load.
     """
-    if os.environ.get("FLASK_DEBUG", 0):
-        ide_js = load_idejs()
-    else:
-        ide_js = module_cache
-
-    
-    ide_js = module_cache.get('ide.js')
-
-    if not ide_js:
-        ide_js = load_idejs()
-
-    return flask.Response(ide_js, mimetype='text/javascript')
+    return ide_js.response(flask.request.args.get('v'), reload=app.debug)
 
 
 @app.route('/lib/<path:filename>')
@@ -125,7 +96,7 @@ def lib_static(filename):
     cache_timeout = None
     if is_running_locally():
         cache_timeout = 0
-    return flask.send_from_directory('../lib', filename, max_age=cache_timeout)
+    return send_asset('../lib', filename, max_age=cache_timeout)
 
 
 @app.route('/node_modules/<path:filename>')
@@ -135,7 +106,13 @@ def node_static(filename):
 
 @app.route('/package/<path:filename>')
 def package_static(filename):
-    return flask.send_from_directory('../package', filename)
+    """
+    The versioned compiler and runtime bundles, see static_assets.
+    """
+    cache_timeout = None
+    if is_running_locally():
+        cache_timeout = 0
+    return send_asset('../package', filename, max_age=cache_timeout)
 
 
 @app.route('/docs/<path:filename>')
@@ -160,7 +137,8 @@ def root():
     docs_home_url = os.environ.get('PUBLIC_DOCS_HOME')  # get docs home
     base_url = get_url_root()
     #load_url = loadURL(url)
-    return flask.render_template('index.html', sandbox_url=sandbox_url, docs_home_url=docs_home_url, base_url=base_url, wasm_url=wasm_url)
+    return flask.render_template('index.html', sandbox_url=sandbox_url, docs_home_url=docs_home_url, base_url=base_url, wasm_url=wasm_url,
+                                 idejs_version=ide_js.version(reload=app.debug))
 
 #
 # Here are some utilities for validating names, hosts, and usernames
@@ -278,6 +256,103 @@ def parseUrlPath(theRegexp, numGroups):
     return names, folder_owner, logged_in_email
 
 
+def screenshot_url(user, folder, program, version):
+    """
+    Where the IDE can fetch a program's screenshot, or "" if it has none.
+    The version makes the URL change whenever the image does, so it can be cached for good.
+    """
+    if not version:
+        return ""
+    return '/api/user/%s/folder/%s/program/%s/screenshot?v=%s' % (user, folder, program, version)
+
+
+def version_time(dt):
+    """
+    Mongo keeps datetimes to the millisecond, so that's all a version stamp can rely on.
+    """
+    return dt and dt.isoformat(timespec='milliseconds') or ''
+
+
+def program_etag(db_program):
+    """
+    A program's version is the time its source was saved. Saving just a
+    screenshot leaves it alone, so an editor's patches still apply after a run.
+    """
+    return hashlib.sha1(version_time(db_program.datetime).encode()).hexdigest()
+
+
+def program_get_etag(db_program):
+    """
+    The ETag of a program as read, which also changes with its screenshot.
+    """
+    return hashlib.sha1((program_etag(db_program) + db.screenshot_hash(db_program)).encode()).hexdigest()
+
+
+def folder_etag(summaries, cursor=None):
+    """
+    A folder's version stamp covers every program's name, save time and screenshot
+    (and for a page of it, the cursor of the next page).
+    """
+    stamp = hashlib.sha1()
+    for s in summaries:
+        stamp.update(('%s\0%s\0%s\0' % (s["name"], version_time(s["datetime"]), s["screenshotHash"])).encode())
+    if cursor:
+        stamp.update(cursor.encode())
+    return stamp.hexdigest()
+
+
+LIST_PAGE_SIZE = 100
+MAX_LIST_PAGE_SIZE = 1000
+
+
+def page_args(orders=("name",)):
+    """
+    (limit, cursor, order) from the query string of a listing that's asked for a
+    page at a time, or None if it's asked for whole. Raises ValueError if they don't make sense.
+    """
+    args = flask.request.args
+    if not any(arg in args for arg in ("limit", "cursor", "order")):
+        return None
+    limit = int(args.get("limit", LIST_PAGE_SIZE))
+    order = args.get("order", orders[0])
+    if not 0 < limit <= MAX_LIST_PAGE_SIZE or order not in orders:
+        raise ValueError("Invalid limit or order")
+    return limit, args.get("cursor") or None, order
+
+
+def conditional_response(data, etag, last_modified=None, private=False):
+    """
+    A JSON response that answers If-None-Match/If-Modified-Since with 304 Not Modified.
+    Clients must revalidate every time, which is cheap when nothing changed.
+    """
+    response = flask.jsonify(data)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    return response.make_conditional(flask.request)
+
+
+def apply_patch(source, patch):
+    """
+    Apply a patch from the IDE's saver: a list of [offset, length, text] edits,
+    each replacing length characters at offset in the result of the ones before.
+    Offsets count UTF-16 code units, as JavaScript strings do.
+
+    Raises TypeError/ValueError for a malformed patch.
+    """
+    units = source.encode('utf-16-le')
+    for offset, length, text in patch:
+        if not (isinstance(offset, int) and isinstance(length, int) and isinstance(text, str)):
+            raise TypeError("Invalid edit")
+        if not 0 <= offset <= offset + length <= len(units)//2:
+            raise ValueError("Edit out of range")
+        units = units[:2*offset] + text.encode('utf-16-le') + units[2*(offset + length):]
+    return units.decode('utf-16-le')  # fails if an edit split a surrogate pair
+
+
 def is_running_locally():
     #
     # Just use the environment. Simpler!
@@ -323,10 +398,73 @@ def api_login():
 
 @app.route('/api/user')
 def ApiUsers():
-    N = User.query().count()
+    N = db.stats()["users"]
     return "Nusers = " + str(N)
 
 
+@app.route('/api/stats')
+def ApiStats():
+    """
+    Total users, folders and programs, see DBGlue.stats.
+    """
+    return db.stats()
+
+
+@app.route('/api/stats/cache')
+def ApiCacheStats():
+    """
+    Hit/miss counters for the process wide user and folder caches (see db_cache),
+    and the write-behind buffer's and view counter's counters if there are any.
+    Only for the superusers, as it says something about what's being used.
+    """
+    if not (auth.is_logged_in() and override(auth.get_user_info().get('email'))):
+        return flask.make_response("Unauthorized", 401)
+    stats = db_cache.cache_stats()
+    if db.write_buffer:
+        stats["write_behind"] = db.write_buffer.stats()
+    if db.view_counter:
+        stats["views"] = db.view_counter.stats()
+    return stats
+
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+
+@app.route('/api/search')
+def ApiSearch():
+    """
+    Programs in public folders whose name or source has every word of q, best
+    matches first, see search_index.py. One page (limit, default
+    SEARCH_PAGE_SIZE) at a time, with the cursor of the next page (null after the last one).
+    """
+    args = flask.request.args
+    tokens = search_index.query_tokens(args.get("q", ""))
+    try:
+        limit = int(args.get("limit", SEARCH_PAGE_SIZE))
+        if not 0 < limit <= MAX_SEARCH_PAGE_SIZE:
+            raise ValueError("Invalid limit")
+        results, next_cursor = tokens and db.search(tokens, limit, args.get("cursor") or None) or ([], None)
+    except ValueError:
+        return flask.make_response('Invalid limit or cursor', 400)
+    programs = [{"user": r["user"], "folder": r["folder"], "name": r["name"], "datetime": str(r["datetime"])}
+                for r in results]
+    return {"query": tokens, "programs": programs, "cursor": next_cursor}
+
+
+@app.route('/api/gallery/<feed>')
+def ApiGallery(feed):
+    """
+    A gallery feed of public programs, "recent" or "popular", as it was last
+    computed, see gallery.py.
+    """
+    if feed not in gallery.FEEDS:
+        return flask.make_response('Unknown feed', 404)
+    data = db.gallery_feed(feed)
+    return conditional_response({"feed": feed, "programs": data["programs"], "datetime": str(data["datetime"])},
+                                hashlib.sha1(version_time(data["datetime"]).encode()).hexdigest())
+
+
 @app.route('/api/user/<username>', methods=['GET', 'PUT'])
 def ApiUser(username):
     """
@@ -371,6 +509,9 @@ def ApiUserFolders(username):
     """
     db_user is the existing user object for 'user'
     email is the email address of the logged in user
+
+    With limit and/or cursor in the query string, one page of the folders is
+    returned, along with the cursor of the next page (null after the last one).
     """
 
     try:
@@ -383,9 +524,20 @@ def ApiUserFolders(username):
 
     user = names and names[0] or ''
 
+    try:
+        paging = page_args()
+        next_cursor = None
+        if paging:
+            limit, cursor, _ = paging
+            db_folders, next_cursor = db.folders_page(user, limit, cursor)
+        else:
+            db_folders = db.folders(user)
+    except ValueError:
+        return flask.make_response('Invalid limit or cursor', 400)
+
     folders = []
     publics = []
-    for k in db.folders(user):
+    for k in db_folders:
         # if k.isPublic != None and not k.isPublic and gaeUser != db_user.gaeUser: continue
         if k.isPublic != None and not k.isPublic:  # private folder
             if override(logged_in_email):
@@ -394,6 +546,8 @@ def ApiUserFolders(username):
                 continue
         folders.append(db.get_id(k))
         publics.append(k.isPublic)
+    if paging:
+        return {"user": user, "folders": folders, "publics": publics, "cursor": next_cursor}
     return {"user": user, "folders": folders, "publics": publics}
 
 
@@ -431,11 +585,7 @@ def ApiUserFolder(username, foldername):
         db_folder = db.folder(user, folder)
         if not db_folder:
             return flask.make_response("Not found", 403)
-        program_count = 0
-        for _ in db.programs(user, folder):
-            program_count += 1
-
-        if program_count > 0:
+        if db.exists_programs(user, folder):
             return flask.make_response("There are programs here", 409)
         db.delete_folder(db_folder)
         return {}
@@ -446,6 +596,11 @@ def ApiUserFolder(username, foldername):
 
 @app.route('/api/user/<username>/folder/<foldername>/program/')
 def ApiUserFolderPrograms(username, foldername):
+    """
+    With limit, cursor and/or order ("name" or "datetime", newest first) in the
+    query string, one page of the folder is returned, along with the cursor
+    of the next page (null after the last one).
+    """
     try:
         names, db_user, email = parseUrlPath(
             r'/api/user/([^/]+)/folder/([^/]+)/program/', 2)
@@ -464,15 +619,29 @@ def ApiUserFolderPrograms(username, foldername):
     except:
         pub = True
     if not pub and not override(db_user.email):
-        return {"user": user, "folder": folder,
-                "error": str('The folder "'+user+'/'+folder+'" is a private folder\nto which you do not have access.')}
+        return {"user": username, "folder": folder,
+                "error": str('The folder "'+username+'/'+folder+'" is a private folder\nto which you do not have access.')}
     else:
+        try:
+            paging = page_args(orders=("name", "datetime"))
+            next_cursor = None
+            if paging:
+                limit, cursor, order = paging
+                summaries, next_cursor = db.summaries_page(username, folder, limit, cursor, order)
+            else:
+                summaries = db.program_summaries(username, folder)
+        except ValueError:
+            return flask.make_response('Invalid limit, cursor or order', 400)
         programs = [
-            {"name": db.get_id(p),
-             "screenshot": str(p.screenshot and p.screenshot.decode('utf-8') or ""),
-             "datetime": str(p.datetime)
-             } for p in db.programs(username, folder)]
-        return {"user": username, "folder": folder, "programs": programs}
+            {"name": s["name"],
+             "screenshot": screenshot_url(username, folder, s["name"], s["screenshotHash"]),
+             "datetime": str(s["datetime"])
+             } for s in summaries]
+        private = db_folder is not None and db_folder.isPublic is False
+        data = {"user": username, "folder": folder, "programs": programs}
+        if paging:
+            data["cursor"] = next_cursor
+        return conditional_response(data, folder_etag(summaries, next_cursor), private=private)
 
 
 @app.route('/api/user/<username>/folder/<foldername>/program/<programname>', methods=['GET', 'PUT', 'DELETE'])
@@ -490,7 +659,7 @@ def ApiUserFolderProgram(username, foldername, programname):
     name = program  # for PUT clause
 
     if flask.request.method == 'GET':
-        db_folder = db.folder(user,folder)
+        _, db_folder, db_program = db.resolve_path(user, folder, name)
         try:
             # before March 2015, isPublic wasn't set
             pub = db_folder.isPublic is None or db_folder.isPublic or email == db_user.email
@@ -500,15 +669,20 @@ def ApiUserFolderProgram(username, foldername, programname):
             return {"user": user, "folder": folder, "name": name,
                     "error": str('The program "'+name+'" is in a private folder\nto which you do not have access.')}
         else:
-            db_program = db.program(user, folder, name)
             if not db_program:
                 return {"user": user, "folder": folder, "name": name,
                         "error": str(user+'/'+folder+'/'+name+' does not exist.')}
             else:
-                return {"user": user, "folder": folder, "name": name,
-                        "screenshot": str(db_program.screenshot and db_program.screenshot.decode('utf-8') or ""),
+                private = db_folder is not None and db_folder.isPublic is False
+                if not private and not (db_user and email == db_user.email):
+                    db.count_view(user, folder, name)
+                # no Last-Modified, datetime doesn't change with the screenshot but the ETag does
+                return conditional_response({"user": user, "folder": folder, "name": name,
+                        "screenshot": screenshot_url(user, folder, name, db.screenshot_hash(db_program)),
                         "datetime": str(db_program.datetime),
-                        "source": db_program.source or ''}
+                        "version": program_etag(db_program),
+                        "source": db_program.source or ''},
+                        program_get_etag(db_program), private=private)
 
     elif flask.request.method == 'PUT':
 
@@ -522,24 +696,55 @@ def ApiUserFolderProgram(username, foldername, programname):
         else:
             changes = {}
 
-        db_program = db.program(user, folder, program)
-
-        if not db_program:  # if not db_program already, this is a request to create a new program
-            db_folder = db.folder(user, folder)
-            if not db_folder:
-                return flask.make_response("No such folder", 403)
+        screenshot = None
+        if "screenshot" in changes:
+            try:
+                screenshot = decode_data_url(changes["screenshot"])
+            except ValueError:
+                return flask.make_response("Invalid screenshot", 400)
 
-            db_program = db.new_program(db_folder, program)
+        _, db_folder, db_program = db.resolve_path(user, folder, program)
 
-        if "source" in changes:
-            db_program.source = changes["source"]
-        if "screenshot" in changes:
-            db_program.screenshot = changes["screenshot"].encode('utf-8')
+        # optimistic concurrency: If-Match lets a client refuse to overwrite someone else's save
+        if_match = flask.request.if_match
+        if if_match and not (db_program and (if_match.contains(program_etag(db_program)) or
+                                             if_match.contains(program_get_etag(db_program)))):
+            return flask.make_response("Program has changed", 412)
+        # the version checked here, which the write checks again as it saves
+        expected = if_match and db_program.datetime or None
 
-        db.set_datetime(db_program,datetime.now())
-        db_program.description = ""  # description currently not used
-        db.put_program(db_program)
-        return {}
+        if not db_folder:
+            return flask.make_response("No such folder", 403)
+
+        source = changes.get("source")
+        if "patch" in changes:
+            # an edit of the version the client last saw (its ETag), rather than the whole source
+            if not db_program or changes.get("base") != program_etag(db_program):
+                return flask.make_response("Program has changed", 409)
+            try:
+                source = apply_patch(db_program.source or '', changes["patch"])
+            except (TypeError, ValueError):
+                return flask.make_response("Invalid patch", 400)
+            expected = db_program.datetime
+
+        if db_program and (source is None or source == db_program.source) and \
+                (screenshot is None or db.screenshot_unchanged(db_program, screenshot)):
+            # nothing to save, e.g. an autosave with no edits or the same screenshot again
+            response = flask.make_response({})
+            response.set_etag(program_etag(db_program))
+            return response
+
+        # creates the program if db_program is None, with its contents in the same write
+        try:
+            db_program = db.upsert_program(db_folder, program, source=source, screenshot=screenshot,
+                                           dt=datetime.now(), program_obj=db_program, expected=expected)
+        except ProgramChanged:
+            # another save got in between the checks above and this one
+            return flask.make_response("Program has changed", if_match and 412 or 409)
+
+        response = flask.make_response({})
+        response.set_etag(program_etag(db_program))
+        return response
 
     elif flask.request.method == 'DELETE':
 
@@ -556,6 +761,132 @@ def ApiUserFolderProgram(username, foldername, programname):
         return flask.make_response('Invalid API operation', 400)
 
 
+@app.route('/api/user/<username>/folder/<foldername>/program/<programname>/version/')
+@app.route('/api/user/<username>/folder/<foldername>/program/<programname>/version/<versionid>')
+def ApiUserFolderProgramVersions(username, foldername, programname, versionid=None):
+    """
+    The earlier versions of a program that are kept (see db_translate.VERSION_HISTORY),
+    or with a version id, the source of one of them.
+    """
+    try:
+        names, db_user, email = parseUrlPath(
+            r'/api/user/([^/]+)/folder/([^/]+)/program/([^/]+)/version/([^/]*)', 4)
+    except ParseUrlPathException as pup:
+        errorMsg = pup.args[0]
+        code = pup.args[1]
+        return flask.make_response(errorMsg, code)
+
+    user, folder, name, version = names
+
+    db_folder = db.folder(user, folder)
+    if not db_folder:
+        return flask.make_response('Not found', 404)
+    # before March 2015, isPublic wasn't set
+    pub = db_folder.isPublic is None or db_folder.isPublic
+    if not pub and not (db_user and db_user.email == email) and not override(email):
+        return flask.make_response('Unauthorized', 405)
+
+    if not version:
+        return {"user": user, "folder": folder, "name": name,
+                "versions": [{"id": v["id"], "datetime": str(v["datetime"])}
+                             for v in db.program_versions(user, folder, name)]}
+
+    v = db.program_version(user, folder, name, version)
+    if not v:
+        return flask.make_response('Not found', 404)
+    return {"user": user, "folder": folder, "name": name,
+            "id": v["id"], "datetime": str(v["datetime"]), "source": v["source"] or ''}
+
+
+@app.route('/api/user/<username>/folder/<foldername>/program/<programname>/screenshot')
+def ApiUserFolderProgramScreenshot(username, foldername, programname):
+    """
+    Serve a program's screenshot as an image. Listings link here rather than
+    embedding every screenshot, so the browser (and any CDN) can cache them.
+    """
+    try:
+        names, db_user, email = parseUrlPath(
+            r'/api/user/([^/]+)/folder/([^/]+)/program/([^/]+)/screenshot', 3)
+    except ParseUrlPathException as pup:
+        errorMsg = pup.args[0]
+        code = pup.args[1]
+        return flask.make_response(errorMsg, code)
+
+    user, folder, name = names
+
+    _, db_folder, db_program = db.resolve_path(user, folder, name)
+    try:
+        # before March 2015, isPublic wasn't set
+        pub = db_folder.isPublic is None or db_folder.isPublic
+    except:
+        pub = True
+    if not pub and not (db_user and db_user.email == email) and not override(email):
+        return flask.make_response('Unauthorized', 405)
+
+    shot = db_program and db.screenshot(user, folder, name, db_program)
+    if not shot:
+        return flask.make_response('Not found', 404)
+
+    response = flask.make_response(shot["image"], 200)
+    response.mimetype = shot["mimetype"]
+    response.set_etag(shot["hash"])
+    if shot["datetime"]:
+        response.last_modified = shot["datetime"]
+    if pub:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    if flask.request.args.get('v') == shot["hash"]:
+        # a versioned URL from a listing never changes
+        response.cache_control.max_age = 365*24*3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+def download_source(source):
+    """
+    Returns the source as it should be downloaded, and its file extension.
+    """
+    source = source or ''
+    end = source.find('\n')
+    if source[0:end].find('ython') > -1:  # VPython
+        source = "from vpython import *\n#"+source
+        extension = '.py'
+    elif source[0:end].find('apyd') > -1:  # RapydScript
+        extension = '.py'
+    # CofeeScript (1.1 is the only version)
+    elif source[0:end].find('ofee') > -1:
+        extension = '.cs'
+    else:                    # JavaScript
+        extension = '.js'
+    return source, extension
+
+
+class ZipStream(io.RawIOBase):
+    """
+    A write-only, unseekable file for zipfile. zipfile then writes each entry
+    with a data descriptor instead of seeking back, so the archive can be
+    drained and sent piece by piece.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
 @app.route('/api/user/<username>/folder/<foldername>/program/<programname>/option/<optionname>')
 def ApiUserFolderProgramDownload(username, foldername, programname, optionname):
 
@@ -570,7 +901,7 @@ def ApiUserFolderProgramDownload(username, foldername, programname, optionname):
     user, folder, name, option = names
 
     if option == 'downloadProgram':
-        db_folder = db.folder(user, folder)
+        _, db_folder, db_program = db.resolve_path(user, folder, name)
         try:
             # before March 2015, isPublic wasn't set
             pub = db_folder.isPublic is None or db_folder.isPublic or db_user.email == email
@@ -578,21 +909,9 @@ def ApiUserFolderProgramDownload(username, foldername, programname, optionname):
             pub = True
         if not pub:
             return flask.make_response('Unauthorized', 405)
-        db_program = db.program(user, folder, name)
         if not db_program:
             return flask.make_response('Not found', 404)
-        source = db_program.source
-        end = source.find('\n')
-        if source[0:end].find('ython') > -1:  # VPython
-            source = "from vpython import *\n#"+source
-            extension = '.py'
-        elif source[0:end].find('apyd') > -1:  # RapydScript
-            extension = '.py'
-        # CofeeScript (1.1 is the only version)
-        elif source[0:end].find('ofee') > -1:
-            extension = '.cs'
-        else:                    # JavaScript
-            extension = '.js'
+        source, extension = download_source(db_program.source)
 
         response = flask.make_response(source, 200)
         response.headers['Content-Disposition'] = 'attachment; filename=' + \
@@ -611,31 +930,20 @@ def ApiUserFolderProgramDownload(username, foldername, programname, optionname):
         if not pub:
             return flask.make_response('Unauthorized', 405)
 
-        # https://newseasandbeyond.wordpress.com/2014/01/27/creating-in-memory-zip-file-with-python/
-        buff = BytesIO()
-        za = zipfile.ZipFile(buff, mode='w', compression=zipfile.ZIP_DEFLATED)
-        programs = [
-            {"name": p.key.id(),
-             "source": p.source  # unicode(p.source or unicode())
-             } for p in db.programs(user, folder)]
-        for p in programs:
-            source = p['source']
-            end = source.find('\n')
-            if source[0:end].find('ython') > -1:  # VPython
-                source = "from vpython import *\n#"+source
-                extension = '.py'
-            elif source[0:end].find('apyd') > -1:  # RapydScript
-                extension = '.py'
-            # CofeeScript (1.1 is the only version)
-            elif source[0:end].find('ofee') > -1:
-                extension = '.cs'
-            else:                    # JavaScript
-                extension = '.js'
-
-            za.writestr(p['name']+extension, source)
-        za.close()
-
-        response = flask.make_response(buff.getvalue(), 200)
+        # The archive is written one program at a time and sent as it's built,
+        # so memory use doesn't grow with the size of the folder.
+        sources = db.iter_program_sources(user, folder)
+
+        def generate():
+            stream = ZipStream()
+            with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_DEFLATED) as za:
+                for name, source in sources:
+                    source, extension = download_source(source)
+                    za.writestr(name+extension, source)
+                    yield stream.drain()
+            yield stream.drain()
+
+        response = flask.Response(generate(), 200, mimetype='application/zip')
         response.headers['Content-Disposition'] = 'attachment; filename=' + \
             user+'_'+folder+'.zip'
         return response
@@ -643,6 +951,174 @@ def ApiUserFolderProgramDownload(username, foldername, programname, optionname):
         return flask.make_response('No such option', 404)
 
 
+#
+# Whole account export/import. The archive has a folders.json at the top,
+# {<folder>: {"isPublic"}} for every folder, and a <folder>/<program>.json
+# for every program:
+#
+#   {"name", "description", "source", "datetime" (ISO 8601), "screenshot" (data URL or "")}
+#
+# Names are the URI-escaped names used everywhere else, so they never contain
+# a '/', and folders.json can't be mistaken for a program.
+#
+
+FOLDERS_MANIFEST = 'folders.json'
+
+
+IMPORT_BATCH_SIZE = PUT_BATCH_SIZE
+
+# Limits on what an import unpacks, checked against the sizes in the archive's
+# directory before anything is read. zipfile stops inflating an entry at its
+# recorded file_size, so a small archive can't expand past these.
+IMPORT_MAX_ENTRIES = 20000
+IMPORT_MAX_ENTRY_SIZE = 16*1024*1024
+IMPORT_MAX_SIZE = 1024*1024*1024
+
+
+def export_program(name, data, shot):
+    return json.dumps({
+        "name": name,
+        "description": data.get("description") or "",
+        "source": data.get("source") or "",
+        "datetime": data.get("datetime") and data["datetime"].isoformat() or "",
+        "screenshot": shot and "data:%s;base64,%s" % (shot[1], base64.b64encode(shot[0]).decode('ascii')) or "",
+    })
+
+
+def import_program(raw):
+    """
+    Parse a <program>.json from an export into (data, screenshot) for db.put_programs.
+    """
+    exported = json.loads(raw)
+    image, mimetype = decode_data_url(exported.get("screenshot") or "")
+    dt = exported.get("datetime")
+    data = {"description": exported.get("description") or "", "source": exported.get("source") or "",
+            "datetime": dt and datetime.fromisoformat(dt) or datetime.now()}
+    return data, image and (image, mimetype) or None
+
+
+@app.route('/api/user/<username>/export')
+def ApiUserExport(username):
+    """
+    Stream every folder and program of a user as one ZIP. Programs are read a
+    page at a time, so the archive is never held in memory.
+    """
+    try:
+        names, _, _ = parseUrlPath(r'/api/user/([^/]+)/export', 1)
+    except ParseUrlPathException as pup:
+        errorMsg = pup.args[0]
+        code = pup.args[1]
+        return flask.make_response(errorMsg, code)
+
+    user = names[0]
+    if not authorize_user(user):
+        return flask.make_response("Unauthorized", 401)
+
+    folders = [(db.get_id(f), f.isPublic) for f in db.folders(user)]
+
+    def generate():
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_DEFLATED) as za:
+            za.writestr(FOLDERS_MANIFEST, json.dumps({folder: {"isPublic": public} for folder, public in folders}))
+            for folder, public in folders:
+                for name, data, shot in db.iter_programs(user, folder):
+                    za.writestr(folder + '/' + name + '.json', export_program(name, data, shot))
+                    yield stream.drain()
+        yield stream.drain()
+
+    response = flask.Response(generate(), 200, mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=' + user + '.zip'
+    return response
+
+
+@app.route('/api/user/<username>/import', methods=['PUT'])
+def ApiUserImport(username):
+    """
+    Load an archive from ApiUserExport into a user's account, either as the
+    'archive' file of a form or as the request body. Missing folders are
+    created, programs with the same name are overwritten, and programs are
+    written IMPORT_BATCH_SIZE at a time.
+    """
+    try:
+        names, db_user, _ = parseUrlPath(r'/api/user/([^/]+)/import', 1)
+    except ParseUrlPathException as pup:
+        errorMsg = pup.args[0]
+        code = pup.args[1]
+        return flask.make_response(errorMsg, code)
+
+    user = names[0]
+    if not authorize_user(user):
+        return flask.make_response("Unauthorized", 401)
+
+    archive = flask.request.files.get('archive')
+    if archive is None:
+        # zipfile needs to seek, so spool the body, on disk if it's big
+        archive = tempfile.SpooledTemporaryFile(max_size=16*1024*1024)
+        shutil.copyfileobj(flask.request.stream, archive)
+        archive.seek(0)
+
+    try:
+        za = zipfile.ZipFile(archive)
+    except zipfile.BadZipFile:
+        return flask.make_response('Not a ZIP archive', 400)
+
+    #
+    # Check every entry's size and name before reading or writing anything
+    #
+    infos = za.infolist()
+    if len(infos) > IMPORT_MAX_ENTRIES:
+        return flask.make_response('Too many archive entries, the limit is %d' % IMPORT_MAX_ENTRIES, 413)
+    for info in infos:
+        if info.file_size > IMPORT_MAX_ENTRY_SIZE:
+            return flask.make_response('Archive entry too large: ' + info.filename, 413)
+    if sum(info.file_size for info in infos) > IMPORT_MAX_SIZE:
+        return flask.make_response('Archive too large when unpacked', 413)
+
+    try:
+        manifest = FOLDERS_MANIFEST in za.namelist() and json.loads(za.read(FOLDERS_MANIFEST)) or {}
+        if not isinstance(manifest, dict):
+            raise ValueError("not an object")
+    except ValueError as e:
+        return flask.make_response('Invalid %s: %s' % (FOLDERS_MANIFEST, e), 400)
+    if not validate_names(*manifest):
+        return flask.make_response('Invalid name in ' + FOLDERS_MANIFEST, 400)
+
+    folders = {folder: [] for folder in manifest}
+    for entry in za.namelist():
+        if entry == FOLDERS_MANIFEST:
+            continue
+        folder, sep, filename = entry.partition('/')
+        if not sep or '/' in filename or not filename.endswith('.json'):
+            return flask.make_response('Unexpected archive entry: ' + entry, 400)
+        program = filename[:-len('.json')]
+        if not validate_names(folder, program):
+            return flask.make_response('Invalid name in archive: ' + entry, 400)
+        folders.setdefault(folder, []).append((program, entry))
+
+    counts = {"folders": 0, "programs": 0}
+    with za:
+        for folder, programs in folders.items():
+            db_folder = db.folder(user, folder)
+            if not db_folder:
+                public = (manifest.get(folder) or {}).get("isPublic", True)
+                db_folder = db.new_folder(db_user, folder, public)
+                counts["folders"] += 1
+
+            for start in range(0, len(programs), IMPORT_BATCH_SIZE):
+                items = []
+                for program, entry in programs[start:start + IMPORT_BATCH_SIZE]:
+                    try:
+                        data, shot = import_program(za.read(entry))
+                    except ValueError as e:
+                        return flask.make_response('Invalid program %s: %s (%s imported)' % (
+                            entry, e, counts["programs"]), 400)
+                    items.append((program, data, shot))
+                db.put_programs(db_folder, items)
+                counts["programs"] += len(items)
+
+    return counts
+
+
 @app.route('/api/user/<username>/folder/<foldername>/program/<programname>/option/<optionname>/oldfolder/<oldfoldername>/oldprogram/<oldprogramname>', methods=['PUT'])
 def ApiUserProgramCopy(username, foldername, programname, optionname, oldfoldername, oldprogramname):
 
@@ -657,33 +1133,24 @@ def ApiUserProgramCopy(username, foldername, programname, optionname, oldfoldern
     user, folder, program, option, oldfolder, oldprogram = names
     app.logger.info("user=%s folder=%s program=%s option=%s oldfolder=%s oldprogram=%s" % (user, folder, program, option, oldfolder, oldprogram))
 
-    db_folder = db.folder(user, folder)
+    # the destination and the old program don't depend on each other, so look them up together
+    destination = db.resolve_path_async(user, folder, program)
+    old = db.resolve_path_async(user, oldfolder, oldprogram)
+
+    _, db_folder, db_program = destination.result()
     if not db_folder:
         return flask.make_response('Folder not found', 404)
 
-    db_program = db.program(user, folder, program)
     if db_program:
         return flask.make_response('Destination program name already exists', 409)
 
-    db_folder = db.folder(user, folder)
-    if not db_folder:
-        return flask.make_response('Folder not found', 404)
-
-    db_program = db.new_program(db_folder, program)
-    if not db_program:
-        return flask.make_response('program copy failed', 404)
-
-    db_program_old = db.program(user, oldfolder, oldprogram)
+    _, _, db_program_old = old.result()
     if not db_program_old:
         return flask.make_response('Old program not found', 404)
 
-    db_program.source = db_program_old.source
-    db_program.screenshot = db_program_old.screenshot
-    db.set_datetime(db_program,db_program_old.datetime)
-    db_program.description = ""  # description currently not used
-    db.put_program(db_program)
-
-    if option == 'rename':
-        db.delete_program(db_program_old)
+    # checked again inside the copy's transaction, another save may have happened since
+    db_program = db.copy_program(db_program_old, db_folder, program, move=option == 'rename')
+    if not db_program:
+        return flask.make_response('program copy failed', 409)
 
     return {}
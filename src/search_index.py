@@ -0,0 +1,98 @@
+#
+# Search over the programs in public folders.
+#
+# Every program in a public folder is indexed under the words of its name and
+# the identifiers in its source. The index is kept up to date as programs
+# are written (DBGlue.index_programs), deleted, or their folder changes
+# between public and private, so a search only reads the index:
+#
+#   Mongo  a SearchDocument per program with a text index on its words
+#   NDB    a SearchToken entity per (token, program), queried by token in
+#          score order, and a SearchEntry per program with its tokens
+#
+# Only the MAX_TOKENS highest scoring tokens of a program are indexed, so
+# a save costs the same however big the program is, and on NDB only the
+# tokens whose score changed are written.
+#
+# "flask reindex-search" builds the index from scratch.
+#
+
+import re
+from urllib.parse import unquote
+
+# A token in the name counts as much as NAME_WEIGHT uses in the source
+NAME_WEIGHT = 10
+# Uses in the source beyond this don't make a program a better match
+MAX_USES = 10
+MAX_TOKENS = 100
+MAX_QUERY_TOKENS = 5
+# NDB reads a multi word search's candidates from the first token's matches,
+# at most this many batches of them per page
+MAX_SEARCH_READS = 5
+# Mongo pages by offset, which costs more the further in, so results end here
+MAX_RESULTS = 1000
+
+# Words of every other program, which would only bloat the index
+STOPWORDS = frozenset("""
+    and as def elif else for from glowscript if import in is not or pass return
+    the vpython web while with
+""".split())
+
+IDENTIFIER = re.compile(r'[a-z_][a-z0-9_]+|[0-9]{2,}')
+# the words of BouncingBall, bouncing_ball or Ball3D
+NAME_WORD = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+')
+
+
+def words(text):
+    return [w for w in IDENTIFIER.findall(text.lower()) if w not in STOPWORDS]
+
+
+def name_words(name):
+    """
+    The program's name as a token, and each word in it. name is as stored,
+    URI-escaped, so "Bouncing%20Ball" gives bouncing and ball, not 20.
+    """
+    name = unquote(name)
+    found = words(name) + [w.lower() for w in NAME_WORD.findall(name)]
+    return [w for w in dict.fromkeys(found) if len(w) > 1 and w not in STOPWORDS]
+
+
+def source_uses(source):
+    """
+    {token: uses, up to MAX_USES} of the MAX_TOKENS most used identifiers in source.
+    """
+    uses = {}
+    for word in words(source or ''):
+        uses[word] = uses.get(word, 0) + 1
+    top = sorted(uses, key=lambda w: (-uses[w], w))[:MAX_TOKENS]
+    return {w: min(uses[w], MAX_USES) for w in top}
+
+
+def program_tokens(name, source):
+    """
+    {token: score} a program is indexed under, at most MAX_TOKENS of them.
+    """
+    scores = source_uses(source)
+    for word in name_words(name):
+        scores[word] = scores.get(word, 0) + NAME_WEIGHT
+    top = sorted(scores, key=lambda w: (-scores[w], w))[:MAX_TOKENS]
+    return {w: scores[w] for w in top}
+
+
+def query_tokens(query):
+    """
+    The distinct tokens of a search, longest (and so likely rarest) first.
+    """
+    tokens = list(dict.fromkeys(words(query)))
+    return sorted(tokens, key=lambda t: -len(t))[:MAX_QUERY_TOKENS]
+
+
+def path_id(path):
+    """
+    user/folder/program, names are URI-escaped so they never contain a '/'.
+    """
+    return '/'.join(path)
+
+
+def path_of(path_id):
+    return tuple(path_id.split('/'))
@@ -1,3 +1,4 @@
 # pipe this into "flask shell" to update all users in the datastore
+# (superseded by "flask update-users", which pages, batches and can resume)
 import ide.modDBFunctions
 wc(ide.modDBFunctions.UpdateUsers, User=User)
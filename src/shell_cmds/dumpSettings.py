@@ -1,4 +1,5 @@
 # pipe this into "flask shell" to update all users in the datastore
+# (superseded by "flask dump-settings")
 
 wc(modDBFunctions.DumpSettings, Setting=Setting)
 
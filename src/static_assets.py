@@ -0,0 +1,242 @@
+#
+# Precompressed static assets: /package and /lib from disk, ide.js from memory.
+#
+# The compiler and runtime bundles are megabytes of minified JavaScript, and
+# they dominate a cold page load. The build step writes a gzip (and, if the
+# brotli package is installed, a brotli) copy next to every compressible file:
+#
+#   python src/static_assets.py package lib
+#
+# It's run by the Dockerfile, and doesn't import the app, so it needs no
+# datastore credentials. send_asset then serves the smallest variant the
+# browser accepts, with an ETag made from a hash of the file's contents.
+# Bundles with a version in their name (RScompiler.3.2.min.js) never change,
+# so they're also marked immutable.
+#
+# Without the compressed copies (e.g. when running locally without the build
+# step) files are served as they are.
+#
+# ide.js changes with every deploy and is fetched on every IDE visit, so it's
+# kept in memory instead, see MemoryAsset.
+#
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import threading
+import traceback
+
+import flask
+from werkzeug.security import safe_join
+
+COMPRESSIBLE = ('.js', '.css', '.html', '.json', '.map', '.svg', '.txt', '.xml', '.wasm', '.ttf', '.otf')
+MIN_SIZE = 1024  # below this compression saves next to nothing
+
+# (Content-Encoding, file suffix) in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# name.1.2.min.js, name.3.0.js, ...
+VERSIONED = re.compile(r'\.\d+\.\d+(\.min)?\.(js|css)$')
+IMMUTABLE_MAX_AGE = 365*24*3600
+
+def import_brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+content_hashes = {}  # path -> (mtime, size, hash)
+content_hashes_lock = threading.Lock()
+
+
+def content_hash(path):
+    """
+    A hash of a file's contents, computed once per version of the file.
+    """
+    st = os.stat(path)
+    with content_hashes_lock:
+        cached = content_hashes.get(path)
+    if cached and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    value = digest.hexdigest()[:20]
+    with content_hashes_lock:
+        content_hashes[path] = (st.st_mtime, st.st_size, value)
+    return value
+
+
+def pick_variant(path):
+    """
+    (encoding, path) of the best precompressed copy of path the request
+    accepts, or (None, path). A copy older than the file itself is ignored.
+    """
+    accepted = flask.request.accept_encodings
+    mtime = os.path.getmtime(path)
+    for encoding, suffix in ENCODINGS:
+        variant = path + suffix
+        if accepted[encoding] and os.path.isfile(variant) and os.path.getmtime(variant) >= mtime:
+            return encoding, variant
+    return None, path
+
+
+def send_asset(directory, filename, max_age=None):
+    """
+    Like flask.send_from_directory, but serves a precompressed copy where there
+    is one, and versioned bundles as immutable (unless max_age is given).
+    directory is relative to the app's root_path.
+    """
+    path = safe_join(os.path.join(flask.current_app.root_path, directory), filename)
+    if path is None or not os.path.isfile(path):
+        flask.abort(404)
+
+    encoding, variant = pick_variant(path)
+    etag = content_hash(path) + (encoding and '-' + encoding or '')
+    immutable = max_age is None and VERSIONED.search(filename)
+    if immutable:
+        max_age = IMMUTABLE_MAX_AGE
+
+    response = flask.send_file(variant, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                               etag=etag, max_age=max_age, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+
+class MemoryAsset:
+    """
+    A file served from memory, with its gzip and brotli bodies compressed once
+    when it's loaded. Requested as ?v=<version>, the current version, it's
+    immutable, otherwise browsers revalidate it by ETag. With reload (for
+    development) a changed file is picked up on the next request.
+    """
+
+    def __init__(self, path, mimetype):
+        self.path = path
+        self.mimetype = mimetype
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            traceback.print_exc()
+            mtime, data = None, b'Ack! Cannot load ' + os.path.basename(self.path).encode()
+
+        bodies = {None: data, 'gzip': gzip.compress(data, 9, mtime=0)}
+        brotli = import_brotli()
+        if brotli:
+            bodies['br'] = brotli.compress(data, quality=11)
+        # replaced in one go, so a request never mixes two versions
+        self.state = (hashlib.sha1(data).hexdigest()[:20], bodies, mtime)
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self.state[2]:
+            with self.lock:
+                if mtime != self.state[2]:
+                    self.load()
+
+    def version(self, reload=False):
+        if reload:
+            self.reload_if_changed()
+        return self.state[0]
+
+    def response(self, version=None, reload=False):
+        if reload:
+            self.reload_if_changed()
+        digest, bodies, _ = self.state
+        accepted = flask.request.accept_encodings
+        encoding = next((e for e, _ in ENCODINGS if e in bodies and accepted[e]), None)
+
+        response = flask.Response(bodies[encoding], mimetype=self.mimetype)
+        response.set_etag(digest + (encoding and '-' + encoding or ''))
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        if version == digest and not reload:
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(flask.request)
+
+
+#
+# Build step
+#
+
+def compress_file(path, brotli=None):
+    """
+    Write path.gz (and path.br) unless they're up to date. A copy that doesn't
+    save at least a tenth of the size isn't kept. Returns the bytes saved.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    mtime = os.path.getmtime(path)
+
+    saved = 0
+    compressors = [('.gz', lambda d: gzip.compress(d, 9, mtime=0))]
+    if brotli:
+        compressors.insert(0, ('.br', lambda d: brotli.compress(d, quality=11)))
+    for suffix, compress in compressors:
+        variant = path + suffix
+        if os.path.isfile(variant) and os.path.getmtime(variant) >= mtime:
+            continue
+        packed = compress(data)
+        if len(packed) > 0.9*len(data):
+            if os.path.exists(variant):
+                os.remove(variant)
+            continue
+        # write and rename, so a server never sees half a file
+        with open(variant + '.tmp', 'wb') as f:
+            f.write(packed)
+        os.replace(variant + '.tmp', variant)
+        saved += len(data) - len(packed)
+    return saved
+
+
+def compress_tree(root, brotli=None):
+    nfiles = saved = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not name.endswith(COMPRESSIBLE) or os.path.getsize(path) < MIN_SIZE:
+                continue
+            saved += compress_file(path, brotli)
+            nfiles += 1
+    return nfiles, saved
+
+
+def main(roots):
+    brotli = import_brotli()
+    if not brotli:
+        print("brotli isn't installed, writing gzip copies only", file=sys.stderr)
+
+    for root in roots:
+        nfiles, saved = compress_tree(root, brotli)
+        print("%s: %d files, %.1fMB saved by new copies" % (root, nfiles, saved/1e6), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    main(sys.argv[1:] or [os.path.join(here, 'package'), os.path.join(here, 'lib')])
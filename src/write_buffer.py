@@ -0,0 +1,122 @@
+#
+# Write-behind buffer for program saves.
+#
+# While a class is in session every open IDE autosaves every few seconds.
+# With WRITE_BEHIND_DELAY set, DBGlue.put_program only records the program
+# here and returns. Saves of the same program within the delay replace each
+# other, so only the latest one is written, and a background thread writes
+# whatever is due in batches (put_multi on NDB, bulk_write on Mongo).
+#
+# Reads go through the buffer first (see DBGlue.pending_program), so a user
+# always sees their own saves. Anything that reads programs straight from the
+# datastore (listings, copies, exports) flushes the affected folder first.
+#
+# Pending saves are written at exit, but a crashed process loses up to
+# WRITE_BEHIND_DELAY seconds of them, and other instances don't see them
+# until they're written. That's why it's off by default.
+#
+
+import atexit
+import os
+import threading
+import time
+
+WRITE_BEHIND_DELAY = float(os.environ.get('WRITE_BEHIND_DELAY', 0))
+WRITE_BEHIND_MAX = int(os.environ.get('WRITE_BEHIND_MAX', 1000))
+
+# programs per write_programs call, each one is a couple of entities
+FLUSH_BATCH_SIZE = 100
+
+
+class WriteBuffer:
+    """
+    Pending program saves keyed by path (user, folder, program), written by
+    write(programs) once they're delay seconds old, or sooner if more than
+    max_pending pile up. write runs inside context().
+    """
+
+    def __init__(self, write, context, delay=WRITE_BEHIND_DELAY, max_pending=WRITE_BEHIND_MAX):
+        self.write = write
+        self.context = context
+        self.delay = delay
+        self.max_pending = max_pending
+        self.pending = {}  # path -> (program, time of the first save not yet written)
+        self.inflight = {}  # path -> program, being written right now
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # one flush at a time, so writes of a path stay in order
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.saves = 0
+        self.writes = 0
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, path, program_obj):
+        with self.lock:
+            first = self.pending.get(path, (None, time.monotonic()))[1]
+            self.pending[path] = (program_obj, first)
+            self.saves += 1
+            full = len(self.pending) >= self.max_pending
+        if full or self.closed:
+            self.flush()
+
+    def get(self, path):
+        with self.lock:
+            entry = self.pending.get(path)
+            return entry and entry[0] or self.inflight.get(path)
+
+    def flush(self, match=None, older_than=None):
+        """
+        Write the pending saves whose path satisfies match(path) (all of them
+        by default) and that are at least older_than seconds old.
+        """
+        with self.flush_lock:
+            now = time.monotonic()
+            with self.lock:
+                due = [(path, entry) for path, entry in self.pending.items()
+                       if (match is None or match(path)) and (older_than is None or now - entry[1] >= older_than)]
+                for path, (program_obj, _) in due:
+                    del self.pending[path]
+                    self.inflight[path] = program_obj
+            try:
+                for start in range(0, len(due), FLUSH_BATCH_SIZE):
+                    batch = due[start:start + FLUSH_BATCH_SIZE]
+                    try:
+                        with self.context():
+                            self.write([program_obj for _, (program_obj, _) in batch])
+                    except Exception as e:
+                        print("write-behind flush failed, will retry:", e)
+                        self.requeue(due[start:])
+                        return
+                    self.writes += len(batch)
+            finally:
+                with self.lock:
+                    self.inflight.clear()
+
+    def requeue(self, entries):
+        with self.lock:
+            for path, entry in entries:
+                # a save that came in since is newer, keep that one
+                self.pending.setdefault(path, entry)
+
+    def flush_path(self, path):
+        self.flush(lambda p: p == path)
+
+    def flush_folder(self, user, folder):
+        self.flush(lambda p: p[:2] == (user, folder))
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.delay/2)
+            self.flush(older_than=self.delay)
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {"pending": len(self.pending), "saves": self.saves, "writes": self.writes,
+                    "delay": self.delay}
@@ -0,0 +1,104 @@
+#
+# The app under test runs on the Mongo backend with mongomock standing in for
+# the server, so the tests need neither MongoDB nor Google credentials.
+# mongomock lacks a few server commands the app asks for at startup, those
+# are answered here.
+#
+#   pip install -r requirements.txt pytest mongomock fakeredis
+#   python -m pytest tests
+#
+
+import os
+import sys
+
+import mongomock
+import mongomock.aggregate
+import pymongo
+import pytest
+from mongomock.database import Database
+
+os.environ['MONGO_URL'] = 'mongodb://localhost/glowscript-test'
+os.environ['GLOWSCRIPT_RUNNING_LOCALLY'] = 'true'
+os.environ.setdefault('DATASTORE_EMULATOR_HOST', 'localhost:1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongo_client = mongomock.MongoClient()
+
+_command = Database.command
+
+
+def command(self, cmd, *args, **kwargs):
+    if isinstance(cmd, dict) and 'buildInfo' in cmd:
+        return {'version': '6.0.0', 'versionArray': [6, 0, 0, 0]}
+    if cmd == 'hello':
+        return {'isWritablePrimary': True}  # a standalone server, so no transactions
+    return _command(self, cmd, *args, **kwargs)
+
+
+Database.command = command
+
+_lookup = mongomock.aggregate._handle_lookup_stage
+
+
+def lookup(in_collection, database, options):
+    """
+    $lookup with let and a pipeline, as far as MONGO_DBGlue.path_pipeline
+    uses it: let binds {"$toString": "$field"} and the pipeline $matches an
+    $expr $eq against it.
+    """
+    if 'let' not in options:
+        return _lookup(in_collection, database, options)
+    out = []
+    for doc in in_collection:
+        doc = dict(doc)
+        variables = {name: str(doc[expr['$toString'][1:]]) for name, expr in options['let'].items()}
+        pipeline = []
+        for stage in options['pipeline']:
+            if '$match' in stage:
+                match = dict(stage['$match'])
+                expr = match.pop('$expr', None)
+                if expr:
+                    field, variable = expr['$eq']
+                    match[field[1:]] = variables[variable[2:]]
+                stage = {'$match': match}
+            pipeline.append(stage)
+        doc[options['as']] = list(database[options['from']].aggregate(pipeline))
+        out.append(doc)
+    return out
+
+
+mongomock.aggregate._handle_lookup_stage = lookup
+mongomock.aggregate._PIPELINE_HANDLERS['$lookup'] = lookup
+pymongo.MongoClient = lambda *args, **kwargs: mongo_client
+
+from src import app, db_cache, mongo_models  # noqa: E402  (after the patches above)
+from src.db_translate import db  # noqa: E402
+
+
+def empty(database):
+    for name in database.list_collection_names():
+        database[name].delete_many({})
+    for cache in db_cache.process_caches.values():
+        cache.clear()
+
+
+@pytest.fixture
+def mongo():
+    """
+    An empty database (and process caches), emptied again after the test.
+    """
+    database = mongo_models.User.get_motor_collection().database
+    empty(database)
+    yield database
+    empty(database)
+
+
+@pytest.fixture
+def client(mongo):
+    """
+    A test client for the app and the CSRF header of bob, a new user. Running
+    locally everyone is logged in as the same local user.
+    """
+    test_client = app.test_client()
+    test_client.put('/api/user/bob')
+    return test_client, {'X-CSRF-Token': db.get_user_byusername('bob').secret}
@@ -0,0 +1,75 @@
+import json
+import time
+
+import pytest
+
+from src.routes import apply_patch
+
+PROGRAM = '/api/user/bob/folder/MyPrograms/program/p'
+
+
+def test_edits_apply_in_order():
+    assert apply_patch("hello world", [[6, 5, "there"], [0, 0, ">> "]]) == ">> hello there"
+
+
+def test_empty_patch():
+    assert apply_patch("box()", []) == "box()"
+
+
+def test_offsets_count_utf16_code_units():
+    # the emoji is two UTF-16 code units, so "world" starts at 9, not 8
+    assert apply_patch("hello 😀 world", [[9, 5, "there"]]) == "hello 😀 there"
+
+
+def test_replacing_a_whole_surrogate_pair():
+    assert apply_patch("a😀b", [[1, 2, "é"]]) == "aéb"
+
+
+def test_splitting_a_surrogate_pair_is_invalid():
+    with pytest.raises(ValueError):
+        apply_patch("a😀b", [[2, 0, "x"]])
+
+
+@pytest.mark.parametrize("patch", [[[6, 10, "x"]], [[-1, 0, "x"]], [[12, 0, "x"]]])
+def test_out_of_range(patch):
+    with pytest.raises(ValueError):
+        apply_patch("hello world", patch)
+
+
+@pytest.mark.parametrize("patch", [[["0", 0, "x"]], [[0, 0, 1]], [[0, 0]], [None]])
+def test_malformed(patch):
+    with pytest.raises((TypeError, ValueError)):
+        apply_patch("hello world", patch)
+
+
+def test_saving_a_patch(client):
+    c, headers = client
+    c.put(PROGRAM, headers=headers, data={'program': json.dumps({'source': 'hello 😀 world'})})
+    version = c.get(PROGRAM).get_json()['version']
+
+    r = c.put(PROGRAM, headers=headers,
+              data={'program': json.dumps({'base': version, 'patch': [[9, 5, 'there']]})})
+    assert r.status_code == 200
+    assert c.get(PROGRAM).get_json()['source'] == 'hello 😀 there'
+
+
+def test_an_out_of_range_patch_is_a_400(client):
+    c, headers = client
+    c.put(PROGRAM, headers=headers, data={'program': json.dumps({'source': 'box()'})})
+    version = c.get(PROGRAM).get_json()['version']
+
+    r = c.put(PROGRAM, headers=headers, data={'program': json.dumps({'base': version, 'patch': [[3, 10, '']]})})
+    assert r.status_code == 400
+    assert c.get(PROGRAM).get_json()['source'] == 'box()'
+
+
+def test_a_patch_of_an_old_version_is_a_409(client):
+    c, headers = client
+    c.put(PROGRAM, headers=headers, data={'program': json.dumps({'source': 'box()'})})
+    version = c.get(PROGRAM).get_json()['version']
+    time.sleep(0.01)  # versions are save times to the millisecond
+    c.put(PROGRAM, headers=headers, data={'program': json.dumps({'source': 'sphere()'})})
+
+    r = c.put(PROGRAM, headers=headers, data={'program': json.dumps({'base': version, 'patch': [[0, 0, '#']]})})
+    assert r.status_code == 409
+    assert c.get(PROGRAM).get_json()['source'] == 'sphere()'
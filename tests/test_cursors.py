@@ -0,0 +1,45 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from src.db_translate import decode_cursor, encode_cursor
+
+
+def test_round_trip():
+    assert decode_cursor(encode_cursor("MyPrograms"), 1) == ["MyPrograms"]
+
+
+def test_datetimes_come_back_as_iso_strings():
+    dt = datetime(2026, 10, 18, 9, 30, 0, 123000)
+    cursor = encode_cursor(dt, "Bouncing%20Ball")
+    assert decode_cursor(cursor, 2) == [dt.isoformat(), "Bouncing%20Ball"]
+    assert datetime.fromisoformat(decode_cursor(cursor, 2)[0]) == dt
+
+
+def test_cursors_are_url_safe():
+    cursor = encode_cursor("a/b?c=d&e" * 10)
+    assert all(ch.isalnum() or ch in "-_=" for ch in cursor)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    base64.urlsafe_b64encode(json.dumps({"a": 1}).encode()).decode(),
+    base64.urlsafe_b64encode(json.dumps([1]).encode()).decode(),
+])
+def test_invalid(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 1)
+
+
+def test_wrong_number_of_values():
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor("a", "b"), 1)
+
+
+def test_an_invalid_cursor_is_a_400(client):
+    c, headers = client
+    assert c.get('/api/user/bob/folder/?cursor=garbage').status_code == 400
+    assert c.get('/api/user/bob/folder/MyPrograms/program/?cursor=garbage').status_code == 400
@@ -0,0 +1,128 @@
+import time
+
+import fakeredis
+import pytest
+import redis
+
+from src import db_cache
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url', classmethod(lambda cls, url: fakeredis.FakeRedis(server=server)))
+    return server
+
+
+@pytest.fixture
+def process_cache():
+    cache = db_cache.ProcessCache('test', maxsize=8, ttl=60)
+    yield cache
+    db_cache.process_caches.pop('test', None)
+
+
+def test_redis_cache_get_set_delete(redis_server):
+    cache = db_cache.RedisCache('redis://fake')
+    assert cache.get('program:a/b/c') is None
+    cache.set('program:a/b/c', {"source": "box()"})
+    assert cache.get('program:a/b/c') == {"source": "box()"}
+    cache.delete('program:a/b/c', 'summaries:a/b')
+    assert cache.get('program:a/b/c') is None
+
+
+def test_redis_cache_sets_ttl(redis_server):
+    cache = db_cache.RedisCache('redis://fake', ttl=30)
+    cache.set('k', 1)
+    assert 0 < cache.client.ttl('k') <= 30
+
+
+def test_redis_cache_outage_is_a_miss(redis_server):
+    cache = db_cache.RedisCache('redis://fake')
+    cache.set('k', 1)
+    redis_server.connected = False
+    assert cache.get('k') is None
+    cache.set('k', 2)
+    cache.delete('k')
+
+
+def test_local_cache_get_set_delete():
+    cache = db_cache.LocalCache()
+    assert cache.get('k') is None
+    cache.set('k', [1, 2])
+    assert cache.get('k') == [1, 2]
+    cache.delete('k', 'other')
+    assert cache.get('k') is None
+
+
+def test_local_cache_expires():
+    cache = db_cache.LocalCache(ttl=0.05)
+    cache.set('k', 1)
+    time.sleep(0.1)
+    assert cache.get('k') is None
+
+
+def test_make_shared_cache(redis_server):
+    assert isinstance(db_cache.make_shared_cache(None), db_cache.NullCache)
+    assert isinstance(db_cache.make_shared_cache('local'), db_cache.LocalCache)
+    assert isinstance(db_cache.make_shared_cache('redis://fake'), db_cache.RedisCache)
+    with pytest.raises(ValueError):
+        db_cache.make_shared_cache('memcached://fake')
+
+
+def test_process_cache_hits_and_invalidate(process_cache):
+    calls = []
+
+    @process_cache
+    def lookup(glue, name):
+        calls.append(name)
+        return name.upper()
+
+    assert lookup(None, 'bob') == 'BOB'
+    assert lookup(None, 'bob') == 'BOB'
+    assert calls == ['bob']
+    process_cache.invalidate('bob')
+    assert lookup(None, 'bob') == 'BOB'
+    assert calls == ['bob', 'bob']
+    stats = process_cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_process_cache_doesnt_store_misses(process_cache):
+    calls = []
+
+    @process_cache
+    def lookup(glue, name):
+        calls.append(name)
+        return None
+
+    lookup(None, 'nobody')
+    lookup(None, 'nobody')
+    assert calls == ['nobody', 'nobody']
+
+
+def test_process_cache_drops_a_read_raced_by_invalidate(process_cache):
+    @process_cache
+    def lookup(glue, name):
+        process_cache.invalidate(name)  # a write lands while the read is in flight
+        return 'old'
+
+    lookup(None, 'bob')
+    assert process_cache.stats()["size"] == 0
+
+
+def test_process_cache_expires():
+    cache = db_cache.ProcessCache('test-ttl', ttl=0.05)
+    try:
+        calls = []
+
+        @cache
+        def lookup(glue, name):
+            calls.append(name)
+            return name
+
+        lookup(None, 'bob')
+        time.sleep(0.1)
+        lookup(None, 'bob')
+        assert calls == ['bob', 'bob']
+    finally:
+        db_cache.process_caches.pop('test-ttl', None)
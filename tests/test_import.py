@@ -0,0 +1,54 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+from src import routes
+
+IMPORT = '/api/user/bob/import'
+
+
+def archive(entries):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, mode='w', compression=zipfile.ZIP_DEFLATED) as za:
+        for name, content in entries.items():
+            za.writestr(name, content)
+    return data.getvalue()
+
+
+def program(source):
+    return json.dumps({"source": source, "datetime": "2026-10-18T09:30:00"})
+
+
+def test_import(client):
+    c, headers = client
+    r = c.put(IMPORT, headers=headers, data=archive({'MyPrograms/a.json': program('box()')}))
+    assert r.status_code == 200
+    assert r.get_json() == {"folders": 0, "programs": 1}
+    assert c.get('/api/user/bob/folder/MyPrograms/program/a').get_json()['source'] == 'box()'
+
+
+def test_an_entry_that_unpacks_too_large_is_a_413(client, monkeypatch):
+    c, headers = client
+    monkeypatch.setattr(routes, 'IMPORT_MAX_ENTRY_SIZE', 1000)
+    # compresses to a few dozen bytes
+    r = c.put(IMPORT, headers=headers, data=archive({'MyPrograms/a.json': program(' ' * 2000)}))
+    assert r.status_code == 413
+    assert 'error' in c.get('/api/user/bob/folder/MyPrograms/program/a').get_json()
+
+
+def test_an_archive_that_unpacks_too_large_is_a_413(client, monkeypatch):
+    c, headers = client
+    monkeypatch.setattr(routes, 'IMPORT_MAX_SIZE', 1000)
+    entries = {'MyPrograms/%d.json' % i: program(' ' * 200) for i in range(5)}
+    assert c.put(IMPORT, headers=headers, data=archive(entries)).status_code == 413
+
+
+@pytest.mark.parametrize("entries", [3, 4])
+def test_too_many_entries_is_a_413(client, monkeypatch, entries):
+    c, headers = client
+    monkeypatch.setattr(routes, 'IMPORT_MAX_ENTRIES', 3)
+    r = c.put(IMPORT, headers=headers,
+              data=archive({'MyPrograms/%d.json' % i: program('box()') for i in range(entries)}))
+    assert r.status_code == (entries > 3 and 413 or 200)
@@ -0,0 +1,109 @@
+import contextlib
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from src import commands, mongo_models
+
+
+class Source:
+    """
+    Stands in for the NDB glue the migration reads from, with the users,
+    folders and programs given as {user: {folder: (public, {name: (source, screenshot)})}}.
+    """
+
+    def __init__(self, users, fail_on=None):
+        self.users = users
+        self.fail_on = fail_on
+        self.stream_context = contextlib.nullcontext
+
+    def users_page(self, limit, cursor=None):
+        names = sorted(self.users)
+        start = int(cursor or 0)
+        page = [SimpleNamespace(name=name, email=name + "@example.com", secret="s-" + name, gaeUser=None,
+                                joinDate=datetime(2020, 1, 1)) for name in names[start:start + limit]]
+        more = start + limit < len(names)
+        return page, more and str(start + limit) or None
+
+    def get_id(self, obj):
+        return obj.name
+
+    def folders(self, user):
+        if user == self.fail_on:
+            raise IOError("interrupted")
+        return [SimpleNamespace(name=name, isPublic=public) for name, (public, _) in sorted(self.users[user].items())]
+
+    def iter_programs(self, user, folder):
+        for name, (source, shot) in sorted(self.users[user][folder][1].items()):
+            yield name, {"source": source, "datetime": datetime(2021, 1, 1)}, shot
+
+
+USERS = {
+    "ann": {"MyPrograms": (True, {"a": ("box()", (b"png-a", "image/png")), "b": ("sphere()", None)}),
+            "Private": (False, {})},
+    "bob": {"MyPrograms": (True, {"c": ("cone()", None)})},
+    "cat": {"MyPrograms": (True, {"d": ("ring()", (b"png-d", "image/png"))})},
+    "dan": {"MyPrograms": (True, {})},
+}
+
+
+def migrate(source, checkpoint, restart=False):
+    return commands.run_job('migrate-to-mongo', source,
+                            lambda cursor: source.users_page(2, cursor),
+                            lambda user, progress: commands.migrate_user(source, user, 100, progress),
+                            checkpoint, restart, workers=2)
+
+
+def contents(mongo):
+    """
+    Everything migrated, as sorted (user, folder, ...) tuples since parentIDs are ObjectIds.
+    """
+    users = {str(u["_id"]): u["key"] for u in mongo[mongo_models.User.get_motor_collection().name].find()}
+    folders = {str(f["_id"]): (users[f["parentID"]], f["key"], f["isPublic"])
+               for f in mongo[mongo_models.Folder.get_motor_collection().name].find()}
+    programs = sorted(folders[p["parentID"]][:2] + (p["key"], mongo_models.decompress_text(p["source"]))
+                      for p in mongo[mongo_models.Program.get_motor_collection().name].find())
+    shots = sorted(folders[s["parentID"]][:2] + (s["key"], s["image"])
+                   for s in mongo[mongo_models.Screenshot.get_motor_collection().name].find())
+    return sorted(users.values()), sorted(folders.values()), programs, shots
+
+
+EXPECTED = (
+    ["ann", "bob", "cat", "dan"],
+    [("ann", "MyPrograms", True), ("ann", "Private", False), ("bob", "MyPrograms", True),
+     ("cat", "MyPrograms", True), ("dan", "MyPrograms", True)],
+    [("ann", "MyPrograms", "a", "box()"), ("ann", "MyPrograms", "b", "sphere()"),
+     ("bob", "MyPrograms", "c", "cone()"), ("cat", "MyPrograms", "d", "ring()")],
+    [("ann", "MyPrograms", "a", b"png-a"), ("cat", "MyPrograms", "d", b"png-d")],
+)
+
+
+def test_migrate(mongo, tmp_path):
+    checkpoint = str(tmp_path / "migrate.json")
+    progress = migrate(Source(USERS), checkpoint)
+    assert contents(mongo) == EXPECTED
+    assert progress.counts == {"users": 4, "folders": 5, "programs": 4, "screenshots": 2}
+    with open(checkpoint) as f:
+        assert json.load(f)["finished"]
+
+
+def test_an_interrupted_migration_resumes(mongo, tmp_path):
+    checkpoint = str(tmp_path / "migrate.json")
+    # the second page (cat, dan) fails part way, after the first was checkpointed
+    with pytest.raises(IOError):
+        migrate(Source(USERS, fail_on="dan"), checkpoint)
+    with open(checkpoint) as f:
+        assert json.load(f)["cursor"] == "2"
+
+    # the resumed run does the second page again, cat isn't copied twice
+    migrate(Source(USERS), checkpoint)
+    assert contents(mongo) == EXPECTED
+
+
+def test_migrating_again_leaves_one_copy(mongo, tmp_path):
+    checkpoint = str(tmp_path / "migrate.json")
+    migrate(Source(USERS), checkpoint)
+    migrate(Source(USERS), checkpoint, restart=True)
+    assert contents(mongo) == EXPECTED
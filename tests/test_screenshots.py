@@ -0,0 +1,18 @@
+import json
+
+from src.db_translate import db
+
+
+def test_a_missing_screenshot_is_a_404(client):
+    c, headers = client
+    c.put('/api/user/bob/folder/MyPrograms/program/a', headers=headers,
+          data={'program': json.dumps({'source': 'box()'})})
+    assert c.get('/api/user/bob/folder/MyPrograms/program/a/screenshot').status_code == 404
+    assert c.get('/api/user/bob/folder/MyPrograms/program/b/screenshot').status_code == 404
+    assert c.get('/api/user/bob/folder/Nowhere/program/a/screenshot').status_code == 404
+    assert c.get('/api/user/nobody/folder/MyPrograms/program/a/screenshot').status_code == 404
+
+
+def test_screenshots_of_an_unknown_user_or_folder(client):
+    assert db.load_screenshots('nobody', 'MyPrograms', ['a']) == {}
+    assert db.load_screenshots('bob', 'Nowhere', ['a']) == {}
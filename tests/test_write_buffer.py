@@ -0,0 +1,108 @@
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+from src.write_buffer import WriteBuffer
+
+
+class Store:
+    """
+    What the buffer writes to: remembers every write() call.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def write(self, programs):
+        if self.fail:
+            raise IOError("datastore unavailable")
+        self.calls.append([p.source for p in programs])
+
+
+@pytest.fixture
+def store():
+    return Store()
+
+
+@pytest.fixture
+def buffer(store):
+    # a delay long enough that the background thread never flushes during a test
+    buf = WriteBuffer(store.write, contextlib.nullcontext, delay=3600, max_pending=10)
+    yield buf
+    buf.closed = True
+    buf.wakeup.set()
+
+
+def program(source):
+    return SimpleNamespace(source=source)
+
+
+def test_saves_of_a_program_are_merged(buffer, store):
+    buffer.put(('bob', 'f', 'a'), program('v1'))
+    buffer.put(('bob', 'f', 'a'), program('v2'))
+    assert buffer.get(('bob', 'f', 'a')).source == 'v2'
+    assert store.calls == []
+
+    buffer.flush()
+    assert store.calls == [['v2']]
+    assert buffer.get(('bob', 'f', 'a')) is None
+    assert buffer.stats()["saves"] == 2 and buffer.stats()["writes"] == 1
+
+
+def test_flush_path_writes_only_that_program(buffer, store):
+    buffer.put(('bob', 'f', 'a'), program('a1'))
+    buffer.put(('bob', 'f', 'b'), program('b1'))
+    buffer.flush_path(('bob', 'f', 'a'))
+    assert store.calls == [['a1']]
+    assert buffer.get(('bob', 'f', 'b')).source == 'b1'
+
+
+def test_flush_folder(buffer, store):
+    buffer.put(('bob', 'f', 'a'), program('a1'))
+    buffer.put(('bob', 'g', 'b'), program('b1'))
+    buffer.flush_folder('bob', 'f')
+    assert store.calls == [['a1']]
+
+
+def test_flush_only_what_is_due(buffer, store):
+    buffer.put(('bob', 'f', 'a'), program('a1'))
+    buffer.flush(older_than=60)
+    assert store.calls == []
+    buffer.flush(older_than=0)
+    assert store.calls == [['a1']]
+
+
+def test_too_many_pending_saves_are_flushed(buffer, store):
+    for i in range(10):
+        buffer.put(('bob', 'f', str(i)), program(str(i)))
+    assert sorted(sum(store.calls, [])) == sorted(str(i) for i in range(10))
+
+
+def test_a_failed_write_is_retried(buffer, store):
+    buffer.put(('bob', 'f', 'a'), program('a1'))
+    store.fail = True
+    buffer.flush()
+    assert buffer.get(('bob', 'f', 'a')).source == 'a1'
+
+    store.fail = False
+    buffer.flush()
+    assert store.calls == [['a1']]
+
+
+def test_a_newer_save_wins_over_a_retried_one(buffer, store):
+    buffer.put(('bob', 'f', 'a'), program('a1'))
+    store.fail = True
+    buffer.flush()
+    buffer.put(('bob', 'f', 'a'), program('a2'))
+    store.fail = False
+    buffer.flush()
+    assert store.calls == [['a2']]
+
+
+def test_close_writes_everything(store):
+    buf = WriteBuffer(store.write, contextlib.nullcontext, delay=3600)
+    buf.put(('bob', 'f', 'a'), program('a1'))
+    buf.close()
+    assert store.calls == [['a1']]